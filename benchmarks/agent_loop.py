@@ -0,0 +1,156 @@
+"""Compares the wakeup-driven Agent main loop against the old loop, which slept
+for 100ms after every step of run() before looking at its queue.
+
+Two things are measured:
+
+latency
+    A message is relayed through a chain of agents with @Agent.queued calls,
+    the same way a chat line goes from the IRC plugin to the core to a queued
+    command plugin. Reports the time from the first call to the last agent
+    handling it.
+
+idle cpu
+    A number of idle agents are left running, and the CPU time used by the
+    whole process is reported.
+
+Run from the repository root:
+
+    python benchmarks/agent_loop.py [--agents N] [--messages N] [--idle SECONDS]
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from queue import Empty
+from traceback import format_exc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hesperus.agent import Agent
+
+class QuietAgent(Agent):
+    def log(self, level, *message):
+        pass
+
+class PollingAgent(QuietAgent):
+    """An Agent using the old main loop, kept here for comparison."""
+    def run(self):
+        while True:
+            yield
+
+    def start(self):
+        with self.lock:
+            self._running = True
+            self._error = None
+            # what Agent._begin() does for start_threaded() and join()
+            self._finished.clear()
+            self._started.set()
+        try:
+            it = self.run()
+            while self._running:
+                try:
+                    next(it)
+                except StopIteration:
+                    break
+                time.sleep(0.1)
+                while self._running:
+                    try:
+                        item = self.queue.get_nowait()
+                    except Empty:
+                        break
+                    else:
+                        item[0](self, *item[1], **item[2])
+        except Exception as e:
+            with self.lock:
+                self._error = (e, format_exc())
+        finally:
+            with self.lock:
+                self._running = False
+                self._thread = None
+                self._finished.set()
+
+def make_relay(base):
+    class Relay(base):
+        def __init__(self, target=None, done=None):
+            super(Relay, self).__init__(daemon=True)
+            self.target = target
+            self.done = done
+
+        @Agent.queued
+        def relay(self, started):
+            if self.target is not None:
+                self.target.relay(started)
+            else:
+                self.done(time.time() - started)
+    return Relay
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def bench_latency(base, hops, messages):
+    Relay = make_relay(base)
+    results = []
+    finished = threading.Event()
+    def done(elapsed):
+        results.append(elapsed)
+        finished.set()
+
+    chain = [Relay(done=done)]
+    for _ in range(hops - 1):
+        chain.append(Relay(target=chain[-1]))
+    for agent in chain:
+        agent.start_threaded()
+
+    try:
+        for _ in range(messages):
+            finished.clear()
+            chain[-1].relay(time.time())
+            finished.wait(10)
+            # space messages out like a chat would
+            time.sleep(0.05)
+    finally:
+        for agent in chain:
+            agent.stop()
+    return results
+
+def bench_idle(base, agents, seconds):
+    Relay = make_relay(base)
+    running = [Relay() for _ in range(agents)]
+    for agent in running:
+        agent.start_threaded()
+    try:
+        # let them settle before measuring
+        time.sleep(0.5)
+        cpu = time.process_time()
+        time.sleep(seconds)
+        return time.process_time() - cpu
+    finally:
+        for agent in running:
+            agent.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hops', type=int, default=3, help='agents in the relay chain')
+    parser.add_argument('--messages', type=int, default=50, help='messages to relay')
+    parser.add_argument('--agents', type=int, default=40, help='idle agents for the cpu test')
+    parser.add_argument('--idle', type=float, default=5.0, help='seconds to measure idle cpu for')
+    args = parser.parse_args()
+
+    print("%-10s %10s %10s %10s %14s" % ('loop', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'idle cpu (s)'))
+    for label, base in [('polling', PollingAgent), ('wakeup', QuietAgent)]:
+        latencies = bench_latency(base, args.hops, args.messages)
+        idle = bench_idle(base, args.agents, args.idle)
+        print("%-10s %10.2f %10.2f %10.2f %14.3f" % (
+            label,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000,
+            idle,
+        ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""End-to-end benchmark of the whole message path: a Core is built from an XML
+config, a fake connector plugin (benchmarks/e2e_plugins.py) injects a
+synthetic chat stream the way the IRC plugin would, and every reply is timed
+from when its line was injected.
+
+Each scenario reports:
+
+throughput
+    lines per second, injecting as fast as the core accepts them and
+    waiting for every reply
+
+latency
+    p50 / p99 / max from injection to reply, with lines paced at --rate
+
+idle
+    CPU seconds and context switches (a stand-in for wakeups) while the bot
+    sits idle for --idle seconds afterwards
+
+memory
+    growth of the resident set size over the scenario
+
+The scenarios cover 1, 10 and 50 plugins, with command-heavy and
+passive-heavy mixes of lines, and with a plugin that stalls on every line.
+Results are written as JSON to --output. Given a --baseline from an earlier
+run, scenarios whose throughput dropped or whose p99 latency grew by more than
+--tolerance are listed, and the exit status is 1.
+
+Run from the repository root:
+
+    python benchmarks/e2e.py [--output FILE] [--baseline FILE] [--only NAME]
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from hesperus.agent import Agent
+from hesperus.core import Core
+
+# (name, number of plugins, fraction of lines that are commands, stalled)
+SCENARIOS = [
+    ('1-plugin-commands', 1, 1.0, False),
+    ('10-plugins-commands', 10, 0.9, False),
+    ('10-plugins-passive', 10, 0.1, False),
+    ('50-plugins-commands', 50, 0.9, False),
+    ('50-plugins-passive', 50, 0.1, False),
+    ('10-plugins-stalled', 10, 0.5, True),
+]
+
+def quiet(*args):
+    pass
+
+def make_config(plugins, command_share, stalled, runtime):
+    """Returns the XML config for a scenario. Half of the plugins (at least
+    one, unless there are no passive lines) are passive."""
+    passive = 0 if command_share >= 1.0 else max(1, plugins // 2)
+    commands = plugins - passive
+    lines = ['<config runtime="%s">' % (runtime,)]
+    lines.append('  <plugin type="e2e_plugins.FakeConnector" />')
+    lines.append('  <plugin type="hesperus.plugins.command.CommandPlugin" channels="default">')
+    lines.append('    <command_chars>!</command_chars>')
+    lines.append('  </plugin>')
+    for i in range(commands):
+        lines.append('  <plugin type="e2e_plugins.Command%d" channels="default" />' % (i,))
+    for i in range(passive):
+        lines.append('  <plugin type="e2e_plugins.Passive%d" channels="default" />' % (i,))
+    if stalled:
+        lines.append('  <plugin type="e2e_plugins.StalledPlugin" channels="default"'
+                ' queue-size="100" queue-policy="drop-oldest">')
+        lines.append('    <stall>0.5</stall>')
+        lines.append('  </plugin>')
+    lines.append('</config>')
+    return '\n'.join(lines), commands, passive
+
+def make_lines(count, commands, passive, command_share, seed=1):
+    """Makes count lines, each of which gets exactly one reply."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        if passive == 0 or (commands and rng.random() < command_share):
+            lines.append('!cmd%d some argument %d' % (rng.randrange(commands), i))
+        else:
+            lines.append('did anyone see word%d earlier? line %d' % (rng.randrange(passive), i))
+    return lines
+
+def rss():
+    """Current resident set size in bytes, if we can tell."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run_scenario(name, plugins, command_share, stalled, args):
+    text, commands, passive = make_config(plugins, command_share, stalled, args.runtime)
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as f:
+        f.write(text)
+        fname = f.name
+
+    rss_start = rss()
+    try:
+        core = Core.load_from_file(fname)
+    finally:
+        os.unlink(fname)
+    connector = [p for p in core.plugins if p.__class__.__name__ == 'FakeConnector'][0]
+    core.start_threaded()
+    try:
+        # throughput: as fast as the core will take them
+        lines = make_lines(args.messages, commands, passive, command_share)
+        started = time.perf_counter()
+        for line in lines:
+            connector.inject(line)
+        complete = connector.wait_for(len(lines), args.timeout)
+        elapsed = time.perf_counter() - started
+        connector.take_latencies()
+
+        # latency: paced like a busy channel
+        lines = make_lines(args.paced, commands, passive, command_share, seed=2)
+        interval = 1.0 / args.rate
+        for line in lines:
+            connector.inject(line)
+            time.sleep(interval)
+        complete = connector.wait_for(len(lines), args.timeout) and complete
+        latencies = connector.take_latencies()
+
+        # idle
+        time.sleep(0.5)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        time.sleep(args.idle)
+        idle = resource.getrusage(resource.RUSAGE_SELF)
+        rss_end = rss()
+    finally:
+        core.stop()
+        core.join()
+        core.remove_all_plugins()
+
+    return {
+        'name': name,
+        'plugins': plugins,
+        'command_share': command_share,
+        'stalled': stalled,
+        'complete': complete,
+        'messages_per_second': args.messages / elapsed,
+        'latency_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'latency_p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'latency_max_ms': max(latencies) * 1000 if latencies else None,
+        'idle_cpu_seconds': (idle.ru_utime + idle.ru_stime) - (usage.ru_utime + usage.ru_stime),
+        'idle_context_switches': (idle.ru_nvcsw + idle.ru_nivcsw) - (usage.ru_nvcsw + usage.ru_nivcsw),
+        'rss_growth_bytes': rss_end - rss_start,
+    }
+
+def compare(results, baseline, tolerance):
+    """Returns a list of descriptions of regressions from baseline."""
+    old = dict((r['name'], r) for r in baseline.get('scenarios', []))
+    problems = []
+    for r in results:
+        b = old.get(r['name'])
+        if b is None:
+            continue
+        if r['messages_per_second'] < b['messages_per_second'] * (1 - tolerance):
+            problems.append('%s: throughput %.0f/s, was %.0f/s' % (
+                r['name'], r['messages_per_second'], b['messages_per_second']))
+        if r['latency_p99_ms'] and b['latency_p99_ms'] and \
+                r['latency_p99_ms'] > b['latency_p99_ms'] * (1 + tolerance):
+            problems.append('%s: p99 latency %.2fms, was %.2fms' % (
+                r['name'], r['latency_p99_ms'], b['latency_p99_ms']))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', default='e2e-results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression, as a fraction')
+    parser.add_argument('--only', help='only run scenarios whose name contains this')
+    parser.add_argument('--runtime', default='threads', choices=['threads', 'asyncio'], help='runtime to configure')
+    parser.add_argument('--messages', type=int, default=2000, help='lines for the throughput test')
+    parser.add_argument('--paced', type=int, default=300, help='lines for the latency test')
+    parser.add_argument('--rate', type=float, default=200.0, help='lines per second for the latency test')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds to measure idle cpu for')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for replies')
+    args = parser.parse_args()
+
+    # the plugins' logging would drown out the results
+    Agent.log = lambda self, level, *message: None
+
+    results = []
+    print("%-22s %10s %9s %9s %10s %8s %10s" % (
+        'scenario', 'lines/s', 'p50 ms', 'p99 ms', 'idle cpu', 'ctx sw', 'rss +KiB'))
+    for name, plugins, command_share, stalled in SCENARIOS:
+        if args.only and not args.only in name:
+            continue
+        r = run_scenario(name, plugins, command_share, stalled, args)
+        results.append(r)
+        print("%-22s %10.1f %9.2f %9.2f %10.3f %8d %10d%s" % (
+            name, r['messages_per_second'], r['latency_p50_ms'] or 0, r['latency_p99_ms'] or 0,
+            r['idle_cpu_seconds'], r['idle_context_switches'], r['rss_growth_bytes'] // 1024,
+            '' if r['complete'] else '  (missing replies)'))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runtime': args.runtime,
+            'scenarios': results,
+        }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print("REGRESSION", problem)
+        if problems:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Plugins used by benchmarks/e2e.py. They live in their own module so the
+generated configs can name them by type, the same way real plugins are."""
+
+import threading
+import time
+
+from hesperus.message import Message
+from hesperus.plugin import Plugin, CommandPlugin, PassivePlugin
+
+class FakeConnector(Plugin):
+    """Stands in for the IRC plugin: inject() hands a line to the core the
+    same way, and every reply is timed against when its line was injected."""
+    def __init__(self, core, channel='default'):
+        super(FakeConnector, self).__init__(core)
+        self.channel = channel
+        self.subscribe(channel)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.replied = threading.Condition(self.lock)
+        self.outgoing = 0
+
+    def log(self, level, *message):
+        pass
+
+    def inject(self, msg, direct=False, nick='someone'):
+        started = time.perf_counter()
+        def reply(text):
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.replied.notify_all()
+        self.parent.handle_message(Message((self.channel,), nick, msg, direct, reply))
+
+    def wait_for(self, replies, timeout):
+        """Waits until at least replies replies have come in, returns whether
+        they did."""
+        deadline = time.time() + timeout
+        with self.lock:
+            while len(self.latencies) < replies:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.replied.wait(remaining)
+            return True
+
+    def take_latencies(self):
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+            return latencies
+
+    @Plugin.queued
+    def send_outgoing(self, chan, msg):
+        self.outgoing += 1
+
+def make_command_plugin(index):
+    """Makes a CommandPlugin class answering "cmd<index> ..." lines."""
+    def command(self, chans, name, match, direct, reply):
+        reply("cmd%d: %s" % (index, match.group(1)))
+    command = CommandPlugin.register_command(r"cmd%d\s+(.+)" % (index,))(command)
+    return type('Command%d' % (index,), (QuietCommandPlugin,), {'command': command})
+
+def make_passive_plugin(index):
+    """Makes a PassivePlugin class answering lines containing
+    "word<index>"."""
+    def pattern(self, match, reply):
+        reply("heard word%d" % (index,))
+    pattern = PassivePlugin.register_pattern(r"\bword%d\b" % (index,))(pattern)
+    return type('Passive%d' % (index,), (QuietPassivePlugin,), {'pattern': pattern})
+
+class QuietCommandPlugin(CommandPlugin):
+    def log(self, level, *message):
+        pass
+
+class QuietPassivePlugin(PassivePlugin):
+    def log(self, level, *message):
+        pass
+
+class StalledPlugin(Plugin):
+    """Sees every line and takes stall seconds over each one, without
+    replying, like a plugin stuck on a slow network request."""
+    @Plugin.config_types(stall=float)
+    def __init__(self, core, stall=2.0):
+        super(StalledPlugin, self).__init__(core)
+        self.stall = stall
+
+    def log(self, level, *message):
+        pass
+
+    @Plugin.queued
+    def handle_incoming(self, chans, name, msg, direct, reply):
+        time.sleep(self.stall)
+
+# plugin classes made by the functions above, for configs to name
+_plugins = {}
+for _i in range(64):
+    for _cls in (make_command_plugin(_i), make_passive_plugin(_i)):
+        _plugins[_cls.__name__] = _cls
+globals().update(_plugins)
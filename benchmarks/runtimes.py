@@ -0,0 +1,112 @@
+"""Compares message throughput through a real Core between the ways agents can
+be run:
+
+threads
+    every agent in a thread of its own (the default)
+
+scheduler
+    plugins share a hesperus.scheduler.Scheduler (<config plugin-threads="N">)
+
+asyncio
+    the core and plugins on one event loop (<config runtime="asyncio">)
+
+A feeder thread pushes lines into Core.handle_incoming() the way a connector
+does, and each of the plugins counts the lines it is handed. Reports lines per
+second from the first line sent to the last one handled by every plugin, and
+the number of threads started for it.
+
+Each runtime is run twice: with the default call queues, and with the
+plugins' queues cut down to --queue-size calls, so they fill up and callers
+have to wait for room (or, on the event loop, queue past the limit).
+
+Run from the repository root:
+
+    python benchmarks/runtimes.py [--plugins N] [--messages N] [--workers N] [--queue-size N]
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hesperus.agent import Agent
+from hesperus.aio import AsyncioRuntime
+from hesperus.core import Core
+from hesperus.plugin import Plugin
+from hesperus.scheduler import Scheduler
+
+class QuietCore(Core):
+    def log(self, level, *message):
+        pass
+
+class Counter(Plugin):
+    def __init__(self, core, expected, done):
+        super(Counter, self).__init__(core, channels=['default'])
+        self.expected = expected
+        self.done = done
+        self.count = 0
+
+    def log(self, level, *message):
+        pass
+
+    @Agent.queued
+    def handle_incoming(self, chans, name, msg, direct, reply):
+        self.count += 1
+        if self.count == self.expected:
+            self.done()
+
+def bench(runtime, plugins, messages, workers, queue_size=None):
+    core = QuietCore()
+    if runtime == 'scheduler':
+        core.scheduler = Scheduler(workers)
+    elif runtime == 'asyncio':
+        core.scheduler = AsyncioRuntime()
+
+    baseline = threading.active_count()
+    finished = threading.Semaphore(0)
+    counters = []
+    for _ in range(plugins):
+        plug = Counter(core, messages, finished.release)
+        if queue_size is not None:
+            plug.set_queue(queue_size, plug.queue.policy)
+        core.add_plugin(plug)
+        counters.append(plug)
+    core.start_threaded()
+
+    reply = lambda msg: None
+    try:
+        started = time.time()
+        for i in range(messages):
+            core.handle_incoming(['default'], 'someone', 'line %d' % (i,), False, reply)
+        threads = threading.active_count() - baseline
+        for _ in range(plugins):
+            finished.acquire()
+        elapsed = time.time() - started
+    finally:
+        core.stop()
+        core.join()
+        for plug in counters:
+            plug.join()
+    return messages / elapsed, threads
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--plugins', type=int, default=40, help='plugins listening to every line')
+    parser.add_argument('--messages', type=int, default=2000, help='lines to send')
+    parser.add_argument('--workers', type=int, default=4, help='scheduler worker threads')
+    parser.add_argument('--queue-size', type=int, default=16, help='plugin call queue size for the second run')
+    args = parser.parse_args()
+
+    for title, queue_size in [('default queues', None), ('queues of %d' % (args.queue_size,), args.queue_size)]:
+        print(title)
+        print("%-10s %14s %8s" % ('runtime', 'lines/s', 'threads'))
+        for runtime in ['threads', 'scheduler', 'asyncio']:
+            rate, threads = bench(runtime, args.plugins, args.messages, args.workers, queue_size)
+            print("%-10s %14.1f %8d" % (runtime, rate, threads))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Compares hesperus.timespec.parse() against the cascade of regular
+expressions RemindPlugin used to read timespecs with: 2 "for" patterns, 2
+"in" patterns and 8 "at" patterns, tried one after another.
+
+Both are run over a corpus of reminder messages like the ones people send
+(the part after "remind <nick>"), including ones without a timespec, which
+go through every pattern. Reports the time per message for each, and how
+many messages each of them found a timespec in, or failed on. The old
+parser raises KeyError or ValueError on units and months it doesn't know;
+those are counted as failures.
+
+Run from the repository root:
+
+    python benchmarks/timespec.py [--rounds N]
+
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hesperus import timespec
+
+CORPUS = [
+    "in 10 mins take the pizza out",
+    "take the pizza out in 10 mins",
+    "call your mom in 2 hours",
+    "in 1 hour 30 mins stretch",
+    "stretch in 1 hour 30 mins",
+    "in 3 days renew the domain",
+    "renew the domain in 3 days",
+    "water the plants for 2 weeks",
+    "for 1 week check on the build farm",
+    "pay rent at 2024-Nov-01 09:00:00",
+    "at Nov 01 2024 09:00:00 pay rent",
+    "at 01 Nov 2024 09:00:00 pay rent",
+    "standup at 2024 01 Dec 09:30:00",
+    "that the meeting moved to thursday",
+    "to bring the projector",
+    "you owe me a beer",
+    "the deploy is done, go home",
+    "check the logs on hesperus, the rss feed is stuck again",
+    "look at the PR I linked in #dev",
+    "in the morning, buy coffee",
+    "to read https://example.com/some/long/article/about/things-that-happen",
+    "ask about the lease in 5 days",
+    "in 45 mins get the laundry",
+    "get the laundry in 45 mins",
+    "in 2 weeks 3 days dentist",
+    "submit timesheet in 1 week",
+    "that you are at work in 8 hours",
+    "for 3 days take your antibiotics",
+    "feed the cat at 2024-Dec-24 18:00:00",
+    "happy birthday!!!",
+    "the thing at the place",
+    "in 20 secs test",
+    "test in 20 secs",
+    "in 1 year check this reminder still works",
+    "to push the release tag, and to tell agrif about it",
+    "bring snacks for the lan party in 2 days",
+    "meet at the pub in 30 mins",
+    "for 5 days do the exercises",
+    "leave for the airport in 3 hours",
+    "your keys are in the fridge",
+]
+
+class OldParser(object):
+    """RemindPlugin's parser before hesperus.timespec, kept for comparison."""
+    compres = [
+              re.compile(r"^in (?P<timespec>(\d+ \w+?s? ?)+) (?P<action>.*?)$"),
+              re.compile(r"^(?P<action>.*) in (?P<timespec>(\d+ \w+?s? ?)+)$"),
+              ]
+
+    atres = [
+            re.compile(r"^at (?P<month>\w{3,4})[-/ ](?P<day>\d\d?)[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
+            re.compile(r"^at (?P<year>\d{4})[-/ ](?P<month>\w{3,4})[-/ ](?P<day>\d\d?)\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
+            re.compile(r"^at (?P<year>\d{4})[-/ ](?P<day>\d\d?)[-/ ](?P<month>\w{3,4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
+            re.compile(r"^at (?P<day>\d\d?)[-/ ](?P<month>\w{3,4})[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
+            re.compile(r"^(?P<action>.*?) at (?P<month>\w{3,4})[-/ ](?P<day>\d\d?)[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
+            re.compile(r"^(?P<action>.*?) at (?P<year>\d{4})[-/ ](?P<month>\w{3,4})[-/ ](?P<day>\d\d?)\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
+            re.compile(r"^(?P<action>.*?) at (?P<year>\d{4})[-/ ](?P<day>\d\d?)[-/ ](?P<month>\w{3,4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
+            re.compile(r"^(?P<action>.*?) at (?P<day>\d\d?)[-/ ](?P<month>\w{3,4})[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$")
+            ]
+
+    forres = [
+        re.compile(r'(?P<action>.*) for (?P<timespec>(\d+ \w+?s? ?)+)$'),
+        re.compile(r"^for (?P<timespec>(\d+ \w+?s? ?)+) (?P<action>.*?)$"),
+    ]
+
+    unit_map = {
+        "second": 1,
+        "sec": 1,
+        "min": 60,
+        "minute": 60,
+        "hour": 60*60,
+        "hr": 60*60,
+        "day": 60*60*24,
+        "week": 60*60*24*7,
+        "wk": 60*60*24*7,
+        "month": 60*60*24*30,
+        "year": 60*60*24*365,
+    }
+
+    def _parse_and_extract(self, string):
+        now = int(time.time())
+        for regex in self.forres:
+            m = regex.match(string)
+            if m:
+                timespec = m.group('timespec').split(' ')
+                action = m.group('action')
+                val = 0
+                for x in range(0, len(timespec), 2):
+                    num = int(timespec[x])
+                    unit = timespec[x+1]
+                    if unit.endswith("s"):
+                        unit = unit[:-1]
+                    val += self.unit_map[unit] * num
+                return (-(now+val), action)
+
+        for regex in self.compres:
+            m = regex.match(string)
+            if m:
+                timespec = m.group("timespec").split(" ")
+                action = m.group("action")
+                val = 0
+                for x in range(0, len(timespec), 2):
+                    num = int(timespec[x])
+                    unit = timespec[x+1]
+                    if unit.endswith("s"):
+                        unit = unit[:-1]
+                    val += self.unit_map[unit] * num
+                return (now+val, action)
+
+        for regex in self.atres:
+            m = regex.match(string)
+            if m:
+                ts = time.strptime("%s %s %s %s %s %s" % m.group("year", "month", "day", "hour", "min", "sec"),
+                        "%Y %b %d %H %M %S")
+                return int(time.mktime(ts)), m.group("action")
+
+        # if still no match, assume no timespec
+        return (None, string)
+
+def old_parse(text):
+    try:
+        when, action = OldParser()._parse_and_extract(text)
+    except (KeyError, ValueError):
+        return 'error'
+    return 'none' if when is None else 'found'
+
+def new_parse(text):
+    try:
+        found = timespec.parse(text)
+    except timespec.TimespecError:
+        return 'error'
+    return 'none' if found.kind is None else 'found'
+
+def measure(parse, rounds):
+    outcomes = {'found': 0, 'none': 0, 'error': 0}
+    for text in CORPUS:
+        outcomes[parse(text)] += 1
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in CORPUS:
+            parse(text)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(CORPUS)), outcomes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rounds', type=int, default=500)
+    args = parser.parse_args()
+
+    print('%d messages, %d rounds' % (len(CORPUS), args.rounds))
+    print('%-12s %10s %8s %8s %8s' % ('parser', 'us/msg', 'found', 'none', 'errors'))
+    for name, parse in [('regexes', old_parse), ('timespec', new_parse)]:
+        per, outcomes = measure(parse, args.rounds)
+        print('%-12s %10.2f %8d %8d %8d' % (name, per * 1e6, outcomes['found'], outcomes['none'], outcomes['error']))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,53 @@
 import threading
 import time
-from queue import Queue, Empty
+from queue import Empty
 from traceback import format_exc
-from .ansi import colored
+from . import log
+from .callqueue import CallQueue, COALESCE
+from . import metrics
 import sys
 
+# the agent whose run() or queued calls are being executed in this thread
+_current = threading.local()
+
+# thread ident -> the agent it is working for, so that other threads (like
+# the profiler) can tell
+_working_for = {}
+
+def current_agent():
+    """Returns the Agent running in the current thread, or None."""
+    return getattr(_current, 'agent', None)
+
+def set_current_agent(agent):
+    """Marks the current thread as running agent (or nothing, if None).
+    Used by the runtimes that run agents."""
+    _current.agent = agent
+    working_for(agent)
+
+def working_for(agent):
+    """Marks the current thread as doing work for agent (or nothing, if
+    None), without otherwise treating it as the agent's thread."""
+    if agent is None:
+        _working_for.pop(threading.get_ident(), None)
+    else:
+        _working_for[threading.get_ident()] = agent
+
+def may_block():
+    """Returns False in a thread running an event loop (see hesperus.aio) or
+    shared by many agents (see hesperus.scheduler), which must not wait for
+    anything the loop, or the agents sharing it, would have to do."""
+    return not getattr(_current, 'loop', False)
+
+def set_loop_thread(running):
+    """Marks the current thread as running an event loop, or not. Used by
+    hesperus.aio, and by the Scheduler's workers."""
+    _current.loop = running
+
+def thread_agents():
+    """Returns a dict of thread ident -> the agent that thread is working for,
+    for every thread that is."""
+    return dict(_working_for)
+
 class Agent(object):
     """An agent is a class whose instances follow a standard protocol for
     running and for communicating with other agents.
@@ -40,9 +83,32 @@ class Agent(object):
     If the agent is to become the master of the current thread, the caller can
     just call start(), which does not return.
 
+    Many agents can also share a few threads with start_scheduled(), which
+    hands the agent to a hesperus.scheduler.Scheduler. Agents with
+    dedicated_thread set should always be given a thread of their own.
+
+    Whatever run() yields tells the agent how long it may sleep before run() is
+    resumed: a bare "yield" waits for one tick, a number waits up to that many
+    seconds, and Agent.forever waits until there is something to do. Queued
+    calls (and stop()) wake the agent immediately, and run() is resumed after
+    they are handled, so it should not assume it slept for the whole time.
+
     """
 
-    stdout_lock = threading.RLock()
+    # how long a bare "yield" in run() sleeps for
+    tick = 0.1
+    # yield this from run() to sleep until woken up by a queued call
+    forever = float('inf')
+    # set this on agents that must not share a thread with others, for
+    # example because they block in _wait() on something other than wake()
+    dedicated_thread = False
+    # set this as well if the agent only ever waits on wake() and readers(), so
+    # that it can run on an event loop after all, see hesperus.aio (it may be
+    # a property, if that is only true some of the time)
+    loop_native = False
+
+    # held by anyone printing to stdout, see hesperus.log
+    stdout_lock = log.stdout_lock
     
     def __init__(self, daemon=False):
         self.lock = threading.RLock()
@@ -50,7 +116,18 @@ class Agent(object):
         self._error = None
         self._thread = None
         self._daemon = daemon
-        self.queue = Queue(1000)
+        self.queue = CallQueue(1000)
+        self._wakeup = threading.Event()
+        self._alive = False
+        self._it = None
+        self._scheduler = None
+        self.metrics = metrics.for_agent(self)
+        self._log_level = None
+        # set once run() has started, and once it has finished, for
+        # start_threaded() and join() to wait on
+        self._started = threading.Event()
+        self._finished = threading.Event()
+        self._finished.set()
     
     # decorator to force a function to execute in the Agent's thread
     # XXX If the agent is not running in its own thread, will @queued methods
@@ -60,112 +137,223 @@ class Agent(object):
     @classmethod
     def queued(cls, func):
         def queued_intern(self, *args, **kwargs):
-            with self.lock:
-                if threading.current_thread() == self.thread:
-                    func(self, *args, **kwargs)
-                    return
-            self.queue.put((func, args, kwargs), True)
+            if current_agent() is self:
+                func(self, *args, **kwargs)
+                return
+            self._enqueue(func, args, kwargs)
         return queued_intern
+
+    def _enqueue(self, func, args, kwargs):
+        queue = self.queue
+        key = None
+        if queue.policy == COALESCE:
+            key = self.queue_key(func, args, kwargs)
+        # the time is for the queue wait metric
+        item = (func, args, kwargs, time.perf_counter())
+        if queue.put(item, self.queue_priority(func, args, kwargs), key, may_block()):
+            self.wake()
+
+    def set_queue(self, maxsize, policy):
+        """Replaces the queue of calls waiting for this agent with one holding
+        at most maxsize calls, and using the given policy when it is full
+        (see hesperus.callqueue.CallQueue). Only call this before starting
+        the agent."""
+        self.queue = CallQueue(maxsize, policy)
+
+    def queue_priority(self, func, args, kwargs):
+        """Returns True if this queued call should go ahead of the others."""
+        return False
+
+    def queue_key(self, func, args, kwargs):
+        """Returns the key the coalesce queue policy merges calls on. By
+        default, calls to the same method with the same arguments are merged,
+        ignoring callbacks (like reply) which are never equal."""
+        args = [a for a in args if not callable(a)]
+        kwargs = sorted((k, v) for k, v in kwargs.items() if not callable(v))
+        return (func, repr(args), repr(kwargs))
     
+    # these are only ever replaced under the lock, and like _running in
+    # start(), they can be read without it
+
     @property
     def running(self):
-        with self.lock:
-            return self._running
+        return self._running
     
     @property
     def error(self):
-        with self.lock:
-            return self._error
+        return self._error
     
+    @property
+    def alive(self):
+        """True from when the agent starts until run() has finished, which
+        may be a while after stop() is called."""
+        return self._alive
+
     @property
     def thread(self):
-        with self.lock:
-            return self._thread
+        return self._thread
     
     # override this in a subclass and yield every once in a while
     def run(self):
         while True:
-            yield
+            yield self.forever
+
+    def readers(self):
+        """Returns the files (or file descriptors) that run() is waiting to
+        read from. Runtimes that can watch them wake the agent up when one is
+        readable."""
+        return []
+
+    def wake(self):
+        """Wake the agent's thread up, if it is sleeping between steps of
+        run(). Safe to call from any thread."""
+        self._wakeup.set()
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.wake(self)
+
+    def _wait_seconds(self, timeout):
+        """Turn a value yielded from run() into a number of seconds to wait,
+        or None to wait until woken up."""
+        if timeout is None:
+            return self.tick
+        if timeout == self.forever:
+            return None
+        return max(timeout, 0)
+
+    def _wait(self, timeout):
+        """Sleep until woken up, or until timeout (as yielded from run())
+        runs out."""
+        timeout = self._wait_seconds(timeout)
+        if timeout != 0:
+            self._wakeup.wait(timeout)
+
+    def _handle_queue(self):
+        metrics = self.metrics
+        while self._running:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            else:
+                start = time.perf_counter()
+                metrics.queue_wait.observe(start - item[3])
+                item[0](self, *item[1], **item[2])
+                metrics.call.observe(time.perf_counter() - start)
         
-    def start(self):
+    def _begin(self):
         with self.lock:
             self._running = True
+            self._alive = True
             self._error = None
+            self._finished.clear()
+            self._started.set()
         
         self.log_debug("starting...")
-        
+        self._it = self.run()
+
+    def _step(self):
+        """Runs run() up to its next yield and handles the queued calls.
+        Returns what run() yielded, or raises StopIteration if it is done."""
+        # clear first, so anything queued from here on wakes us up
+        self._wakeup.clear()
+        timeout = next(self._it)
+        self._handle_queue()
+        return timeout
+
+    def _crashed(self, e):
+        self.metrics.exceptions += 1
+        with self.lock:
+            self._error = (e, format_exc())
+            self.log_debug("Thread for %s has crashed!" % self.__class__.__name__)
+
+    def _finish(self):
+        self.log_debug("stopping...")
+        with self.lock:
+            self._running = False
+            self._alive = False
+            self._thread = None
+            self._scheduler = None
+            self._it = None
+            self._finished.set()
+
+    def start(self):
+        self._begin()
+        previous = current_agent()
+        set_current_agent(self)
         try:
-            it = self.run()
             # Access to self._running does not necessarily need to be wrapped
             # around a lock: reading a variable is atomic in python -- it is a
             # single bytecode operation. It's especially safe here since
             # _running will always be one of the boolean singletons.
             while self._running:
                 try:
-                    next(it)
+                    timeout = self._step()
                 except StopIteration:
                     break
-                
-                # give a little leeway
-                time.sleep(0.1)
-
-                while self._running:
-                    try:
-                        item = self.queue.get_nowait()
-                    except Empty:
-                        break
-                    else:
-                        item[0](self, *item[1], **item[2])
+                self._wait(timeout)
         
         except Exception as e:
+            self._crashed(e)
             with self.lock:
-                self._error = (e, format_exc())
-                self.log_debug("Thread for %s has crashed!" % self.__class__.__name__)
                 if self._thread == None:
                     raise
         finally:
-            self.log_debug("stopping...")
-            with self.lock:
-                self._running = False
-                self._thread = None
+            set_current_agent(previous)
+            self._finish()
 
     def start_threaded(self):
+        self._started.clear()
         self._thread = threading.Thread(target=self.start)
         self._thread.daemon = self._daemon
         self._thread.start()
-        # wait until _running is true
-        while not self.running:
-            time.sleep(0.1)
+        # wait until run() has started
+        self._started.wait()
+
+    def join(self, timeout=None):
+        """Waits until run() has finished, however the agent is run. Returns
+        False if timeout seconds went by first."""
+        return self._finished.wait(timeout)
+
+    def start_scheduled(self, scheduler):
+        """Run the agent on a hesperus.scheduler.Scheduler's worker threads
+        instead of a thread of its own."""
+        scheduler.add(self)
     
     def stop(self):
         with self.lock:
             self._running = False
+        self.wake()
+
+    @property
+    def log_level(self):
+        """The lowest level of message this agent logs. Unless set for the
+        agent, this is hesperus.log.default_level."""
+        if self._log_level is None:
+            return log.default_level
+        return self._log_level
+
+    @log_level.setter
+    def log_level(self, level):
+        self._log_level = level
+
+    @classmethod
+    def _log_domain(cls):
+        domain = cls.__dict__.get('_log_domain_name')
+        if domain is None:
+            domain = cls.__module__ + "." + cls.__name__
+            if domain.startswith('hesperus.'):
+                domain = domain.split('.', 1)[1]
+            else:
+                domain = 'extern.' + domain
+            cls._log_domain_name = domain
+        return domain
 
     def log(self, level, *message):
-        global stdout_lock
-        cls = self.__class__
-        
-        levels = [
-            lambda s: colored('debug: ' + s, 'bold', 'black'),
-            lambda s: colored(s, 'white'),
-            lambda s: colored(s, 'bold', 'white'),
-            lambda s: colored('warning', 'bold', 'yellow') + ': ' + colored(s, 'yellow'),
-            lambda s: colored('error', 'bold', 'red') + ': ' + colored(s, 'red'),
-        ]
-        
-        timebuf = time.strftime("%x %X")
-        domain = cls.__module__ + "." + cls.__name__
-        if domain.startswith('hesperus.'):
-            domain = domain.split('.', 1)[1]
-        else:
-            domain = 'extern.' + domain
-        prefix = '(%s) [%s]' % (colored(timebuf, 'bold', 'blue'), colored(domain, 'cyan'))
-        
-        msg = levels[level](' '.join(map(str, message)))
-        
-        with cls.stdout_lock:
-            print(prefix, msg)
-            sys.stdout.flush()
+        # don't even join the message unless it's going to be written
+        if level < self.log_level:
+            return
+        log.emit(level, self._log_domain(), message)
     
     # conveniences for logging
     def log_debug(self, *msg): self.log(0, *msg)
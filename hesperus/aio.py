@@ -0,0 +1,217 @@
+import asyncio
+import inspect
+import threading
+
+from . import agent as _agent
+
+class _Task(object):
+    __slots__ = ('agent', 'event', 'readers', 'future')
+
+    def __init__(self, agent):
+        self.agent = agent
+        # set by wake(), always from the loop's thread
+        self.event = None
+        # file descriptors being watched with loop.add_reader()
+        self.readers = ()
+        self.future = None
+
+class AsyncioRuntime(object):
+    """Runs agents (the core and the plugins) on a single asyncio event loop,
+    as an alternative to hesperus.scheduler.Scheduler and to giving every
+    agent its own thread.
+
+    Agents with a generator run() are driven just as they are by
+    Agent.start(): each step runs run() up to its next yield and then handles
+    the queued calls, and what it yields says how long the agent waits for a
+    wake() before the next step. The waiting is done on the loop, so poll
+    intervals become loop timers, and queued calls from other threads reach
+    the loop with call_soon_threadsafe().
+
+    run() may also be an "async def" method, which is run as a task on the
+    loop. Queued calls are handled whenever the agent is woken up.
+    The coroutine itself doesn't count as "in" the agent for the purposes of
+    @Agent.queued, so queued calls made from an async run() always go through
+    the queue.
+
+    Nothing on the loop may wait for the loop, so calls queued from it for
+    an agent whose queue is full and set to block are queued anyway, past
+    the queue's limit (see CallQueue.put()), instead of waiting for an agent
+    that could only make room once the loop gets back to it.
+
+    Agents with dedicated_thread set may block, so each of their steps is run
+    in the loop's default executor instead, unless they also set
+    loop_native. Those declare what they wait on in readers(), which the
+    loop watches for them (this is how the IRC plugin works). loop_native is
+    checked before every step, so an agent can turn it off while it has
+    something blocking to do, like connecting.
+
+    """
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self._tasks = {}
+        self._thread = None
+        self.steps = 0
+
+    def _call(self, func, *args):
+        # run func on the loop, right away if we're already on it
+        if self._thread is not None and threading.current_thread() == self._thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def add(self, agent):
+        """Starts running agent on the loop."""
+        if agent in self._tasks:
+            return
+        agent._begin()
+        agent._scheduler = self
+        task = self._tasks[agent] = _Task(agent)
+        self._call(self._spawn, task)
+
+    def _spawn(self, task):
+        task.event = asyncio.Event()
+        # anything queued before we got here
+        task.event.set()
+        if inspect.iscoroutine(task.agent._it):
+            driver = self._drive_async(task)
+        else:
+            driver = self._drive(task)
+        task.future = self.loop.create_task(driver)
+
+    def wake(self, agent):
+        """Makes sure agent gets a step soon. Called by Agent.wake()."""
+        task = self._tasks.get(agent)
+        if task is not None:
+            self._call(self._set, task)
+
+    def _set(self, task):
+        if task.event is not None:
+            task.event.set()
+
+    def _step(self, agent):
+        _agent.set_current_agent(agent)
+        try:
+            return agent._step()
+        finally:
+            _agent.set_current_agent(None)
+
+    def _watch(self, task):
+        # keep loop.add_reader() in line with what the agent waits on
+        fds = set()
+        for f in task.agent.readers():
+            fds.add(f if isinstance(f, int) else f.fileno())
+        for fd in set(task.readers) - fds:
+            self.loop.remove_reader(fd)
+        for fd in fds - set(task.readers):
+            self.loop.add_reader(fd, task.event.set)
+        task.readers = tuple(fds)
+
+    async def _sleep(self, task, seconds):
+        if seconds == 0:
+            # give everyone else a turn first
+            await asyncio.sleep(0)
+            return
+        try:
+            await asyncio.wait_for(task.event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _drive(self, task):
+        agent = task.agent
+        try:
+            while agent._running:
+                task.event.clear()
+                try:
+                    if agent.dedicated_thread and not agent.loop_native:
+                        timeout = await self.loop.run_in_executor(None, self._step, agent)
+                    else:
+                        timeout = self._step(agent)
+                except StopIteration:
+                    break
+                self.steps += 1
+                if not agent._running:
+                    break
+                self._watch(task)
+                await self._sleep(task, agent._wait_seconds(timeout))
+        except Exception as e:
+            agent._crashed(e)
+        finally:
+            self._done(task)
+
+    async def _drive_async(self, task):
+        agent = task.agent
+        runner = self.loop.create_task(agent._it)
+        try:
+            while agent._running and not runner.done():
+                task.event.clear()
+                _agent.set_current_agent(agent)
+                try:
+                    agent._handle_queue()
+                finally:
+                    _agent.set_current_agent(None)
+                self._watch(task)
+                waiter = self.loop.create_task(task.event.wait())
+                await asyncio.wait([runner, waiter], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            if not runner.done():
+                runner.cancel()
+            elif runner.exception() is not None:
+                try:
+                    runner.result()
+                except Exception as e:
+                    agent._crashed(e)
+        except Exception as e:
+            agent._crashed(e)
+        finally:
+            self._done(task)
+
+    def _done(self, task):
+        for fd in task.readers:
+            self.loop.remove_reader(fd)
+        task.readers = ()
+        del self._tasks[task.agent]
+        task.agent._finish()
+
+    def start(self):
+        """Runs the loop in a daemon thread of its own."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run_forever, name='hesperus-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run_forever(self):
+        _agent.set_loop_thread(True)
+        self.loop.run_forever()
+
+    def main(self, agent):
+        """Runs the loop in the current thread until agent is done, and
+        re-raises the error it crashed with, if any. Since nothing runs the
+        loop after that, any other agents on it are stopped first."""
+        self._thread = threading.current_thread()
+        _agent.set_loop_thread(True)
+        self.add(agent)
+        try:
+            self.loop.run_until_complete(self._tasks[agent].future)
+        finally:
+            rest = list(self._tasks.values())
+            for task in rest:
+                task.agent.stop()
+            futures = [task.future for task in rest if task.future is not None]
+            if futures:
+                self.loop.run_until_complete(asyncio.wait(futures))
+            self._thread = None
+            _agent.set_loop_thread(False)
+        if agent.error:
+            raise agent.error[0]
+
+    def stats(self):
+        """Returns a dict with the number of agents on the loop, how many of
+        them run their steps in the executor, and how many steps have been run
+        so far."""
+        tasks = list(self._tasks.values())
+        return {
+            'agents': len(tasks),
+            'in_executor': len([t for t in tasks if t.agent.dedicated_thread and not t.agent.loop_native]),
+            'steps': self.steps,
+        }
@@ -0,0 +1,149 @@
+import threading
+from collections import deque
+from queue import Empty
+
+# what to do with a call when the queue is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+class CallQueue(object):
+    """The queue of @Agent.queued calls waiting for an agent, holding
+    (func, args, kwargs) tuples.
+
+    Calls go in one of two lanes, and everything in the priority lane is
+    handed out before anything in the normal lane. Plugins use the priority
+    lane for lines directed at the bot, so commands don't wait behind a
+    backlog of chatter.
+
+    At most maxsize calls wait at once. What happens to a call made when the
+    queue is full depends on the policy:
+
+    block
+        the caller waits until there is room (like queue.Queue), unless it
+        must not wait (see put()), in which case the call is queued anyway,
+        past maxsize
+
+    drop-oldest
+        the oldest waiting call is thrown away, from the normal lane if it
+        has any
+
+    drop-newest
+        the new call is thrown away
+
+    coalesce
+        calls with the same key as one already waiting are dropped whether
+        the queue is full or not, otherwise it works like drop-oldest
+
+    The number of calls queued, dropped and coalesced are kept in the
+    attributes of the same name, and the number queued past maxsize in
+    overflowed.
+
+    """
+    def __init__(self, maxsize=1000, policy=BLOCK):
+        if not policy in POLICIES:
+            raise ValueError('unknown queue policy "%s"' % (policy,))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.mutex = threading.Lock()
+        self.not_full = threading.Condition(self.mutex)
+        self._priority = deque()
+        self._normal = deque()
+        # key -> number of waiting calls with it, for coalesce
+        self._keys = {}
+
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.prioritized = 0
+        self.high_water = 0
+        self.overflowed = 0
+
+    def qsize(self):
+        with self.mutex:
+            return len(self._priority) + len(self._normal)
+
+    def _drop_oldest(self):
+        lane = self._normal if self._normal else self._priority
+        self._forget(lane.popleft())
+        self.dropped += 1
+
+    def _forget(self, entry):
+        key = entry[1]
+        if key is not None:
+            count = self._keys[key] - 1
+            if count:
+                self._keys[key] = count
+            else:
+                del self._keys[key]
+
+    def put(self, item, priority=False, key=None, block=True):
+        """Queues item. key is only used by the coalesce policy. Returns
+        False if item was dropped instead. With block False, a full queue
+        with the block policy takes item anyway instead of waiting, for
+        callers that nobody could make room for while they wait, like an
+        event loop putting calls for agents that run on that same loop."""
+        with self.not_full:
+            if self.policy == COALESCE:
+                if key is not None and key in self._keys:
+                    self.coalesced += 1
+                    return False
+            else:
+                key = None
+
+            full = self.maxsize > 0 and len(self._priority) + len(self._normal) >= self.maxsize
+            if full:
+                if self.policy == BLOCK and not block:
+                    self.overflowed += 1
+                elif self.policy == BLOCK:
+                    while len(self._priority) + len(self._normal) >= self.maxsize:
+                        self.not_full.wait()
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                else:
+                    self._drop_oldest()
+
+            if priority:
+                self._priority.append((item, key))
+                self.prioritized += 1
+            else:
+                self._normal.append((item, key))
+            if key is not None:
+                self._keys[key] = self._keys.get(key, 0) + 1
+            self.queued += 1
+            size = len(self._priority) + len(self._normal)
+            if size > self.high_water:
+                self.high_water = size
+            return True
+
+    def get_nowait(self):
+        """Returns the next item, or raises queue.Empty."""
+        with self.not_full:
+            if self._priority:
+                entry = self._priority.popleft()
+            elif self._normal:
+                entry = self._normal.popleft()
+            else:
+                raise Empty
+            self._forget(entry)
+            self.not_full.notify()
+            return entry[0]
+
+    def stats(self):
+        """Returns a dict of the queue's size, limits and counters."""
+        with self.mutex:
+            return {
+                'size': len(self._priority) + len(self._normal),
+                'maxsize': self.maxsize,
+                'policy': self.policy,
+                'queued': self.queued,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'prioritized': self.prioritized,
+                'high_water': self.high_water,
+                'overflowed': self.overflowed,
+            }
@@ -1,8 +1,19 @@
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from .agent import Agent
 from .plugin import Plugin, ConfigurationError, ET
+from .patterns import InterestIndex
+from .message import Message
+from .scheduler import Scheduler
+from .supervisor import Supervisor, RELOAD
+from .timers import TimerWheel
+from .aio import AsyncioRuntime
+from . import executor
+from . import log
+from . import metrics
+from . import storage
 
 class Core(Agent):
     """The core is an Agent that controls the main thread. Its job is to load
@@ -13,116 +24,332 @@ class Core(Agent):
 
     Similarly for when a plugin calls our send_outgoing() method.
 
+    By default every plugin gets a thread of its own. If the scheduler attribute
+    is set to a hesperus.scheduler.Scheduler (with <config plugin-threads="N">),
+    plugins share its threads instead, except for those that set
+    dedicated_thread. With <config runtime="asyncio">, it is a
+    hesperus.aio.AsyncioRuntime, and the core runs on the event loop too.
+
+    The core also drives a hesperus.timers.TimerWheel, which tells every
+    PollPlugin when to poll, so that plugins sleep until they have something
+    to do.
+
     """
+    # plugins are run by this, if set, see launch()
+    scheduler = None
+    # how many plugins load_plugins() constructs at once
+    load_threads = 16
+    # how long start() waits for the plugins to stop (and, say, save their
+    # state) when the core stops
+    stop_timeout = 10.0
+
     @classmethod
     def load_from_file(cls, fname):
         config = ET.parse(fname).getroot()
         c = Core()
         c.configfile = fname
+
+        blocking_threads = config.get('blocking-threads', None)
+        if blocking_threads:
+            try:
+                executor.configure(int(blocking_threads))
+            except ValueError:
+                raise ConfigurationError('blocking-threads must be a number')
+
+        storage_path = config.get('storage', None)
+        if storage_path:
+            storage.configure(storage_path)
+
+        plugin_threads = config.get('plugin-threads', None)
+        if plugin_threads:
+            try:
+                c.scheduler = Scheduler(max(int(plugin_threads), 1))
+            except ValueError:
+                raise ConfigurationError('plugin-threads must be a number')
+
+        # before the plugins, so they log at the right level from the start
+        for el in config:
+            if el.tag.lower() == 'logging':
+                try:
+                    log.configure_from_element(el)
+                except (ValueError, OSError) as e:
+                    raise ConfigurationError('invalid logging config: %s' % (e,))
+
+        runtime = config.get('runtime', 'threads').lower()
+        if runtime == 'asyncio':
+            c.scheduler = AsyncioRuntime()
+        elif runtime != 'threads':
+            raise ConfigurationError('unknown runtime "%s"' % (runtime,))
         
+        elements = []
         for el in config:
             if el.tag.lower() == 'plugin':
-                p = Plugin.load_plugin(c, el)
-                c.add_plugin(p)
-            else:
-                raise ConfigurationError('unrecognized tag "%s"' % (tag,))
+                elements.append(el)
+            elif el.tag.lower() != 'logging':
+                raise ConfigurationError('unrecognized tag "%s"' % (el.tag,))
+
+        for p in c.load_plugins(elements):
+            c.add_plugin(p)
         
         return c
+
+    def load_plugins(self, elements):
+        """Loads a plugin from each config element. Plugin constructors may be
+        slow, so they are run side by side, but the plugins are returned in
+        the same order as the elements. Raises the error of the first element
+        that could not be loaded."""
+        if len(elements) <= 1:
+            return [Plugin.load_plugin(self, el) for el in elements]
+        workers = min(len(elements), self.load_threads)
+        with ThreadPoolExecutor(workers, thread_name_prefix='hesperus-load') as pool:
+            return list(pool.map(lambda el: Plugin.load_plugin(self, el), elements))
         
     def __init__(self):
         super(Core, self).__init__()
-        self._plugins = []
+        # a tuple, replaced under the lock whenever a plugin is added or
+        # removed but never modified, so it can be read without the lock
+        self._plugins = ()
+        # channel -> tuple of subscribed plugins, in plugin order, and
+        # plugin -> position in the plugin list. These are rebuilt by
+        # update_routes() and only ever replaced, never modified, so
+        # handle_incoming() and send_outgoing() can use them without the lock.
+        self._routes = {}
+        self._order = {}
+        # which lines each plugin could possibly handle, also rebuilt by
+        # update_routes()
+        self._interests = InterestIndex()
+        # plugins that override Plugin.observe(), also rebuilt by
+        # update_routes()
+        self._observers = frozenset()
+        self.supervisor = Supervisor()
+        # shared by the plugins for their polls, see PollPlugin
+        self.timers = TimerWheel(on_earlier=self.wake)
     
     def start(self):
         with self.lock:
             for plug in self._plugins:
                 if not plug.running:
-                    plug.start_threaded()
+                    self.launch(plug)
         
         try:
-            super(Core, self).start()
+            if isinstance(self.scheduler, AsyncioRuntime):
+                self.scheduler.main(self)
+            else:
+                super(Core, self).start()
         finally:
             with self.lock:
-                for plug in self._plugins:
+                plugins = self._plugins
+                for plug in plugins:
                     if plug.running:
                         plug.stop()
+            deadline = time.time() + self.stop_timeout
+            for plug in plugins:
+                plug.join(max(deadline - time.time(), 0))
     
     def run(self):
         while True:
-            toremove = []
             for plug in self.plugins:
                 # There was an error in the plugin's thread that happened asynchronously
                 if plug.error:
-                    # print out error, and quit
-                    self.log_error("error in", plug)
-                    self.send_outgoing("default", "One of my plugins, %s, has crashed. Someone call for help plz!"
-                            % (plug.__class__.__name__,))
-                    with self.__class__.stdout_lock:
-                        print(plug.error[1], end=' ')
-                    # Can't remove the plugin while we're iterating over the list
-                    toremove.append(plug)
-                
-            for r in toremove:
-                self.remove_plugin(r)
-            yield
-    
+                    self.plugin_crashed(plug)
+
+            for plug, mode, index in self.supervisor.due():
+                self.restart_plugin(plug, mode, index)
+
+            self.timers.advance()
+
+            # crashing plugins wake us up, see Plugin._finish(), and so do
+            # timers scheduled before we would otherwise be back
+            delays = [d for d in (self.supervisor.next_delay(), self.timers.next_delay()) if d is not None]
+            yield min(delays) if delays else self.forever
+
+    def plugin_crashed(self, plug):
+        """Take a crashed plugin out of the plugin list, and let the
+        supervisor decide when to bring it back."""
+        if plug.error:
+            self.log_error("error in", plug, "\n" + plug.error[1].rstrip())
+        else:
+            self.log_error("error in", plug)
+        with self.lock:
+            if not plug in self._plugins:
+                return
+            index = self._plugins.index(plug)
+            self.remove_plugin(plug, crashed=True)
+            delay = self.supervisor.crashed(plug, index)
+        name = plug.__class__.__name__
+        if delay is None:
+            self.send_outgoing("default", "One of my plugins, %s, has crashed. Someone call for help plz!"
+                    % (name,))
+        else:
+            self.send_outgoing("default", "One of my plugins, %s, has crashed. I'll restart it in %d seconds."
+                    % (name, max(delay, 1)))
+
+    def restart_plugin(self, plug, mode, index):
+        """Bring back a crashed plugin, either by starting the same instance
+        again (mode "thread") or by loading a new one from its config element
+        (mode "reload"), at the same place in the plugin list."""
+        if plug.alive:
+            # still winding down, give it a moment
+            plug.stop()
+            self.supervisor.postpone(plug, 0.5)
+            return
+
+        name = plug.__class__.__name__
+        new = plug
+        if mode == RELOAD:
+            # the new instance takes over the name its metrics are under
+            metrics.registry.forget(plug)
+            try:
+                new = Plugin.load_plugin(self, plug.config_element)
+            except Exception as e:
+                traceback.print_exc()
+                self.log_error("could not reload %s: %s" % (name, e))
+                self.supervisor.restarted(plug, plug)
+                self.supervisor.crashed(plug, index)
+                return
+
+        with self.lock:
+            if not self.supervisor.waiting(plug):
+                # removed with remove_plugin() in the meantime
+                if new is not plug:
+                    new.stop()
+                return
+            self.log_message("restarting %s" % (name,))
+            self.supervisor.restarted(plug, new)
+            self.add_plugin(new, index)
+
     #
     # plugin management
     #
     
     @property
     def plugins(self):
-        with self.lock:
-            return self._plugins
+        """A snapshot of the plugin list, as a tuple."""
+        return self._plugins
     
-    def add_plugin(self, plug):
+    def update_routes(self, plug=None):
+        """Rebuild the channel index used to route messages. Called whenever
+        the plugin list changes, and by plugins whose channels change."""
+        with self.lock:
+            if plug is not None and not plug in self._plugins:
+                return
+            routes = {}
+            order = {}
+            for i, p in enumerate(self._plugins):
+                order[p] = i
+                for chan in p.channels:
+                    routes.setdefault(chan, []).append(p)
+            self._routes = dict((chan, tuple(plugs)) for chan, plugs in routes.items())
+            self._order = order
+            self._interests = InterestIndex((p, p.interests()) for p in self._plugins)
+            self._observers = frozenset(p for p in self._plugins if type(p).observe is not Plugin.observe)
+
+    def routes_for(self, chans):
+        """Returns the plugins subscribed to any of the given channels, in
+        plugin order."""
+        routes = self._routes
+        if len(chans) == 1:
+            for chan in chans:
+                return routes.get(chan, ())
+        found = set()
+        for chan in chans:
+            found.update(routes.get(chan, ()))
+        order = self._order
+        return sorted(found, key=lambda p: order.get(p, 0))
+
+    def launch(self, plug):
+        """Start a plugin, on the scheduler if there is one, then warm it up
+        in the background (see Plugin.warm_up()). Plugins with
+        dedicated_thread set get a thread of their own, except on an
+        AsyncioRuntime, which runs their steps in its executor (or on the
+        loop, for loop_native ones) instead."""
+        if isinstance(self.scheduler, AsyncioRuntime):
+            plug.start_scheduled(self.scheduler)
+        elif self.scheduler is not None and not plug.dedicated_thread:
+            plug.start_scheduled(self.scheduler)
+        else:
+            plug.start_threaded()
+        plug.start_warm_up()
+
+    def add_plugin(self, plug, index=None):
         with self.lock:
             if not plug in self._plugins:
-                self._plugins.append(plug)
+                plugins = list(self._plugins)
+                if index is None:
+                    plugins.append(plug)
+                else:
+                    plugins.insert(index, plug)
+                self._plugins = tuple(plugins)
+                self.update_routes()
                 if self.running and not plug.running:
-                    plug.start_threaded()
+                    self.launch(plug)
     
-    def remove_plugin(self, plug, wait=False):
+    def remove_plugin(self, plug, wait=False, crashed=False):
+        """Takes a plugin out of the plugin list and stops it. Unless it is
+        being taken out because it crashed, any restart the supervisor has
+        planned for it is called off too."""
         with self.lock:
-            if plug in self._plugins:
-                self._plugins.remove(plug)
-                if plug.running:
-                    plug.stop()
-                    if wait:
-                        while plug.thread is not None:
-                            time.sleep(0.1)
+            if not crashed:
+                self.supervisor.forget(plug)
+                metrics.registry.forget(plug)
+            # anything it still had waiting on the executor is moot
+            executor.shared().forget(plug)
+            if not plug in self._plugins:
+                return
+            self._plugins = tuple(p for p in self._plugins if p is not plug)
+            self.update_routes()
+            if plug.running:
+                plug.stop()
+        # wait without the lock, so the plugin can still reach us on its way out
+        if wait:
+            plug.join()
     
     def remove_all_plugins(self, wait=False):
         with self.lock:
-            plugins_copy = list(self._plugins)
-            while len(self._plugins) > 0:
-                self.remove_plugin(self._plugins[0])
-            if wait:
-                while not all([plugin.thread is None for plugin in plugins_copy]):
-                    time.sleep(0.1)
-                
+            plugins = self._plugins
+            for plugin in plugins:
+                self.remove_plugin(plugin)
+        if wait:
+            for plugin in plugins:
+                plugin.join()
     
-    @Agent.queued
     def handle_incoming(self, chans, name, msg, direct, reply):
-        toremove = []
-        for plug in self.plugins:
-            relevant_chans = set(plug.channels).intersection(set(chans))
-            if len(relevant_chans) > 0:
-                try:
-                    plug.handle_incoming(chans, name, msg, direct, reply)
-                except Exception:
-                    # An exception occurred in the main thread while calling
-                    # into the plugin's handle_incomming method
-                    traceback.print_exc()
-                    reply("Oh dear, there was a problem in the %s plugin. I'm shutting it down." %
-                            (plug.__class__.__name__,))
-                    # Can't remove the plugin while we're iterating over the list
-                    toremove.append(plug)
-        for r in toremove:
-            self.remove_plugin(r)
+        """Relays a line to the plugins, the old way. Connectors should make
+        a hesperus.message.Message and call handle_message() instead."""
+        self.handle_message(Message(chans, name, msg, direct, reply))
+
+    @Agent.queued
+    def handle_message(self, message):
+        """Relays a Message to every plugin it is routed to. They all get the
+        same Message object."""
+        crashed = []
+        interests = self._interests
+        observers = self._observers
+        wanted = None
+        for plug in self.routes_for(message.channels):
+            try:
+                if plug in observers:
+                    plug.observe(message)
+                if plug in interests.constrained:
+                    if wanted is None:
+                        wanted = interests.matching(message.text, message.direct)
+                    if not plug in wanted:
+                        continue
+                start = time.perf_counter()
+                plug.handle_message(message)
+                plug.metrics.dispatch.observe(time.perf_counter() - start)
+            except Exception as e:
+                # An exception occurred in the main thread while calling
+                # into the plugin's handle_incomming method
+                message.reply("Oh dear, there was a problem in the %s plugin." %
+                        (plug.__class__.__name__,))
+                plug._crashed(e)
+                # Can't remove the plugin while we're iterating over the list
+                crashed.append(plug)
+        for plug in crashed:
+            self.plugin_crashed(plug)
     
     @Agent.queued
     def send_outgoing(self, chan, msg):
-        for plug in self.plugins:
-            if chan in plug.channels:
-                plug.send_outgoing(chan, msg)
+        for plug in self._routes.get(chan, ()):
+            plug.send_outgoing(chan, msg)
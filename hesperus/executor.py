@@ -0,0 +1,234 @@
+import heapq
+import threading
+import time
+import traceback
+from collections import deque
+from queue import Queue
+
+from .agent import working_for
+
+class _Job(object):
+    __slots__ = ('owner', 'requester', 'func', 'timeout', 'on_timeout',
+            'deadline', 'finished', 'timed_out', 'queued_at')
+
+    def __init__(self, owner, requester, func, timeout, on_timeout):
+        self.owner = owner
+        self.requester = requester
+        self.func = func
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.deadline = None
+        self.finished = False
+        self.timed_out = False
+        self.queued_at = time.time()
+
+    # for the timeout heap
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class _Owner(object):
+    """Book-keeping for the jobs of one plugin."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        # requester -> deque of jobs waiting behind the one running
+        self.lanes = {}
+        # requesters with nothing running and a job ready to go, in order
+        self.ready = deque()
+        self.busy = set()
+        self.completed = 0
+        self.timeouts = 0
+        # set by forget() while jobs are still running
+        self.forgotten = False
+
+    @property
+    def pending(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+class BlockingExecutor(object):
+    """Runs blocking work (usually command handlers registered with
+    blocking=True) on a bounded pool of daemon threads shared by all plugins,
+    so that one slow network request doesn't hold up everything else the
+    plugin does.
+
+    Jobs belong to an owner (the plugin) and a requester (usually the nick that
+    issued the command). At most limit jobs of one owner run at once, and the
+    jobs of one requester run one after the other, so their replies come out in
+    the order the commands were given. The limit is the owner's blocking_limit
+    attribute (1 if it has none), read the first time it submits a job.
+
+    A job that runs past its timeout can't be stopped, but it stops counting
+    against its owner and requester: its on_timeout callback is called, and the
+    next job in line is started.
+
+    """
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.lock = threading.RLock()
+        self._work = Queue()
+        self._threads = []
+        self._owners = {}
+        self._busy = 0
+        self._deadlines = []
+        self._watchdog = None
+        self._watchdog_wakeup = threading.Event()
+
+    def _start_threads(self):
+        # called with the lock held
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name='hesperus-blocking-%d' % (len(self._threads),))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name='hesperus-blocking-watchdog')
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def submit(self, owner, requester, func, timeout=None, on_timeout=None):
+        """Queues func() to be run in the pool. If the job takes longer than
+        timeout seconds, on_timeout() is called."""
+        job = _Job(owner, requester, func, timeout, on_timeout)
+        with self.lock:
+            self._start_threads()
+            state = self._owners.get(owner)
+            if state is None:
+                state = self._owners[owner] = _Owner(max(getattr(owner, 'blocking_limit', 1), 1))
+            state.forgotten = False
+            state.lanes.setdefault(requester, deque()).append(job)
+            if not requester in state.busy and not requester in state.ready:
+                state.ready.append(requester)
+            self._pump(state)
+        return job
+
+    def _pump(self, state):
+        # called with the lock held: start whatever this owner may start
+        while state.running < state.limit and state.ready:
+            requester = state.ready.popleft()
+            lane = state.lanes.get(requester)
+            if not lane:
+                continue
+            job = lane.popleft()
+            if not lane:
+                del state.lanes[requester]
+            state.running += 1
+            state.busy.add(requester)
+            if job.timeout is not None:
+                job.deadline = time.time() + job.timeout
+                heapq.heappush(self._deadlines, job)
+                self._watchdog_wakeup.set()
+            self._work.put(job)
+
+    def _release(self, job):
+        # called with the lock held, once per job: lets the next one go
+        state = self._owners[job.owner]
+        state.running -= 1
+        state.busy.discard(job.requester)
+        if job.requester in state.lanes:
+            state.ready.append(job.requester)
+        self._pump(state)
+        if state.forgotten and not state.running:
+            del self._owners[job.owner]
+
+    def forget(self, owner):
+        """Drops the jobs owner has waiting, and stops keeping track of it
+        once the ones running are done, for example once it is unloaded."""
+        with self.lock:
+            state = self._owners.get(owner)
+            if state is None:
+                return
+            state.lanes.clear()
+            state.ready.clear()
+            if state.running:
+                state.forgotten = True
+            else:
+                del self._owners[owner]
+
+    def _worker(self):
+        while True:
+            job = self._work.get()
+            with self.lock:
+                self._busy += 1
+            working_for(job.owner)
+            try:
+                job.func()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                working_for(None)
+                with self.lock:
+                    self._busy -= 1
+                    job.finished = True
+                    if not job.timed_out:
+                        self._owners[job.owner].completed += 1
+                        self._release(job)
+
+    def _watch(self):
+        while True:
+            with self.lock:
+                timeout = None
+                now = time.time()
+                expired = []
+                while self._deadlines:
+                    job = self._deadlines[0]
+                    if job.finished:
+                        heapq.heappop(self._deadlines)
+                    elif job.deadline <= now:
+                        heapq.heappop(self._deadlines)
+                        job.timed_out = True
+                        self._owners[job.owner].timeouts += 1
+                        self._release(job)
+                        expired.append(job)
+                    else:
+                        timeout = job.deadline - now
+                        break
+                self._watchdog_wakeup.clear()
+            for job in expired:
+                if job.on_timeout is not None:
+                    try:
+                        job.on_timeout()
+                    except Exception:
+                        traceback.print_exc()
+            self._watchdog_wakeup.wait(timeout)
+
+    def stats(self):
+        """Returns a dict describing how busy the pool is: the number of
+        workers, how many are busy, the utilization (busy / workers), the
+        number of jobs waiting, and per-owner counts."""
+        with self.lock:
+            owners = {}
+            for owner, state in self._owners.items():
+                owners[owner] = {
+                    'running': state.running,
+                    'pending': state.pending,
+                    'limit': state.limit,
+                    'completed': state.completed,
+                    'timeouts': state.timeouts,
+                }
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'utilization': float(self._busy) / self.workers if self.workers else 0.0,
+                'queued': self._work.qsize() + sum(o['pending'] for o in owners.values()),
+                'owners': owners,
+            }
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    """Returns the executor shared by all plugins, creating it if needed."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = BlockingExecutor()
+        return _shared
+
+def configure(workers):
+    """Sets the number of threads in the shared executor. Only adds threads if
+    it is already running."""
+    executor = shared()
+    with executor.lock:
+        executor.workers = max(workers, 1)
+        if executor._threads:
+            executor._start_threads()
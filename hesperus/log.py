@@ -0,0 +1,250 @@
+"""The logging pipeline behind Agent.log().
+
+Agent.log() checks the agent's level first, so nothing is formatted for
+messages that are filtered out. The rest are joined into a line in the
+calling thread and put on a queue, and a background writer thread takes them
+off in batches, formats them for each output, and writes and flushes each
+output once per batch. A slow terminal never blocks a plugin: if the queue
+fills up, new messages are dropped and counted instead.
+
+Outputs are configured with configure(), or with a <logging> element in the
+config file:
+
+    <logging level="verbose" stdout="text" file="hesperus.log"
+             file-format="json" max-bytes="10485760" backups="5" />
+
+stdout is "text" (colored, as always), "json" or "off". file-format is
+"text" or "json", for JSON lines. The file is rotated to hesperus.log.1 and
+so on once it reaches max-bytes. Levels can also be set per plugin, with
+<plugin log-level="debug">.
+
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from .ansi import colored
+
+DEBUG = 0
+VERBOSE = 1
+MESSAGE = 2
+WARNING = 3
+ERROR = 4
+
+LEVEL_NAMES = ['debug', 'verbose', 'message', 'warning', 'error']
+
+def parse_level(name):
+    """Turns a level name (or number) into a level, or raises ValueError."""
+    name = str(name).strip().lower()
+    if name in LEVEL_NAMES:
+        return LEVEL_NAMES.index(name)
+    level = int(name)
+    if not 0 <= level < len(LEVEL_NAMES):
+        raise ValueError('no such log level: %s' % (name,))
+    return level
+
+# the level for agents that don't have their own
+default_level = VERBOSE
+
+# held while writing to stdout, by the writer and anyone else printing there
+stdout_lock = threading.RLock()
+
+_COLORS = [
+    lambda s: colored('debug: ' + s, 'bold', 'black'),
+    lambda s: colored(s, 'white'),
+    lambda s: colored(s, 'bold', 'white'),
+    lambda s: colored('warning', 'bold', 'yellow') + ': ' + colored(s, 'yellow'),
+    lambda s: colored('error', 'bold', 'red') + ': ' + colored(s, 'red'),
+]
+
+def format_text(record, color=True):
+    created, level, domain, message = record
+    timebuf = time.strftime("%x %X", time.localtime(created))
+    if not color:
+        return '(%s) [%s] %s%s' % (timebuf, domain,
+                '' if level in (VERBOSE, MESSAGE) else LEVEL_NAMES[level] + ': ', message)
+    prefix = '(%s) [%s]' % (colored(timebuf, 'bold', 'blue'), colored(domain, 'cyan'))
+    return prefix + ' ' + _COLORS[level](message)
+
+def format_json(record):
+    created, level, domain, message = record
+    return json.dumps({
+        'time': created,
+        'level': LEVEL_NAMES[level],
+        'source': domain,
+        'message': message,
+    })
+
+class StreamOutput(object):
+    """Writes to a stream, by default stdout."""
+    def __init__(self, stream=None, fmt='text', color=True):
+        self.stream = stream
+        self.fmt = fmt
+        self.color = color
+
+    def write(self, records):
+        if self.fmt == 'json':
+            lines = [format_json(r) for r in records]
+        else:
+            lines = [format_text(r, self.color) for r in records]
+        stream = self.stream or sys.stdout
+        with stdout_lock:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    def close(self):
+        pass
+
+class RotatingFileOutput(object):
+    """Appends to a file, which is moved to fname.1 (and fname.1 to fname.2,
+    and so on, keeping backups of them) once it grows past max_bytes."""
+    def __init__(self, fname, fmt='text', max_bytes=10 * 1024 * 1024, backups=5):
+        self.fname = fname
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = open(fname, 'a')
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.fname, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.fname, i + 1))
+        if self.backups > 0:
+            os.replace(self.fname, self.fname + '.1')
+        else:
+            os.remove(self.fname)
+        self.f = open(self.fname, 'a')
+
+    def write(self, records):
+        if self.fmt == 'json':
+            lines = [format_json(r) for r in records]
+        else:
+            lines = [format_text(r, False) for r in records]
+        data = '\n'.join(lines) + '\n'
+        if self.max_bytes and self.f.tell() + len(data) > self.max_bytes and self.f.tell() > 0:
+            self.rotate()
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class Writer(object):
+    """Takes records off the queue and writes them to the outputs, in a
+    daemon thread."""
+    def __init__(self, outputs=None, maxsize=10000):
+        self.outputs = outputs if outputs is not None else [StreamOutput()]
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.records = deque()
+        self.dropped = 0
+        self.written = 0
+        self._busy = False
+        self._thread = None
+
+    def put(self, record):
+        with self.lock:
+            if len(self.records) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.records.append(record)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='hesperus-log')
+                self._thread.daemon = True
+                self._thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.records:
+                    self._busy = False
+                    self.cond.notify_all()
+                    self.cond.wait()
+                self._busy = True
+                batch = list(self.records)
+                self.records.clear()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append((time.time(), WARNING, 'log', '%d log messages were dropped' % (dropped,)))
+            for output in list(self.outputs):
+                try:
+                    output.write(batch)
+                except Exception as e:
+                    sys.stderr.write('could not write log: %s\n' % (e,))
+            self.written += len(batch)
+
+    def flush(self, timeout=5.0):
+        """Waits until everything queued so far has been written."""
+        deadline = time.time() + timeout
+        with self.lock:
+            while (self.records or self._busy) and self._thread is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+_writer = Writer()
+atexit.register(_writer.flush)
+
+def emit(level, domain, message):
+    """Queues an already filtered message (a tuple of things to join with
+    spaces) to be written."""
+    _writer.put((time.time(), level, domain, ' '.join(map(str, message))))
+
+def flush(timeout=5.0):
+    _writer.flush(timeout)
+
+def configure(level=None, stdout='text', color=True, fname=None, file_format='text',
+        max_bytes=10 * 1024 * 1024, backups=5):
+    """Sets the default level and replaces the outputs."""
+    global default_level
+    if level is not None:
+        default_level = level
+    outputs = []
+    if stdout != 'off':
+        outputs.append(StreamOutput(fmt=stdout, color=color))
+    if fname:
+        outputs.append(RotatingFileOutput(fname, file_format, max_bytes, backups))
+    _writer.flush()
+    old, _writer.outputs = _writer.outputs, outputs
+    for output in old:
+        output.close()
+
+def configure_from_element(el):
+    """Configures logging from a <logging> config element. Raises ValueError
+    for bad values."""
+    stdout = el.get('stdout', 'text').lower()
+    if not stdout in ('text', 'json', 'off'):
+        raise ValueError('stdout must be text, json or off')
+    file_format = el.get('file-format', 'text').lower()
+    if not file_format in ('text', 'json'):
+        raise ValueError('file-format must be text or json')
+    level = el.get('level', None)
+    configure(
+        level=parse_level(level) if level is not None else None,
+        stdout=stdout,
+        color=el.get('color', 'true').lower() in ('true', '1'),
+        fname=el.get('file', None),
+        file_format=file_format,
+        max_bytes=int(el.get('max-bytes', 10 * 1024 * 1024)),
+        backups=int(el.get('backups', 5)),
+    )
+
+def stats():
+    """Returns a dict with the number of messages waiting, written and
+    dropped since the last batch."""
+    with _writer.lock:
+        return {
+            'queued': len(_writer.records),
+            'written': _writer.written,
+            'dropped': _writer.dropped,
+        }
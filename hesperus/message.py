@@ -0,0 +1,157 @@
+import itertools
+import time
+
+class Command(object):
+    """A line of chat parsed as a command, as done once by the command
+    frontend (hesperus.plugins.command.CommandPlugin) before it is passed on.
+
+    verb
+        the first word of the command
+
+    args
+        everything after the first word, with surrounding whitespace removed
+
+    text
+        the whole command, without any name or command character in front
+
+    addressee
+        for inline commands redirected at someone else (as in
+        "agrif, (!bookmark)"), the nick the reply is meant for, otherwise None
+
+    inline
+        True if the command was found in the middle of a line, in parentheses
+        or brackets, rather than being the whole line
+
+    """
+    __slots__ = ('verb', 'args', 'text', 'addressee', 'inline')
+
+    def __init__(self, text, addressee=None, inline=False):
+        parts = text.split(None, 1)
+        self.verb = parts[0] if parts else ''
+        self.args = parts[1].strip() if len(parts) > 1 else ''
+        self.text = text
+        self.addressee = addressee
+        self.inline = inline
+
+    def __repr__(self):
+        return '<Command %r %r%s%s>' % (self.verb, self.args,
+                ' for %s' % (self.addressee,) if self.addressee else '',
+                ' inline' if self.inline else '')
+
+class CommandText(str):
+    """The text of a parsed command, which carries the parsed Command along as
+    its command attribute. Anything expecting a plain message string can use
+    it as one, while CommandPlugin uses the command to dispatch on the verb.
+
+    """
+    def __new__(cls, command):
+        self = super(CommandText, cls).__new__(cls, command.text)
+        self.command = command
+        return self
+
+# for trace ids, unique within a run
+_trace_ids = itertools.count(1)
+
+# Message.command before it is worked out
+_UNPARSED = object()
+
+class Message(object):
+    """A line of chat on its way through the core. Connectors make one for
+    each line that comes in and hand it to Core.handle_message(), and the
+    same object is then passed to every plugin it is routed to. Plugins that
+    pass a line on (like the command frontend, or a bridge) make a new one
+    with derive(), which keeps the timestamp and trace id of the original.
+
+    channels
+        the channels the line came in on, as a frozenset
+
+    nick
+        who said it (or None, if the source doesn't have names)
+
+    text
+        the text itself
+
+    direct
+        True if the line was directed at us
+
+    reply
+        a function that takes a string and replies to the line
+
+    timestamp
+        when the line came in, from time.time()
+
+    trace_id
+        a number identifying the line, and anything derived from it
+
+    lower
+        the text in lower case, worked out the first time it is asked for
+
+    command
+        the line parsed as a Command, or None if it isn't one. Lines from
+        the command frontend carry the Command it parsed, and other direct
+        lines are parsed the first time this is asked for. Pass
+        command=False to say the line is not to be treated as a command.
+
+    Plugins that only implement the older handle_incoming(chans, name, msg,
+    direct, reply) get the fields of the message as arguments, see
+    hesperus.plugin.Plugin.handle_message().
+
+    """
+    __slots__ = ('channels', 'nick', 'text', 'direct', 'reply', 'timestamp', 'trace_id',
+            '_lower', '_command')
+
+    def __init__(self, channels, nick, text, direct, reply, timestamp=None, trace_id=None, command=None):
+        if not isinstance(channels, frozenset):
+            channels = frozenset(channels)
+        self.channels = channels
+        self.nick = nick
+        self.text = text
+        self.direct = direct
+        self.reply = reply
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.trace_id = next(_trace_ids) if trace_id is None else trace_id
+        self._lower = None
+        if command is None:
+            command = getattr(text, 'command', _UNPARSED)
+        self._command = command or None
+
+    @property
+    def lower(self):
+        if self._lower is None:
+            self._lower = self.text.lower()
+        return self._lower
+
+    @property
+    def command(self):
+        command = self._command
+        if command is _UNPARSED:
+            command = Command(self.text) if self.direct else None
+            self._command = command
+        return command
+
+    def derive(self, **changes):
+        """Returns a copy of this message with the given fields changed, for
+        passing a line on. The timestamp and trace id stay the same."""
+        fields = {
+            'channels': self.channels,
+            'nick': self.nick,
+            'text': self.text,
+            'direct': self.direct,
+            'reply': self.reply,
+            'timestamp': self.timestamp,
+            'trace_id': self.trace_id,
+        }
+        # the command only still applies if the text didn't change
+        if not 'text' in changes:
+            fields['command'] = self._command if self._command is not None else False
+        fields.update(changes)
+        return Message(**fields)
+
+    def args(self):
+        """Returns (chans, name, msg, direct, reply), as passed to
+        handle_incoming()."""
+        return (self.channels, self.nick, self.text, self.direct, self.reply)
+
+    def __repr__(self):
+        return '<Message #%d from %s in %s%s: %r>' % (self.trace_id, self.nick,
+                ','.join(sorted(self.channels)), ' direct' if self.direct else '', self.text)
@@ -0,0 +1,228 @@
+"""Cheap always-on metrics for the core and plugins.
+
+Every agent gets an AgentMetrics of its own (see for_agent()) holding a few
+histograms and counters, which the core, the agent main loop and PollPlugin
+fill in:
+
+dispatch_seconds
+    time the core spends in the plugin's handle_incoming(), which for plugins
+    that don't queue their input is the whole time spent handling a line
+
+call_seconds
+    time spent running each queued call in the agent's own thread
+
+queue_wait_seconds
+    time queued calls waited before being run
+
+poll_seconds
+    time spent in PollPlugin.poll(), not counting time it yielded
+
+replies, exceptions
+    counts of reply() calls made by the plugin and of exceptions it raised
+
+persist_writes, persist_bytes
+    how many times a PersistentPlugin wrote its state out, and how much
+
+Metrics are listed under the agent's class name, or "Name-2" and so on for
+a second instance alive at the same time. A plugin that is removed (or
+reloaded) is forgotten, see Registry.forget(), so a reloaded plugin starts
+over from zero under the same name.
+
+The queue depth is read from the agent's queue when the metrics are looked
+at. Histograms are a fixed array of counts over fixed bucket bounds, so
+recording a value is a binary search and an increment, under an uncontended
+lock of the histogram's own. Counters are not locked, and concurrent updates
+from different threads may very rarely lose a count, which is fine for what
+these are for.
+
+"""
+
+import bisect
+import threading
+import time
+import weakref
+from array import array
+
+# bucket upper bounds in seconds: 10us to 100s, in steps of ~1.8x
+DEFAULT_BOUNDS = tuple(round(1e-5 * 10 ** (i / 4.0), 7) for i in range(29))
+
+class Histogram(object):
+    """Counts of observed values falling in each of a fixed set of buckets,
+    plus their count and sum."""
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'lock')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        # one more for anything larger than the last bound
+        self.counts = array('L', [0] * (len(bounds) + 1))
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Returns (counts, count, sum), all read at the same time."""
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q):
+        """Returns an upper bound on the q-quantile (0 to 1) of the values
+        observed, or None if there are none."""
+        counts, count, _ = self.snapshot()
+        if not count:
+            return None
+        wanted = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= wanted and n:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def mean(self):
+        _, count, total = self.snapshot()
+        return total / count if count else None
+
+class AgentMetrics(object):
+    """The metrics kept for one agent."""
+    __slots__ = ('name', 'dispatch', 'call', 'queue_wait', 'poll', 'replies',
+            'exceptions', 'persist_writes', 'persist_bytes')
+
+    histograms = ('dispatch', 'call', 'queue_wait', 'poll')
+
+    def __init__(self, name):
+        self.name = name
+        self.dispatch = Histogram()
+        self.call = Histogram()
+        self.queue_wait = Histogram()
+        self.poll = Histogram()
+        self.replies = 0
+        self.exceptions = 0
+        # written by PersistentPlugins
+        self.persist_writes = 0
+        self.persist_bytes = 0
+
+    def counting_reply(self, reply):
+        """Wraps reply() so that calls to it are counted."""
+        def counted(msg):
+            self.replies += 1
+            reply(msg)
+        return counted
+
+class Registry(object):
+    """Holds the AgentMetrics of every agent, by name."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+        # name -> the agent with that name, for queue depths, and back
+        self._agents = weakref.WeakValueDictionary()
+        self._names = weakref.WeakKeyDictionary()
+        # (name, metrics) of agents that are gone, see _purge()
+        self._dead = []
+        self.started = time.time()
+
+    def for_agent(self, agent):
+        base = agent.__class__.__name__
+        with self.lock:
+            self._purge()
+            name = base
+            n = 1
+            while name in self._metrics:
+                n += 1
+                name = '%s-%d' % (base, n)
+            metrics = self._metrics[name] = AgentMetrics(name)
+            self._agents[name] = agent
+            self._names[agent] = name
+        # agents that are never forgotten are dropped once they're gone
+        weakref.finalize(agent, self._dead.append, (name, metrics))
+        return metrics
+
+    def forget(self, agent):
+        """Stops listing agent's metrics, for example once it is unloaded,
+        so its name is free for the next one."""
+        with self.lock:
+            name = self._names.pop(agent, None)
+            if name is not None:
+                self._metrics.pop(name, None)
+                self._agents.pop(name, None)
+
+    def _purge(self):
+        # called with the lock held: drops the metrics of agents that have
+        # been garbage collected, which can happen at any time, so the
+        # finalizers only leave them in _dead
+        while self._dead:
+            name, metrics = self._dead.pop()
+            # unless it was forgotten, and the name given to another
+            if self._metrics.get(name) is metrics:
+                del self._metrics[name]
+
+    def names(self):
+        with self.lock:
+            self._purge()
+            return sorted(self._metrics)
+
+    def get(self, name):
+        with self.lock:
+            return self._metrics.get(name)
+
+    def queue_depth(self, name):
+        agent = self._agents.get(name)
+        if agent is None:
+            return None
+        return agent.queue.qsize()
+
+    def prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        names = self.names()
+
+        for attr in AgentMetrics.histograms:
+            metric = 'hesperus_%s_seconds' % (attr,)
+            lines.append('# TYPE %s histogram' % (metric,))
+            for name in names:
+                m = self.get(name)
+                if m is None:
+                    continue
+                hist = getattr(m, attr)
+                # one consistent read, so the buckets add up to the count
+                counts, count, total = hist.snapshot()
+                if not count:
+                    continue
+                cumulative = 0
+                for bound, n in zip(hist.bounds, counts):
+                    cumulative += n
+                    lines.append('%s_bucket{plugin="%s",le="%g"} %d' % (metric, name, bound, cumulative))
+                lines.append('%s_bucket{plugin="%s",le="+Inf"} %d' % (metric, name, count))
+                lines.append('%s_sum{plugin="%s"} %f' % (metric, name, total))
+                lines.append('%s_count{plugin="%s"} %d' % (metric, name, count))
+
+        for attr in ('replies', 'exceptions', 'persist_writes', 'persist_bytes'):
+            metric = 'hesperus_%s_total' % (attr,)
+            lines.append('# TYPE %s counter' % (metric,))
+            for name in names:
+                m = self.get(name)
+                if m is not None:
+                    lines.append('%s{plugin="%s"} %d' % (metric, name, getattr(m, attr)))
+
+        lines.append('# TYPE hesperus_queue_depth gauge')
+        for name in names:
+            depth = self.queue_depth(name)
+            if depth is not None:
+                lines.append('hesperus_queue_depth{plugin="%s"} %d' % (name, depth))
+
+        lines.append('# TYPE hesperus_uptime_seconds gauge')
+        lines.append('hesperus_uptime_seconds %f' % (time.time() - self.started,))
+        return '\n'.join(lines) + '\n'
+
+# the registry everything records into
+registry = Registry()
+
+def for_agent(agent):
+    """Returns the AgentMetrics to record agent's metrics into."""
+    return registry.for_agent(agent)
@@ -0,0 +1,449 @@
+"""Cheap facts about regular expressions, used to avoid running them.
+
+CommandPlugin handlers are regular expressions matched against the start of a
+line. Most of them begin with some literal text (the command name), so a line
+that does not start with any of those literals can never match. This module
+works out those literals from the parsed expression, and provides the Interest
+and InterestIndex classes the core uses to skip plugins that could not possibly
+handle a line.
+
+PassivePlugin patterns are searched for anywhere in the line instead, so for
+those the literals that must appear somewhere in a match are used, by
+MultiPattern.
+
+"""
+
+import re
+import threading
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# give up enumerating literals past this many alternatives
+MAX_ALTERNATIVES = 64
+# and only look at character classes up to this size
+MAX_CLASS = 8
+
+# marks a literal that is followed by whitespace or the end of the line
+_WORD_END = '\0'
+
+def _class_literals(av):
+    """The characters matched by a [...] class, if it is a small list of
+    plain characters, otherwise None."""
+    chars = []
+    for op, val in av:
+        if op is not sre_parse.LITERAL:
+            return None
+        chars.append(chr(val))
+    if len(chars) > MAX_CLASS:
+        return None
+    return chars
+
+def _is_space(op, av):
+    if op is sre_parse.IN:
+        return av == [(sre_parse.CATEGORY, sre_parse.CATEGORY_SPACE)]
+    return False
+
+def _expand_item(op, av):
+    """Returns (open, closed) for a single parsed item, see _expand."""
+    if op is sre_parse.LITERAL:
+        return set([chr(av)]), set()
+    if op is sre_parse.IN:
+        if _is_space(op, av):
+            return set(), set([_WORD_END])
+        chars = _class_literals(av)
+        if chars is None:
+            return set(), set([''])
+        return set(chars), set()
+    if op is sre_parse.AT:
+        if av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            return set(['']), set()
+        if av in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+            return set(), set([_WORD_END])
+        return set(), set([''])
+    if op is sre_parse.SUBPATTERN:
+        group, add_flags, del_flags, sub = av
+        if add_flags or del_flags:
+            # scoped flags (like (?i:...)) change what the literals mean
+            return set(), set([''])
+        return _expand(sub)
+    if op is sre_parse.BRANCH:
+        opened, closed = set(), set()
+        for branch in av[1]:
+            o, c = _expand(branch)
+            opened.update(o)
+            closed.update(c)
+        return opened, closed
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        lo, hi, sub = av
+        if lo == 1 and hi == 1:
+            return _expand(sub)
+        if lo == 0 and hi == 1:
+            o, c = _expand(sub)
+            o.add('')
+            return o, c
+        if lo >= 1 and len(sub) == 1 and _is_space(*sub[0]):
+            return set(), set([_WORD_END])
+        o, c = _expand(sub)
+        if lo == 0:
+            c.add('')
+        return set(), o | c
+    # anything else: we can't say anything more about what comes next
+    return set(), set([''])
+
+def _expand(items):
+    """Enumerates the literal text at the start of a parsed expression.
+
+    Returns (open, closed): open holds literals for which all of items matched
+    literally, so whatever follows items may extend them; closed holds literals
+    that could not be extended any further. Every match starts with one of
+    these (minus any _WORD_END marker). An empty string in closed means there
+    is no literal constraint at all.
+
+    """
+    opened = set([''])
+    closed = set()
+    for op, av in items:
+        o, c = _expand_item(op, av)
+        closed.update(p + x for p in opened for x in c)
+        opened = set(p + x for p in opened for x in o)
+        if not opened:
+            break
+        if len(opened) + len(closed) > MAX_ALTERNATIVES:
+            # too many to be useful, stop here
+            closed.update(opened)
+            return set(), closed
+    return opened, closed
+
+def _analyze(pattern):
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None, False
+    opened, closed = _expand(list(parsed))
+    found = opened | closed
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    if ignorecase:
+        found = set(s.lower() for s in found)
+    return found, ignorecase
+
+def literal_prefixes(pattern):
+    """Returns a tuple of literal strings, one of which starts every string
+    that pattern.match() accepts, or None if there is no such set. If pattern
+    ignores case, the prefixes are lower case.
+
+    """
+    found, _ = _analyze(pattern)
+    if found is None:
+        return None
+    prefixes = set(s.split(_WORD_END, 1)[0] for s in found)
+    if '' in prefixes:
+        return None
+    return tuple(sorted(prefixes))
+
+def command_verbs(pattern):
+    """Returns the set of first words (split on whitespace) that a line must
+    start with to be accepted by pattern.match(), or None if that set can't be
+    worked out from the expression. If pattern ignores case, the words are lower
+    case.
+
+    """
+    found, _ = _analyze(pattern)
+    if found is None:
+        return None
+    verbs = set()
+    for s in found:
+        word = re.split(r'[\s\0]', s, 1)
+        if len(word) == 1 or not word[0]:
+            # not followed by whitespace or the end of the line, so the word
+            # may go on
+            return None
+        verbs.add(word[0])
+    return frozenset(verbs)
+
+def _required(items):
+    """Returns a list of sets of literal strings. Every match of the parsed
+    expression contains at least one string from each set."""
+    found = []
+    run = []
+    def flush():
+        if run:
+            found.append(frozenset([''.join(run)]))
+            del run[:]
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        if op is sre_parse.IN:
+            chars = _class_literals(av)
+            if chars:
+                found.append(frozenset(chars))
+        elif op is sre_parse.SUBPATTERN:
+            group, add_flags, del_flags, sub = av
+            if not (add_flags or del_flags):
+                found.extend(_required(sub))
+        elif op is sre_parse.BRANCH:
+            alternatives = set()
+            for branch in av[1]:
+                best = _most_selective(_required(branch))
+                if best is None:
+                    # this branch needs no literal text at all
+                    break
+                alternatives.update(best)
+            else:
+                found.append(frozenset(alternatives))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+            lo, hi, sub = av
+            if lo >= 1:
+                found.extend(_required(sub))
+    flush()
+    return found
+
+def _most_selective(sets):
+    """Picks the set of alternatives least likely to show up by chance: the
+    one whose shortest string is longest, then the one with fewest strings."""
+    if not sets:
+        return None
+    return max(sets, key=lambda s: (min(len(x) for x in s), -len(s)))
+
+def required_literals(pattern):
+    """Returns a list of sets of lower case strings, such that any string
+    pattern.search() finds a match in contains (case insensitively) at least
+    one string from each set. The list is empty if nothing is required. The
+    most selective set comes first.
+
+    """
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return []
+    found = []
+    for alternatives in _required(list(parsed)):
+        alternatives = frozenset(s.lower() for s in alternatives)
+        if alternatives and not '' in alternatives and not alternatives in found:
+            found.append(alternatives)
+    found.sort(key=lambda s: (min(len(x) for x in s), -len(s)), reverse=True)
+    return found
+
+class MultiPattern(object):
+    """Decides which of a group of regular expressions are worth running
+    against a line, in a single pass over the literals they need.
+
+    Every expression is reduced (with required_literals(), and any keywords it
+    was given) to literal strings that must appear in any line it matches. The
+    distinct literals of all the expressions are looked for once per line, and
+    only expressions whose literals are all present are candidates; the rest
+    could not possibly match. Expressions that need no literal text are always
+    candidates.
+
+    Also keeps count, per expression, of lines seen, candidates, matches and
+    time spent searching, see stats(). The counts are kept under a lock, and
+    copy() makes a MultiPattern with the same expressions and counts of its
+    own, so each plugin can count its own lines.
+
+    """
+    def __init__(self, entries):
+        """entries is a list of (key, pattern, keywords) tuples. keywords, if
+        not None, are required in addition to whatever the pattern needs."""
+        self._literals = []
+        literal_index = {}
+        # key -> list of sets of indexes into self._literals
+        self._requires = {}
+        self._always = []
+        self._patterns = {}
+        self._counts = {}
+        for key, pattern, keywords in entries:
+            groups = required_literals(pattern)
+            if keywords:
+                keywords = frozenset(k.lower() for k in keywords)
+                if not keywords in groups:
+                    groups.append(keywords)
+            self._patterns[key] = pattern
+            # [candidates, matches, seconds searching]
+            self._counts[key] = [0, 0, 0.0]
+            if not groups:
+                self._always.append(key)
+                continue
+            indexed = []
+            for group in groups:
+                ids = set()
+                for literal in group:
+                    if not literal in literal_index:
+                        literal_index[literal] = len(self._literals)
+                        self._literals.append(literal)
+                    ids.add(literal_index[literal])
+                indexed.append(frozenset(ids))
+            self._requires[key] = indexed
+        self.lock = threading.Lock()
+        self.lines = 0
+
+    def copy(self):
+        """Returns a MultiPattern for the same expressions, counting from
+        zero."""
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other._counts = dict((key, [0, 0, 0.0]) for key in self._counts)
+        other.lock = threading.Lock()
+        other.lines = 0
+        return other
+
+    def candidates(self, text):
+        """Returns the set of keys whose expressions might match text."""
+        with self.lock:
+            self.lines += 1
+        found = set(self._always)
+        if self._requires:
+            lower = text.lower()
+            present = set(i for i, literal in enumerate(self._literals) if literal in lower)
+            if present:
+                for key, groups in self._requires.items():
+                    for group in groups:
+                        if present.isdisjoint(group):
+                            break
+                    else:
+                        found.add(key)
+        return found
+
+    def search(self, key, text):
+        """Runs the expression for key against text, keeping count."""
+        start = time.perf_counter()
+        match = self._patterns[key].search(text)
+        seconds = time.perf_counter() - start
+        with self.lock:
+            counts = self._counts[key]
+            counts[0] += 1
+            if match:
+                counts[1] += 1
+            counts[2] += seconds
+        return match
+
+    def stats(self):
+        """Returns a list of (key, lines, candidates, matches, seconds), most
+        expensive first."""
+        found = []
+        with self.lock:
+            for key, (candidates, matches, seconds) in self._counts.items():
+                found.append((key, self.lines, candidates, matches, seconds))
+        found.sort(key=lambda s: s[4], reverse=True)
+        return found
+
+class Interest(object):
+    """Describes the lines a single handler could possibly accept.
+
+    prefixes
+        a tuple of strings, the line must start with one of them
+
+    keywords
+        a tuple of strings, the line must contain one of them (compared case
+        insensitively)
+
+    ignorecase
+        if true, prefixes are lower case and compared case insensitively
+
+    direct_only
+        if true, only direct lines are of interest
+
+    A handler with neither prefixes nor keywords is interested in everything,
+    and should have an Interest of None instead.
+
+    """
+    __slots__ = ('prefixes', 'keywords', 'ignorecase', 'direct_only')
+
+    def __init__(self, prefixes=(), keywords=(), ignorecase=False, direct_only=False):
+        self.prefixes = tuple(prefixes)
+        self.keywords = tuple(k.lower() for k in keywords)
+        self.ignorecase = ignorecase
+        self.direct_only = direct_only
+
+    @classmethod
+    def for_pattern(cls, pattern, direct_only=False, prefixes=None, keywords=None):
+        """Works out the Interest of a register_command style pattern (which
+        is matched at the start of the line). Explicit prefixes or keywords
+        override whatever can be found in the pattern. Returns None if the
+        handler could want any line."""
+        ignorecase = False
+        if prefixes is None and keywords is None:
+            if isinstance(pattern, str):
+                pattern = re.compile(pattern)
+            prefixes = literal_prefixes(pattern)
+            ignorecase = bool(pattern.flags & re.IGNORECASE)
+            if prefixes is None:
+                return None
+        return cls(prefixes or (), keywords or (), ignorecase, direct_only)
+
+    def matches(self, msg, direct):
+        if self.direct_only and not direct:
+            return False
+        if self.prefixes:
+            if self.ignorecase:
+                if msg.lower().startswith(self.prefixes):
+                    return True
+            elif msg.startswith(self.prefixes):
+                return True
+        if self.keywords:
+            lower = msg.lower()
+            for keyword in self.keywords:
+                if keyword in lower:
+                    return True
+        return False
+
+    def __repr__(self):
+        return '<Interest prefixes=%r keywords=%r%s>' % (
+            self.prefixes, self.keywords, ' direct' if self.direct_only else '')
+
+class InterestIndex(object):
+    """A combined index of every plugin's interests, used by the core to find
+    which plugins could handle a line without asking each of them.
+
+    Built from (plugin, interests) pairs, where interests is a list of
+    Interest objects (one per handler) or None for plugins that want every line.
+    Like the core's channel routes, an index is never modified after it is
+    built.
+
+    """
+    def __init__(self, pairs=()):
+        # plugins that declared interests at all, anything else gets every line
+        constrained = set()
+        # first character of a prefix -> [(plugin, interest), ...]
+        self._by_first = {}
+        self._by_first_lower = {}
+        # [(plugin, interest), ...] for interests given as keywords
+        self._keyworded = []
+
+        for plug, interests in pairs:
+            if interests is None:
+                continue
+            constrained.add(plug)
+            for interest in interests:
+                if interest.keywords:
+                    self._keyworded.append((plug, interest))
+                index = self._by_first_lower if interest.ignorecase else self._by_first
+                for first in set(p[:1] for p in interest.prefixes):
+                    entries = index.setdefault(first, [])
+                    if not (plug, interest) in entries:
+                        entries.append((plug, interest))
+        self.constrained = frozenset(constrained)
+
+    def matching(self, msg, direct):
+        """Returns the set of constrained plugins interested in this line."""
+        found = set()
+        first = msg[:1]
+        for plug, interest in self._by_first.get(first, ()):
+            if not plug in found and interest.matches(msg, direct):
+                found.add(plug)
+        if self._by_first_lower:
+            for plug, interest in self._by_first_lower.get(first.lower(), ()):
+                if not plug in found and interest.matches(msg, direct):
+                    found.add(plug)
+        for plug, interest in self._keyworded:
+            if not plug in found and interest.matches(msg, direct):
+                found.add(plug)
+        return found
@@ -1,10 +1,21 @@
 from .agent import Agent
 from xml.etree import ElementTree as ET
 import time
-from copy import copy
 import traceback
 import re
+import copy
 import json
+import sqlite3
+import threading
+from collections import deque, namedtuple
+
+from .message import Message
+from .patterns import Interest, MultiPattern, required_literals, command_verbs
+from . import executor
+from . import log
+from . import storage
+from .supervisor import RESTART_MODES
+from . import timers
 
 class ConfigurationError(Exception):
     pass
@@ -77,16 +88,113 @@ class Plugin(Agent):
             traceback.print_exc()
             raise ConfigurationError(str(e))
 
+        queue_size = el.get('queue-size', None)
+        queue_policy = el.get('queue-policy', None)
+        if queue_size or queue_policy:
+            try:
+                plug.set_queue(int(queue_size or plug.queue.maxsize), queue_policy or plug.queue.policy)
+            except ValueError as e:
+                raise ConfigurationError('invalid queue for "%s": %s' % (plug_type, e))
+
+        log_level = el.get('log-level', None)
+        if log_level is not None:
+            try:
+                plug.log_level = log.parse_level(log_level)
+            except ValueError:
+                raise ConfigurationError('invalid log level "%s"' % (log_level,))
+
+        restart = el.get('restart', plug.restart).lower()
+        if not restart in RESTART_MODES:
+            raise ConfigurationError('invalid restart mode "%s"' % (restart,))
+        plug.restart = restart
+        # kept so the plugin can be loaded again if it crashes
+        plug.config_element = el
+
+        poll_jitter = el.get('poll-jitter', None)
+        if poll_jitter is not None:
+            try:
+                plug.poll_jitter = max(float(poll_jitter), 0.0)
+            except ValueError:
+                raise ConfigurationError('invalid poll jitter "%s"' % (poll_jitter,))
+        poll_policy = el.get('poll-policy', None)
+        if poll_policy is not None:
+            if not poll_policy.lower() in timers.POLICIES:
+                raise ConfigurationError('invalid poll policy "%s"' % (poll_policy,))
+            plug.poll_policy = poll_policy.lower()
+        persist_interval = el.get('persist-interval', None)
+        if persist_interval is not None:
+            try:
+                plug.persist_interval = max(float(persist_interval), 0.0)
+            except ValueError:
+                raise ConfigurationError('invalid persist interval "%s"' % (persist_interval,))
+
         for chan in plug_channels:
             plug.subscribe(chan)
 
         return plug
 
+    # how the core's supervisor brings the plugin back if it crashes, one of
+    # "reload", "thread" or "never", see hesperus.supervisor
+    restart = 'reload'
+    # the element the plugin was loaded from, if any
+    config_element = None
+    # the most jobs (blocking commands, warm-ups) this plugin may have
+    # running on the shared executor at once
+    blocking_limit = 2
+
     def __init__(self, parent, channels=[], daemon=False):
         super(Plugin, self).__init__(daemon=daemon)
-        self._channels = copy(channels)
+        self._channels = tuple(channels)
         self.parent = parent
 
+    def queue_priority(self, func, args, kwargs):
+        # lines directed at us go ahead of the rest of the chatter
+        if func.__name__.startswith('handle_message'):
+            return bool(args and args[0].direct)
+        if func.__name__.startswith('handle_incoming'):
+            if len(args) > 3:
+                return bool(args[3])
+            return bool(kwargs.get('direct', False))
+        return False
+
+    def queue_key(self, func, args, kwargs):
+        # the same line said twice is the same call, whatever its trace id
+        if args and isinstance(args[0], Message):
+            message = args[0]
+            args = (sorted(message.channels), message.nick, message.text, message.direct) + args[1:]
+        return super(Plugin, self).queue_key(func, args, kwargs)
+
+    def _finish(self):
+        super(Plugin, self)._finish()
+        # let the core know right away if we crashed
+        if self.error and isinstance(self.parent, Agent):
+            self.parent.wake()
+
+    def warm_up(self):
+        """Override this for slow setup that needn't hold up startup, like
+        connecting to a service or fetching feeds for the first time. It is
+        called on the shared executor once the plugin has started, so the bot
+        is already online, and messages and polls may come in before it is
+        done. Errors are logged, and leave the plugin running."""
+        pass
+
+    def start_warm_up(self):
+        """Runs warm_up() in the background. Called by the core when it
+        starts the plugin."""
+        if type(self).warm_up is Plugin.warm_up:
+            # nothing to do, don't bother the executor
+            return
+        def job():
+            start = time.time()
+            try:
+                self.warm_up()
+            except Exception as e:
+                self.metrics.exceptions += 1
+                self.log_warning("warm-up failed:", e)
+            else:
+                self.log_debug("warmed up in %.2f seconds" % (time.time() - start,))
+        executor.shared().submit(self, 'warm-up', job)
+
     # useful decorator for config type checking
     @classmethod
     def config_types(cls, **types):
@@ -129,27 +237,65 @@ class Plugin(Agent):
     # channel management
     #
 
+    # _channels is a tuple, replaced (under the lock) but never modified, so
+    # it can be read without the lock
+
     @property
     def channels(self):
-        with self.lock:
-            return self._channels
+        return self._channels
 
     def subscribe(self, chan):
         with self.lock:
-            if not chan in self._channels:
-                self._channels.append(chan)
+            if chan in self._channels:
+                return
+            self._channels = self._channels + (chan,)
+        self._channels_changed()
 
     def unsubscribe(self, chan):
         with self.lock:
-            if chan in self._channels:
-                self._channels.remove(chan)
+            if not chan in self._channels:
+                return
+            self._channels = tuple(c for c in self._channels if c != chan)
+        self._channels_changed()
 
     def unsubscribe_all(self):
         with self.lock:
-            self._channels = []
+            self._channels = ()
+        self._channels_changed()
+
+    def _channels_changed(self):
+        # called without our lock held, the core takes its own lock and then
+        # reads our channels
+        update_routes = getattr(self.parent, 'update_routes', None)
+        if update_routes is not None:
+            update_routes(self)
+
+    def interests(self):
+        """Returns a list of Interest objects describing which lines
+        handle_incoming() could possibly do something with, or None if it
+        wants every line. The core uses this to avoid handing lines to
+        plugins that would ignore them."""
+        return None
+
+    def observe(self, message):
+        """Called by the core, in its own thread, with every Message routed
+        to this plugin, whether or not interests() lets it through to
+        handle_message(). For plugins that keep track of everyone who talks
+        (like when they were last seen) but only handle a few commands. It
+        must be quick: queue anything slow with Plugin.queued."""
+        pass
 
     # override in subclasses, use Plugin.queued when appropriate
 
+    def handle_message(self, message):
+        """Handle an incoming hesperus.message.Message. This is what the
+        core calls; by default it calls handle_incoming() with the message's
+        fields, so plugins can override either one. The message is shared
+        with the other plugins, so don't change it: pass on a
+        message.derive() instead."""
+        self.handle_incoming(message.channels, message.nick, message.text, message.direct,
+                self.metrics.counting_reply(message.reply))
+
     def handle_incoming(self, chans, name, msg, direct, reply):
         """Handle incoming messages. chans contains a list of channels
         that the author of this message belongs to. name is the name
@@ -168,6 +314,9 @@ class Plugin(Agent):
         #self.log_debug("outgoing", self, chan, msg)
         pass
 
+# one entry in a CommandPlugin's command_table
+CommandHandler = namedtuple('CommandHandler', ['name', 'func', 'pattern', 'direct_only', 'passive', 'interest', 'verbs'])
+
 # special case of Plugin that just handles chat commands, given as regexps
 class CommandPlugin(Plugin):
     """Plugins deriving from this class are meant to implement a command that
@@ -184,17 +333,115 @@ class CommandPlugin(Plugin):
     the message. In other words, the part of the message that matched the given
     regular expression.
 
+    The decorated functions are collected once, when the class is created, into
+    command_table: a tuple of CommandHandler entries (in the order they are
+    tried) that subclasses inherit and extend.
+
+    Each handler also gets an Interest, worked out from the literal text its
+    regular expression starts with (usually the command name), so the core
+    only passes along lines that some handler could match. Handlers whose
+    expression starts with no literal text get every line, unless they are
+    given explicit prefixes or keywords to look for.
+
+    Where the regular expression only allows a known set of first words
+    (verbs), lines already parsed into a hesperus.message.Command by the
+    command frontend are dispatched by looking the verb up, and only the
+    handlers that accept that verb (or whose verbs are unknown) are tried.
+
     """
     # If true, incomming messages will be added to the agent's built-in queue
     # and handled in the plugin's thread instead of the core thread
     commands_queued = True
 
+    # handlers registered with blocking=True run on the shared executor (at
+    # most blocking_limit at once, see Plugin), and are given up on after
+    # blocking_timeout seconds unless they ask for a different timeout
+    blocking_timeout = 60
+
+    # filled in for each subclass by __init_subclass__
+    command_table = ()
+    _interests = []
+    _passive_patterns = None
+    _verb_table = {}
+    _verbless = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(CommandPlugin, cls).__init_subclass__(**kwargs)
+        # handlers are tried in name order, same as the dir(self) scan this
+        # replaces
+        table = []
+        for attr in dir(cls):
+            handler = getattr(getattr(cls, attr, None), '_hesperus_command', None)
+            if not isinstance(handler, CommandHandler):
+                continue
+            if handler.name != attr:
+                handler = handler._replace(name=attr)
+            table.append(handler)
+        cls.command_table = tuple(table)
+
+        cls._interests = [h.interest for h in table]
+        if None in cls._interests:
+            cls._interests = None
+
+        # verb -> handlers to try for a Command with that verb, in order
+        verbs = set()
+        for h in table:
+            verbs.update(h.verbs or ())
+        cls._verbless = tuple(h for h in table if h.verbs is None)
+        cls._verb_table = dict(
+            (verb, tuple(h for h in table if h.verbs is None or verb in h.verbs))
+            for verb in verbs)
+
+        # register_pattern handlers search the whole line, so check for the
+        # text they need all at once before running any of them
+        passive = [h for h in table if h.passive]
+        cls._passive_patterns = None
+        if passive:
+            cls._passive_patterns = MultiPattern([
+                (h.name, h.pattern, h.interest.keywords if h.interest else None)
+                for h in passive])
+
+    def __init__(self, *args, **kwargs):
+        super(CommandPlugin, self).__init__(*args, **kwargs)
+        # the expressions are worked out once per class, but each plugin
+        # counts its own lines
+        if self._passive_patterns is not None:
+            self._passive_patterns = self._passive_patterns.copy()
+
+    def interests(self):
+        # subclasses that do their own thing in handle_incoming see every line
+        if type(self).handle_incoming is not CommandPlugin.handle_incoming:
+            return None
+        return self._interests
+
+    @classmethod
+    def list_commands(cls):
+        """Returns (name, pattern) for every command and pattern handler this
+        plugin class registered, in dispatch order."""
+        return [(h.name, h.pattern.pattern) for h in cls.command_table]
+
+    def pattern_stats(self):
+        """Returns (name, lines, candidates, matches, seconds) for each
+        register_pattern handler of this plugin, most expensive first. lines
+        counts every line dispatched, candidates those that had the literal
+        text the pattern needs, and seconds the time spent searching them."""
+        if self._passive_patterns is None:
+            return []
+        return self._passive_patterns.stats()
+
     # first, the decorator for defining commands
     # takes a regexp to match, and direct-only flag (default=True)
     # applies to a function taking (chans, match_obj, direct, reply)
+    # prefixes and keywords optionally override the handler's Interest
+    # blocking handlers (ones that wait on the network, say) are run with
+    # run_blocking(), optionally with their own timeout
     @classmethod
-    def register_command(cls, regexp, direct_only=True):
+    def register_command(cls, regexp, direct_only=True, prefixes=None, keywords=None, blocking=False, timeout=None):
         regexp = re.compile(regexp + "$")
+        interest = Interest.for_pattern(regexp, direct_only, prefixes, keywords)
+        verbs = None
+        if prefixes is None and keywords is None and not regexp.flags & re.IGNORECASE:
+            verbs = command_verbs(regexp)
         def sub_generator(func):
             def sub_function(self, chans, name, msg, direct, reply):
                 if direct_only and not direct:
@@ -202,13 +449,60 @@ class CommandPlugin(Plugin):
                 match = regexp.match(msg)
                 if not match:
                     return False
-                func(self, chans, name, match, direct, reply)
+                if blocking:
+                    self.run_blocking(name,
+                            lambda reply: func(self, chans, name, match, direct, reply),
+                            reply, timeout)
+                else:
+                    func(self, chans, name, match, direct, reply)
                 return True
 
-            sub_function._hesperus_command = True
+            sub_function.__name__ = func.__name__
+            sub_function.__doc__ = func.__doc__
+            sub_function._hesperus_command = CommandHandler(
+                func.__name__, sub_function, regexp, direct_only, False, interest, verbs)
             return sub_function
         return sub_generator
 
+    def run_blocking(self, requester, func, reply, timeout=None):
+        """Runs func(reply) on the executor shared by all plugins, instead
+        of in the current thread. Commands from the same requester run one at
+        a time, in order. If func takes longer than timeout seconds (default
+        blocking_timeout), the requester is told, and anything func replies
+        after that is dropped."""
+        if timeout is None:
+            timeout = self.blocking_timeout
+        cut_off = []
+        def guarded_reply(msg):
+            if not cut_off:
+                reply(msg)
+        def on_timeout():
+            cut_off.append(True)
+            self.log_warning("blocking command for %s timed out after %s seconds" % (requester, timeout))
+            reply("Sorry, that's taking too long. I give up.")
+        def job():
+            try:
+                func(guarded_reply)
+            except Exception:
+                self.metrics.exceptions += 1
+                raise
+        executor.shared().submit(self, requester, job, timeout=timeout, on_timeout=on_timeout)
+
+    def handle_message(self, message):
+        # subclasses that do their own thing in handle_incoming get it
+        # called as usual
+        if type(self).handle_incoming is not CommandPlugin.handle_incoming:
+            super(CommandPlugin, self).handle_message(message)
+        elif self.commands_queued:
+            self.handle_message_queued(message)
+        else:
+            self.handle_message_nonqueued(message)
+
+    def handle_message_nonqueued(self, message):
+        self._dispatch(message.channels, message.nick, message.text, message.direct,
+                self.metrics.counting_reply(message.reply), message.command)
+    handle_message_queued = Plugin.queued(handle_message_nonqueued)
+
     def handle_incoming(self, *args):
         if self.commands_queued:
             self.handle_incoming_queued(*args)
@@ -216,29 +510,111 @@ class CommandPlugin(Plugin):
             self.handle_incoming_nonqueued(*args)
 
     def handle_incoming_nonqueued(self, chans, name, msg, direct, reply):
-        for func in dir(self):
-            func = getattr(self, func)
-            if (not "_hesperus_command" in dir(func)) or (not func._hesperus_command):
-                continue
-            if func(chans, name, msg, direct, reply):
-                return
+        self._dispatch(chans, name, msg, direct, reply, getattr(msg, 'command', None))
     handle_incoming_queued = Plugin.queued(handle_incoming_nonqueued)
 
+    def _dispatch(self, chans, name, msg, direct, reply, command=None):
+        """Tries the handlers on a line, until one handles it. If the line
+        was parsed into a Command, only the handlers for its verb are
+        tried."""
+        if command is not None:
+            handlers = self._verb_table.get(command.verb, self._verbless)
+        else:
+            handlers = self.command_table
+
+        passive = self._passive_patterns
+        if passive is not None:
+            candidates = passive.candidates(msg)
+        for handler in handlers:
+            if handler.passive:
+                if not handler.name in candidates:
+                    continue
+                match = passive.search(handler.name, msg)
+                if not match:
+                    continue
+                if handler.func(self, chans, name, msg, direct, reply, match):
+                    return
+            elif handler.func(self, chans, name, msg, direct, reply):
+                return
+
 # special case of plugin that polls every X seconds
 class PollPlugin(Plugin):
+    """A plugin whose poll() is called every poll_interval seconds.
+
+    poll_interval may be a property, for intervals that change; call
+    reschedule_poll() when it does. Up to poll_jitter * poll_interval seconds
+    are added to each wait, at random, to spread out plugins polling at the
+    same interval, and poll_policy says what happens to polls that are missed
+    because poll() took too long (see hesperus.timers). Both can be set with
+    <plugin poll-jitter="0.1" poll-policy="skip">.
+
+    Under a core, polls are scheduled on its timer wheel, and the plugin
+    sleeps in between. A poll() that blocks (fetching a feed, say) holds up
+    whatever it runs on, so pollers like that should set dedicated_thread,
+    rather than tie up a worker shared with other plugins.
+
+    """
     poll_interval = 5.0
+    poll_jitter = 0.0
+    poll_policy = timers.DELAY
 
     def run(self):
+        wheel = getattr(self.parent, 'timers', None)
+        if wheel is None:
+            # no core to keep time for us
+            for timeout in self._run_unscheduled():
+                yield timeout
+            return
+
+        self._poll_due = False
+        self._poll_timer = timers.Periodic(wheel, lambda: self.poll_interval, self._poll_fired,
+                jitter=self.poll_jitter, policy=self.poll_policy)
+        self._poll_timer.start()
+        try:
+            while True:
+                if not self._poll_due:
+                    yield self.forever
+                    continue
+                self._poll_due = False
+                for timeout in self._timed_poll():
+                    yield timeout
+                self._poll_timer.done()
+        finally:
+            self._poll_timer.stop()
+
+    def _run_unscheduled(self):
         self.lasttime = time.time()
         while True:
-            while time.time() < self.lasttime + self.poll_interval:
-                yield
-
-            for _ in self.poll():
-                yield
-
+            remaining = self.lasttime + self.poll_interval - time.time()
+            if remaining > 0:
+                yield remaining
+                continue
+            for timeout in self._timed_poll():
+                yield timeout
             self.lasttime = time.time()
 
+    def _poll_fired(self):
+        # called by the core's timer wheel, in the core's thread
+        self._poll_due = True
+        self.wake()
+
+    def _timed_poll(self):
+        # only count the time spent in poll(), not the time it yields
+        metrics = self.metrics
+        elapsed = 0.0
+        start = time.perf_counter()
+        for timeout in self.poll():
+            elapsed += time.perf_counter() - start
+            yield timeout
+            start = time.perf_counter()
+        metrics.poll.observe(elapsed + time.perf_counter() - start)
+
+    def reschedule_poll(self):
+        """Moves the next poll to one (new) poll_interval after the last."""
+        periodic = getattr(self, '_poll_timer', None)
+        if periodic is not None:
+            periodic.reschedule()
+
     def poll(self):
         yield
 
@@ -246,7 +622,7 @@ class PollPlugin(Plugin):
 #  does something with them
 class PassivePlugin(CommandPlugin):
     @classmethod
-    def register_pattern(cls, regexp, ignore_direct=False):
+    def register_pattern(cls, regexp, ignore_direct=False, keywords=None):
         """The decorated method will be called for every line of chat that matches the given regexp.
         You can return True to indicate no other command handlers will be
         called; the line was "hanlded". Otherwise, other commands that may also
@@ -255,13 +631,26 @@ class PassivePlugin(CommandPlugin):
         if ignore_direct is true, ignores messages that are directed
         specifically at us
 
+        keywords, if given, is a list of words one of which must appear in
+        any line the regexp matches. Otherwise, whatever literal text the
+        regexp needs is used. Lines without it are skipped by the core, and
+        the regexp is not run on them.
+
         """
         pattern = re.compile(regexp)
+        interest = None
+        if keywords:
+            interest = Interest(keywords=keywords)
+        else:
+            required = required_literals(pattern)
+            if required:
+                interest = Interest(keywords=required[0])
         def wrapper(func):
-            def wrapped(self, chans, name, msg, direct, reply):
+            def wrapped(self, chans, name, msg, direct, reply, match=None):
                 if direct and ignore_direct:
                     return False
-                match = pattern.search(msg)
+                if match is None:
+                    match = pattern.search(msg)
                 if match:
                     try:
                         return func(self, match, reply)
@@ -269,21 +658,170 @@ class PassivePlugin(CommandPlugin):
                         return func(self, chans, name, match, direct, reply)
                 else:
                     return False
-            wrapped._hesperus_command = True
+            wrapped.__name__ = func.__name__
+            wrapped.__doc__ = func.__doc__
+            wrapped._hesperus_command = CommandHandler(
+                func.__name__, wrapped, pattern, False, True, interest, None)
             return wrapped
         return wrapper
 
 class PersistentPlugin(Plugin):
+    """A plugin that keeps its state in _data, a dict, saved in the shared
+    hesperus.storage database. Each top-level key of _data is stored on its
+    own, in a namespace named after the plugin (persistence_namespace, the
+    class name by default). The class attribute _data holds the defaults,
+    which each instance gets a copy of.
+
+    save_data() only marks keys as changed: the ones given, or all of them.
+    The changes are written out at most once every persist_interval seconds
+    (or <plugin persist-interval>), so a busy plugin can change its state on
+    every line without touching the disk each time. The changed keys are
+    serialized in the plugin's thread, and written in one transaction on
+    hesperus.storage's writer thread. Whatever is left is written right away
+    when the plugin stops, and flush_data() does the same on demand. A
+    persist_interval of 0 writes every change, but still in the background.
+
+    load_data() reads the state back. The first time, it imports
+    persistence_file, the JSON file plugins used to save to, if there is
+    one.
+
+    """
     persistence_file = 'global.json'
+    persistence_namespace = None
+    persist_interval = 5.0
     _data = {}
 
-    def save_data(self):
-        with open(self.persistence_file, 'w') as pf:
-            json.dump(self._data, pf, indent=4)
+    def __init__(self, *args, **kwargs):
+        super(PersistentPlugin, self).__init__(*args, **kwargs)
+        self._data = copy.deepcopy(type(self)._data)
+        self._store = None
+        # _persist_lock guards _persist_pending, _persist_write_lock is held
+        # while writing
+        self._persist_lock = threading.Lock()
+        self._persist_write_lock = threading.Lock()
+        # keys changed since the last snapshot, or True for all of them
+        self._persist_dirty = set()
+        self._persist_timer = None
+        # snapshots waiting to be written, oldest first
+        self._persist_pending = deque()
+        self.persist_saves = 0
+
+    @property
+    def store(self):
+        """This plugin's hesperus.storage.Namespace."""
+        if self._store is None:
+            self._store = storage.namespace(self.persistence_namespace or type(self).__name__)
+        return self._store
+
+    def save_data(self, *keys):
+        """Marks the given keys of _data (or all of them) as changed, to be
+        written out soon."""
+        self.persist_saves += 1
+        if not keys:
+            self._persist_dirty = True
+        elif self._persist_dirty is not True:
+            self._persist_dirty.update(keys)
+        if self._persist_timer is not None:
+            # already on its way
+            return
+        wheel = getattr(self.parent, 'timers', None)
+        if wheel is None or self.persist_interval <= 0:
+            self._write_behind()
+            return
+        self._persist_timer = wheel.schedule_in(self.persist_interval, self._persist_fired)
+
+    def _persist_fired(self):
+        # called by the core's timer wheel, in the core's thread
+        self._persist_timer = None
+        self._write_behind()
+
+    @Plugin.queued
+    def _write_behind(self):
+        if self._snapshot():
+            storage.writer().submit(self._write_pending)
+
+    def _snapshot(self):
+        # called in our thread: serializes the changed keys, if any
+        dirty = self._persist_dirty
+        if not dirty:
+            return False
+        self._persist_dirty = set()
+        if dirty is True:
+            keys = list(self._data)
+        else:
+            keys = [k for k in dirty if k in self._data]
+        puts = [(k, json.dumps(self._data[k])) for k in keys]
+        # everything else that was changed is gone
+        deletes = None if dirty is True else [k for k in dirty if not k in self._data]
+        with self._persist_lock:
+            self._persist_pending.append((puts, deletes))
+        return True
+
+    def _write_pending(self):
+        # writes the snapshots in order, all in one transaction. Only one
+        # write runs at a time, so they land in order, but _persist_lock is
+        # only held to take the snapshots, so _snapshot() never waits for the
+        # disk
+        with self._persist_write_lock:
+            with self._persist_lock:
+                snapshots = list(self._persist_pending)
+                self._persist_pending.clear()
+            if not snapshots:
+                return
+            written = 0
+            try:
+                store = self.store
+                with store.batch():
+                    for puts, deletes in snapshots:
+                        for key, text in puts:
+                            written += store.put_json(key, text)
+                        if deletes is None:
+                            # a snapshot of everything
+                            keep = set(key for key, text in puts)
+                            deletes = [key for key in store.keys() if not key in keep]
+                        for key in deletes:
+                            store.delete(key)
+            except (sqlite3.Error, IOError, OSError) as e:
+                # put back ahead of anything newer, for the next try
+                with self._persist_lock:
+                    self._persist_pending.extendleft(reversed(snapshots))
+                self.metrics.exceptions += 1
+                self.log_warning('Error while saving persistent data: {err}'.format(err=e))
+                return
+            self.metrics.persist_writes += 1
+            self.metrics.persist_bytes += written
+
+    def flush_data(self):
+        """Writes out any unsaved changes now, and waits for it."""
+        timer = self._persist_timer
+        if timer is not None:
+            self._persist_timer = None
+            self.parent.timers.cancel(timer)
+        self._snapshot()
+        self._write_pending()
+
+    def persistence_stats(self):
+        """Returns a dict with the number of changes saved, the number of
+        writes and the bytes they wrote, and whether there are unsaved
+        changes."""
+        return {
+            'saves': self.persist_saves,
+            'writes': self.metrics.persist_writes,
+            'bytes': self.metrics.persist_bytes,
+            'dirty': bool(self._persist_dirty or self._persist_pending),
+        }
+
+    def _finish(self):
+        try:
+            self.flush_data()
+        finally:
+            super(PersistentPlugin, self)._finish()
 
     def load_data(self):
         try:
-            with open(self.persistence_file, 'r') as pf:
-                self._data.update(json.load(pf))
-        except (ValueError,IOError) as e:
+            imported = self.store.import_json(self.persistence_file)
+            if imported:
+                self.log_message('imported %d keys from %s' % (imported, self.persistence_file))
+            self._data.update(self.store.items())
+        except (ValueError, IOError, sqlite3.Error) as e:
             self.log_warning('Error while loading persistent data: {err}'.format(err=e))
@@ -36,7 +36,7 @@ class IdleAlerter(CommandPlugin, PollPlugin, PersistentPlugin):
     def remove_user(self, name):
         if name in self._data['users']:
             del self._data['users'][name]
-            self.save_data()
+            self.save_data('users')
 
     def add_user(self, name, sms_contact=None, email_contact=None):
         now = int(time.time())
@@ -54,13 +54,13 @@ class IdleAlerter(CommandPlugin, PollPlugin, PersistentPlugin):
             if email_contact is not None:
                 self._data['users'][name]['email_contact'] = email_contact
                 self.log_debug('Enabled email alerts for ' + name)
-        self.save_data()
+        self.save_data('users')
 
     update_user = add_user
 
     def add_message(self, **kwargs):
         self._data['messages'].append(kwargs)
-        self.save_data()
+        self.save_data('messages')
         self.log_debug('Added message to queue: {msg}'.format(msg=kwargs))
 
     def update_last_active(self, name):
@@ -68,7 +68,7 @@ class IdleAlerter(CommandPlugin, PollPlugin, PersistentPlugin):
         #remove queued messages
         self._data['messages'] = [msg for msg in self._data['messages'] \
             if msg['dest'] != name]
-        self.save_data()
+        self.save_data('users', 'messages')
 
     @CommandPlugin.register_command(r'emailalert(?:\s+(.+))?')
     def email_alert_command(self, chans, name, match, direct, reply):
@@ -137,7 +137,7 @@ class IdleAlerter(CommandPlugin, PollPlugin, PersistentPlugin):
                 self.send_message(msg)
                 self._data['messages'].remove(msg)
                 self.update_last_active(msg['dest'])
-            self.save_data()
+            self.save_data('messages')
         yield
 
     def send_message(self, message):
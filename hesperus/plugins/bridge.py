@@ -26,26 +26,26 @@ class BridgePlugin(Plugin):
             self.subscribe(channel)
             self.outputs.append(channel)
     
-    def handle_incoming(self, chans, name, msg, direct, reply):
-        other_chans = set(chans) - set(self.inputs)
-        chans = set(chans).intersection(self.inputs)
+    def handle_message(self, message):
+        inputs = frozenset(self.inputs)
+        chans = message.channels & inputs
         if not chans:
             return
+        other_chans = message.channels - inputs
         
+        reply = message.reply
         # direct *usually* means private message, so don't broadcast those!
-        if not direct:
+        if not message.direct:
             for chan in self.inputs:
                 if chan in chans:
                     continue
-                self.parent.send_outgoing(chan, '<%s> %s' % (name, msg))
+                self.parent.send_outgoing(chan, '<%s> %s' % (message.nick, message.text))
             
-            old_reply = reply
-            def new_reply(msg):
+            def reply(msg):
                 for chan in self.inputs:
                     self.parent.send_outgoing(chan, msg)
-            reply = new_reply
         
-        self.parent.handle_incoming(self.outputs + list(other_chans), name, msg, direct, reply)
+        self.parent.handle_message(message.derive(channels=other_chans.union(self.outputs), reply=reply))
     
     def send_outgoing(self, chan, msg):
         if not chan in self.outputs:
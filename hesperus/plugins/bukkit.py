@@ -5,6 +5,7 @@ import socket
 
 from ..core import ConfigurationError
 from ..plugin import Plugin, PollPlugin
+from ..message import Message
 
 class Transport(object):
     def call(self, name, args):
@@ -271,13 +272,19 @@ class BukkitPlugin(PollPlugin):
         self.password = password
         self.salt = salt
         
-        self.b = Bukkit(server, port, username, password, salt)
+        # connected by warm_up()
+        self.b = None
         self.ignore = True
-        self.b.subscribe('chat', self._handle)
+    
+    def warm_up(self):
+        b = Bukkit(self.server, self.port, self.username, self.password, self.salt)
+        b.subscribe('chat', self._handle)
+        self.b = b
         self.ignore = False
     
     def poll(self):
-        self.b.flush()
+        if self.b is not None:
+            self.b.flush()
         yield
     
     def _handle(self, it):
@@ -292,7 +299,10 @@ class BukkitPlugin(PollPlugin):
         
         def reply(msg):
             self.b.broadcastWithName(msg, self.username)
-        self.parent.handle_incoming(self.channels, nick, msg, False, reply)
+        self.parent.handle_message(Message(self.channels, nick, msg, False, reply))
 
     def send_outgoing(self, chan, msg):
+        if self.b is None:
+            self.log_warning("not connected yet, dropping:", msg)
+            return
         self.b.broadcastWithName(msg, self.username)
@@ -2,6 +2,7 @@ import re
 
 from ..core import ConfigurationError, ET
 from ..plugin import Plugin
+from ..message import Command, CommandText
 
 class CommandPlugin(Plugin):
     """Install this plugin to supplement plugins that derive from
@@ -9,9 +10,14 @@ class CommandPlugin(Plugin):
     tries to parse them in command syntax. If they match, the command is
     re-emitted as if the command were sent to the bot directly.
 
+    Each line is parsed once, into a hesperus.message.Command, and re-emitted
+    as a Message carrying it (with its text a CommandText carrying it too, for
+    plugins that only look at the text), so downstream command plugins can
+    dispatch on its verb instead of trying each of their regular expressions.
+
     """
-    @Plugin.config_types(inline=bool, names=ET.Element, command_chars=str, name_sep_chars=str)
-    def __init__(self, core, inline=False, names=None, command_chars="", name_sep_chars=",:"):
+    @Plugin.config_types(inline=bool, names=ET.Element, command_chars=str, name_sep_chars=str, structured=bool)
+    def __init__(self, core, inline=False, names=None, command_chars="", name_sep_chars=",:", structured=True):
         """Options:
 
         inline
@@ -30,6 +36,10 @@ class CommandPlugin(Plugin):
             A string of characters that may prefix a command. Good options are:
             ! or .
 
+        structured
+            If false, commands are re-emitted as plain text, and downstream
+            plugins match them against all of their regular expressions.
+
 
         In other words, the bot will respond to commands in the forms:
             name whitespace name_sep whitespace command
@@ -40,6 +50,7 @@ class CommandPlugin(Plugin):
         super(CommandPlugin, self).__init__(core)
         
         self.inline = inline
+        self.structured = structured
         
         self.names = []
         if names == None:
@@ -60,30 +71,43 @@ class CommandPlugin(Plugin):
         
         # create a generic name-directed re (matches: nick, message)
         self.redirection_re = '([^ ]+?)(?:' + re_names_sep + ').*'
+
+        self._whole_re = re.compile("^" + self.command_re + "$", re.IGNORECASE)
+        self._inline_re = re.compile("(?:\(|\[)" + self.command_re + "(?:\)|\])", re.IGNORECASE)
+        self._redirection_re = re.compile(self.redirection_re, re.IGNORECASE)
+
+    def parse(self, msg):
+        """Parses a line of chat into a Command, or returns None if it isn't
+        one."""
+        whole = self._whole_re.match(msg)
+        if whole:
+            return Command(whole.group(1))
+        if self.inline:
+            part = self._inline_re.search(msg)
+            if part:
+                # try to detect redirection (e.g. agrif, (!bookmark))
+                redirection = self._redirection_re.match(msg)
+                addressee = redirection.group(1) if redirection else None
+                return Command(part.group(1), addressee=addressee, inline=True)
+        return None
     
-    def handle_incoming(self, chans, name, msg, direct, reply):
+    def handle_message(self, message):
         # skip direct messages, our work is done already
-        if direct:
+        if message.direct:
             return
         
         # turn indirect messages into direct messages, if appropriate
-        direct_re = "^" + self.command_re + "$"
-        whole = re.match(direct_re, msg, re.IGNORECASE)
-        if whole:
-            whole_direct = True
-            whole_msg = whole.group(1)
-            whole_reply = lambda s: reply(name + ": " + s)
-            self.parent.handle_incoming(chans, name, whole_msg, True, whole_reply)
-        elif self.inline:
-            part = re.search("(?:\(|\[)" + self.command_re + "(?:\)|\])", msg, re.IGNORECASE)
-            if part:
-                # try to detect redirection (e.g. agrif, (!bookmark))
-                redirection = re.match(self.redirection_re, msg, re.IGNORECASE)
-                if redirection:
-                    part_name = redirection.group(1)
-                else:
-                    part_name = name
-                
-                part_msg = part.group(1)
-                part_reply = lambda s: reply(part_name + ": " + s)
-                self.parent.handle_incoming(chans, part_name, part_msg, True, part_reply)
+        command = self.parse(message.text)
+        if command is None:
+            return
+
+        target = command.addressee or message.nick
+        reply = message.reply
+        command_reply = lambda s: reply(target + ": " + s)
+        if self.structured:
+            derived = message.derive(nick=target, text=CommandText(command), direct=True,
+                    reply=command_reply, command=command)
+        else:
+            derived = message.derive(nick=target, text=command.text, direct=True,
+                    reply=command_reply, command=False)
+        self.parent.handle_message(derived)
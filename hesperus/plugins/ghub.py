@@ -7,6 +7,7 @@ from time import time, sleep
 from ..plugin import PollPlugin, CommandPlugin
 from ..core import ET, ConfigurationError
 from ..shorturl import short_url
+from .. import executor
 _short_url = lambda u: short_url(u, provider="git.io")
 
 # how each event is printed.
@@ -138,14 +139,16 @@ class Feed(object):
         self.channels = channels
         self.gh3 = gh3
 
-        # Go ahead and do the initial fetch to see the most recent entry
         # Store lastupdate as a string, lexographic ordering should work just
-        # fine. No need to parse the date.
+        # fine. No need to parse the date. It is set by warm_up(), or by the
+        # first get_new_events() if that comes first.
+        self.lastupdate = None
+
+    def warm_up(self):
+        """Do the initial fetch to see the most recent entry."""
         events = self._fetch()
-        if events:
+        if events and not self.lastupdate:
             self.lastupdate = events[0]['created_at']
-        else:
-            self.lastupdate = None
 
     def _fetch(self):
         try:
@@ -195,8 +198,15 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
     Also does issue searches and file:line lookups.
 
     """
+    # fetch up to four feeds at once when warming up
+    blocking_limit = 4
+    # poll() fetches the feeds itself, so it gets a thread (or a slot in the
+    # asyncio runtime's executor) of its own
+    dedicated_thread = True
 
     poll_interval = 60
+    # spread out the fetches of many watchers
+    poll_jitter = 0.1
     commands_queued = False
     
     @PollPlugin.config_types(feedmap=ET.Element, default_user=str, default_repo=str)
@@ -226,12 +236,17 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
             else:
                 self.feeds[feed_url].channels.append(channel)
 
+    def warm_up(self):
+        # fetch the feeds side by side
+        for feed in self.feeds.values():
+            executor.shared().submit(self, feed.url, feed.warm_up)
+
     @CommandPlugin.register_command(r"(issue|pull|patch|diff)s?(?:\s+help)?")
     def issue_help_command(self, chans, name, match, direct, reply):
         cmd = match.group(1)
         reply("Usage: %s <number or search string> [in name/repo]" % (cmd,))
 
-    @CommandPlugin.register_command(r"(issue|pull|patch|diff)s?\s+(?:(?:#?([0-9]+))|(.+?))(?:\s+(?:in|for|of|on)\s+([a-zA-Z0-9._-]+))?")
+    @CommandPlugin.register_command(r"(issue|pull|patch|diff)s?\s+(?:(?:#?([0-9]+))|(.+?))(?:\s+(?:in|for|of|on)\s+([a-zA-Z0-9._-]+))?", blocking=True)
     def issue_command(self, chans, name, match, direct, reply):
         cmd = match.group(1)
         user = match.group(4)
@@ -274,7 +289,7 @@ class GitHubPlugin(PollPlugin, CommandPlugin):
         if len(issues) == 0:
             reply("no issues found :(")
 
-    @CommandPlugin.register_command(r"([^:]+):([0-9]+)(?:\s+(?:in|for|of|on)\s+([a-zA-Z0-9._-]+)(?:/([a-zA-Z0-9._-]+))?)?")
+    @CommandPlugin.register_command(r"([^:]+):([0-9]+)(?:\s+(?:in|for|of|on)\s+([a-zA-Z0-9._-]+)(?:/([a-zA-Z0-9._-]+))?)?", blocking=True)
     def file_line_command(self, chans, name, match, direct, reply):
         fname = match.group(1)
         lineno = match.group(2)
@@ -1,40 +1,132 @@
 from ..core import ConfigurationError, ET
 from ..plugin import Plugin
+from ..message import Message
 from irc.bot import SingleServerIRCBot as IRCBot
 import re
+import select
+import socket
 import string
+import threading
 import time
+from collections import OrderedDict, deque
+import irc.client
 import irc.strings
 
-class RateLimit(object):
-    """If 5 lines come in less than 2 seconds, sleep for 2 seconds"""
-    def __init__(self, waittime=2):
-        self.waittime = waittime
-        self.lastmsg = 0
-        # Number of messages that have come in since lastmsg
-        self.msgcount = 0
-
-    def call(self):
-        now = time.time()
-        if now - self.lastmsg > self.waittime:
-            # Nothing received in waittime seconds. No delay.
-            self.lastmsg = now
-            self.msgcount = 0
+# outgoing line priorities, most urgent first
+REPLY = 0
+BROADCAST = 1
 
-        else:
-            # received this message within the last waittime seconds of lastmsg
-            self.msgcount += 1
+class OutboundQueue(object):
+    """Lines waiting to be sent to the server, drained at a pace the server's
+    flood protection will put up with: a token bucket holding up to burst
+    lines, refilled at rate lines a second.
+
+    Replies go ahead of broadcasts (like feed announcements). Within a
+    priority, targets (channels or nicks) take turns, one line each, so one
+    busy target can't hold up the rest. At most backlog lines wait; past
+    that, a broadcast line is dropped to make room for a reply, and anything
+    else new is dropped. Drops are counted.
+
+    Thread safe: anyone can put(), and the IRC plugin's thread takes lines
+    off with ready().
+
+    """
+    def __init__(self, rate=0.5, burst=5, backlog=100, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.backlog = backlog
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        # one target -> deque of lines per priority, targets in turn order
+        self._queues = [OrderedDict(), OrderedDict()]
+        self._size = 0
+        self.sent = 0
+        self.dropped = [0, 0]
 
-            if self.msgcount >= 5:
-                time.sleep(self.waittime)
-                self.lastmsg = now + self.waittime
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _drop_one(self, priority):
+        # called with the lock held: drops the oldest line of the target
+        # with the most lines waiting at this priority, if there is one
+        queue = self._queues[priority]
+        if not queue:
+            return False
+        target = max(queue, key=lambda t: len(queue[t]))
+        lines = queue[target]
+        lines.popleft()
+        if not lines:
+            del queue[target]
+        self._size -= 1
+        self.dropped[priority] += 1
+        return True
+
+    def put(self, target, line, priority=BROADCAST):
+        """Queues a line, and returns whether it was queued."""
+        with self.lock:
+            if self._size >= self.backlog:
+                if priority == BROADCAST or not self._drop_one(BROADCAST):
+                    self.dropped[priority] += 1
+                    return False
+            queue = self._queues[priority]
+            lines = queue.get(target)
+            if lines is None:
+                lines = queue[target] = deque()
+            lines.append(line)
+            self._size += 1
+            return True
+
+    def ready(self):
+        """Takes the (target, line)s that may be sent now off the queue."""
+        out = []
+        with self.lock:
+            self._refill(self.clock())
+            while self._size and self._tokens >= 1:
+                for queue in self._queues:
+                    if queue:
+                        break
+                # the target whose turn it is goes to the back of the line
+                target, lines = queue.popitem(last=False)
+                out.append((target, lines.popleft()))
+                if lines:
+                    queue[target] = lines
+                self._size -= 1
+                self._tokens -= 1
+            self.sent += len(out)
+        return out
+
+    def next_delay(self):
+        """Returns how long until the next line may be sent, or None if
+        nothing is waiting."""
+        with self.lock:
+            if not self._size:
+                return None
+            self._refill(self.clock())
+            return max((1 - self._tokens) / self.rate, 0)
+
+    def __len__(self):
+        with self.lock:
+            return self._size
+
+    def stats(self):
+        """Returns a dict with the number of lines waiting, sent, and dropped
+        (replies and broadcasts)."""
+        with self.lock:
+            return {
+                'queued': self._size,
+                'sent': self.sent,
+                'dropped_replies': self.dropped[REPLY],
+                'dropped_broadcasts': self.dropped[BROADCAST],
+            }
 
 class IRCPluginBot(IRCBot):
     def __init__(self, plugin, channels):
         IRCBot.__init__(self, [(plugin.server, plugin.port)], plugin.nick, plugin.nick)
         self.initial_channels = channels
         self.plugin = plugin
-        self.ratelimit = RateLimit()
     
     def on_nicknameinuse(self, c, e):
         c.nick(c.get_nickname() + "_")
@@ -47,6 +139,9 @@ class IRCPluginBot(IRCBot):
         for chan in self.initial_channels:
             c.join(chan)
         self.plugin.connected = True
+
+    def on_disconnect(self, c, e):
+        self.plugin.connected = False
     
     def strip_nonprintable(self, s):
         return ''.join([c for c in s if c in string.printable])
@@ -61,8 +156,7 @@ class IRCPluginBot(IRCBot):
         msg = e.arguments[0].strip()
         msg = self.strip_nonprintable(msg)
         def reply(msg):
-            self.ratelimit.call()
-            self.connection.privmsg(channel, msg)
+            self.plugin.send_line(channel, msg, REPLY)
         self.plugin.do_input([channel], e.source.nick, msg, False, reply)
     
     def do_command(self, source, channel, cmd):
@@ -70,11 +164,10 @@ class IRCPluginBot(IRCBot):
             return
         
         def reply(msg):
-            self.ratelimit.call()
             if channel == None:
-                self.connection.privmsg(source, msg)
+                self.plugin.send_line(source, msg, REPLY)
             else:
-                self.connection.privmsg(channel, ("%s: %s" % (source, msg)))
+                self.plugin.send_line(channel, "%s: %s" % (source, msg), REPLY)
         
         channels = []
         if channel != None:
@@ -101,12 +194,36 @@ class IRCPlugin(Plugin):
     to everyone, and plugins that respond to "admin" and will get messages only
     from admins.
 
+    Everything we say goes through an OutboundQueue, so reply() and
+    send_outgoing() never wait for the flood limits: send_rate lines a
+    second, in bursts of up to send_burst, with at most send_backlog lines
+    waiting. The defaults match the usual 5 lines per 10 seconds that
+    servers allow.
+
     """
 
-    @Plugin.config_types(server=str, port=int, nick=str, nickserv_password=str, channelmap=ET.Element, nickmap=ET.Element, quitmsgs=ET.Element)
-    def __init__(self, core, server='chat.freenode.net', port=6667, nick='hesperus', nickserv_password=None, channelmap=None, nickmap=None, quitmsgs=None):
+    # waits on the server socket in _wait(), so it can't share a thread,
+    # except with an event loop that watches readers() for us
+    dedicated_thread = True
+
+    @property
+    def loop_native(self):
+        # connecting (and reconnecting, from inside process_once()) looks up
+        # the server and waits for the TCP connect, so until we're connected
+        # an event loop has to run our steps in its executor
+        return self.connected
+
+    @Plugin.config_types(server=str, port=int, nick=str, nickserv_password=str, channelmap=ET.Element, nickmap=ET.Element, quitmsgs=ET.Element,
+            send_rate=float, send_burst=int, send_backlog=int)
+    def __init__(self, core, server='chat.freenode.net', port=6667, nick='hesperus', nickserv_password=None, channelmap=None, nickmap=None, quitmsgs=None,
+            send_rate=0.5, send_burst=5, send_backlog=100):
         
         super(IRCPlugin, self).__init__(core)
+
+        if send_rate <= 0 or send_burst < 1 or send_backlog < 1:
+            raise ConfigurationError('send_rate, send_burst and send_backlog must be positive')
+        self.outbound = OutboundQueue(send_rate, send_burst, send_backlog)
+        self._dropped_reported = 0
         
         self.server = server
         self.port = port
@@ -161,6 +278,11 @@ class IRCPlugin(Plugin):
         
         self.bot = IRCPluginBot(self, channels)
 
+        # written to by wake(), so that _wait() can select() on it alongside
+        # the IRC sockets. Opened when run() starts and closed in _finish(),
+        # so that stopped plugins (after a reload, say) don't keep them open
+        self._wake_recv = self._wake_send = None
+
     @property
     def connected(self):
         with self.lock:
@@ -171,6 +293,9 @@ class IRCPlugin(Plugin):
             self._connected = value
         
     def run(self):
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
         self.log_verbose("connecting...")
         # start() calls _connect() and then reactor.process_forever()... since
         # we want to be in control of the main loop, just call _connect() for
@@ -180,13 +305,53 @@ class IRCPlugin(Plugin):
         try:
             while True:
                 self.bot.reactor.process_once()
-                yield
+                self._send_ready()
+                # _wait() wakes us up as soon as the server sends something,
+                # this only bounds how late the reactor's scheduled tasks run
+                delay = self.outbound.next_delay() if self.connected else None
+                yield 1.0 if delay is None else min(delay, 1.0)
         finally:
             # Apparently, IRC servers only use your quit message if you've been
             # connected for more than 5 minutes (according to a comment in
             # irclib). No idea why.
             self.bot.disconnect(self.quitmsg)
     
+    def wake(self):
+        super(IRCPlugin, self).wake()
+        sender = self._wake_send
+        if sender is None:
+            return
+        try:
+            sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # the buffer is full, so we're already awake (or we're stopped,
+            # and it's closed)
+            pass
+
+    def _finish(self):
+        for sock in (self._wake_recv, self._wake_send):
+            if sock is not None:
+                sock.close()
+        self._wake_recv = self._wake_send = None
+        super(IRCPlugin, self)._finish()
+
+    def readers(self):
+        return list(self.bot.reactor.sockets)
+
+    def _wait(self, timeout):
+        sockets = self.readers()
+        if not sockets or self._wake_recv is None:
+            return super(IRCPlugin, self)._wait(timeout)
+
+        timeout = self._wait_seconds(timeout)
+        readable, _, _ = select.select(sockets + [self._wake_recv], [], [], timeout)
+        if self._wake_recv in readable:
+            try:
+                while self._wake_recv.recv(4096):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+
     @Plugin.queued
     def do_input(self, irc_channels, irc_nick, msg, direct, reply):
         chans = []
@@ -198,15 +363,32 @@ class IRCPlugin(Plugin):
             if irc_nick in self.nickmap[k] and not k in chans:
                 chans.append(k)
         
-        self.parent.handle_incoming(chans, irc_nick, msg, direct, reply)
+        self.parent.handle_message(Message(chans, irc_nick, msg, direct, reply))
     
-    @Plugin.queued
+    def send_line(self, target, msg, priority=BROADCAST):
+        """Queues a line for an IRC channel or nick, to be sent from our
+        thread as soon as the flood limits allow. Returns right away."""
+        if self.outbound.put(target, msg, priority):
+            self.wake()
+
+    def _send_ready(self):
+        # called in our thread: sends whatever the token bucket allows
+        if not self.connected:
+            return
+        for target, msg in self.outbound.ready():
+            try:
+                self.bot.connection.privmsg(target, msg)
+            except irc.client.ServerNotConnectedError:
+                self.log_warning("not connected, dropping line for", target)
+        dropped = sum(self.outbound.dropped)
+        if dropped > self._dropped_reported:
+            self.log_warning("outgoing backlog full, dropped %d lines" % (dropped - self._dropped_reported,))
+            self._dropped_reported = dropped
+
     def send_outgoing(self, chan, msg):
         if chan in self.chanmap:
             for irc_chan in self.chanmap[chan]:
-                self.bot.ratelimit.call()
-                self.bot.connection.privmsg(irc_chan, msg)
+                self.send_line(irc_chan, msg)
         if chan in self.nickmap:
             for irc_nick in self.nickmap[chan]:
-                self.bot.ratelimit.call()
-                self.bot.connection.privmsg(irc_nick, msg)
+                self.send_line(irc_nick, msg)
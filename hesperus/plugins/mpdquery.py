@@ -13,7 +13,7 @@ class MPDQuery(CommandPlugin):
         self.replypostfix = replypostfix
         self.notplaying = notplayingstr
 
-    @CommandPlugin.register_command("music")
+    @CommandPlugin.register_command("music", blocking=True, timeout=10)
     def music(self, chans, name, match, direct, reply):
         client = mpd.MPDClient()
         client.connect(self.mpdhost, self.mpdport)
@@ -0,0 +1,81 @@
+import os
+import time
+
+from ..plugin import CommandPlugin, ConfigurationError
+from ..profiler import Profiler
+
+class ProfilerPlugin(CommandPlugin):
+    """Profiles every plugin thread on demand, with "profile 30s" (or
+    "profile 2m", or just "profile" for the default duration). Put this on an
+    admin channel.
+
+    When it's done, it replies with the busiest plugins and functions, and
+    writes the full collapsed stacks (for flamegraph.pl or speedscope) to a
+    file in output_dir.
+
+    """
+    @CommandPlugin.config_types(rate=int, default_seconds=float, max_seconds=float, output_dir=str, top=int)
+    def __init__(self, core, rate=100, default_seconds=30, max_seconds=600, output_dir='.', top=5):
+        super(ProfilerPlugin, self).__init__(core)
+        if rate <= 0:
+            raise ConfigurationError('rate must be more than 0 samples a second')
+        self.rate = rate
+        self.default_seconds = default_seconds
+        self.max_seconds = max_seconds
+        self.output_dir = output_dir
+        self.top = top
+        self.profiler = None
+
+    @CommandPlugin.register_command(r"profile(?:\s+(\d+(?:\.\d+)?)\s*(s|sec|secs|seconds?|m|min|mins|minutes?)?)?")
+    def profile_command(self, chans, name, match, direct, reply):
+        if self.profiler is not None:
+            reply("I'm already profiling, hang on.")
+            return
+        seconds = self.default_seconds
+        if match.group(1):
+            seconds = float(match.group(1))
+            if match.group(2) and match.group(2).startswith('m'):
+                seconds *= 60
+        seconds = min(seconds, self.max_seconds)
+        if seconds <= 0:
+            reply("usage: profile [<n>s | <n>m], for more than 0 seconds")
+            return
+        if self.rate <= 0:
+            # the sampler waits 1 / rate seconds between samples
+            reply("Can't profile at %s samples a second, the rate must be more than 0." % (self.rate,))
+            return
+
+        self.profiler = Profiler(seconds, self.rate,
+                done=lambda profile: self.profile_done(profile, reply))
+        self.profiler.start()
+        reply("Profiling for %g seconds..." % (seconds,))
+
+    @CommandPlugin.queued
+    def profile_done(self, profile, reply):
+        self.profiler = None
+        if not profile.stacks:
+            reply("Nothing was busy while I was profiling.")
+            return
+
+        fname = os.path.join(self.output_dir, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        try:
+            with open(fname, 'w') as f:
+                f.write(profile.collapsed())
+        except OSError as e:
+            self.log_warning("could not write profile to %s: %s" % (fname, e))
+            fname = None
+
+        busy = sum(profile.stacks.values())
+        agents = ", ".join("%s %d%%" % (agent, 100 * n // busy)
+                for agent, n in profile.by_agent().most_common(self.top))
+        funcs = ", ".join("%s in %s (%d)" % (func, agent, n)
+                for agent, func, n in profile.top(self.top))
+        reply("%d samples, %d busy. Busiest: %s" % (profile.samples, busy, agents))
+        reply("Top functions: %s" % (funcs,))
+        if fname:
+            reply("Collapsed stacks written to %s" % (fname,))
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        super(ProfilerPlugin, self).stop()
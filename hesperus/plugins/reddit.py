@@ -95,17 +95,19 @@ class RedditPlugin(CommandPlugin):
             self.log_debug('error : {0}'.format(repr(e)))
             reply('no {0} today :('.format(name))
 
-    @CommandPlugin.register_command(r"reddit\s+(.+)")
+    @CommandPlugin.register_command(r"reddit\s+(.+)", blocking=True)
     def reddit(self, chans, name, match, direct, reply):
             self.do_command(match.group(1), reply)
 
     @CommandPlugin.register_command(r"(\S+)")
     def other_command(self, chans, name, match, direct, reply):
         cmd = match.group(1).lower()
-        if cmd in self.commands:
-            self.do_command(self.commands[cmd], reply)
-        else:
-            for reobj, name in self.matchers.items():
+        # this matches any word, so only go to the executor for real commands
+        subreddit = self.commands.get(cmd)
+        if subreddit is None:
+            for reobj, sub in self.matchers.items():
                 if reobj.match(cmd):
-                    self.do_command(name, reply)
+                    subreddit = sub
                     break
+        if subreddit is not None:
+            self.run_blocking(name, lambda reply: self.do_command(subreddit, reply), reply)
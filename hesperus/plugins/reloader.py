@@ -25,9 +25,14 @@ class Reloader(CommandPlugin):
                 raise ConfigurationError('skip must contain name tags')
             self.skip.add(el.text.strip())
 
+    def _plugins(self):
+        # the running plugins, and the crashed ones waiting to be restarted,
+        # which have to be unloaded too or the supervisor brings them back
+        return list(self.parent.plugins) + self.parent.supervisor.pending()
+
     @CommandPlugin.register_command(r"unload (\w+)")
     def unload(self, chans, name, match, direct, reply):
-        for plugin in self.parent.plugins:
+        for plugin in self._plugins():
             if plugin.__class__.__name__ == match.group(1):
                 self.parent.remove_plugin(plugin)
                 reply("%s unloaded" % match.group(1))
@@ -48,7 +53,7 @@ class Reloader(CommandPlugin):
             return
 
         # Get the set of current plugin names
-        loadedplugins = set(x.__class__.__name__ for x in list(self.parent.plugins))
+        loadedplugins = set(x.__class__.__name__ for x in self._plugins())
 
         if match.group(1):
             # A specific plugin was requested for reload
@@ -74,7 +79,7 @@ class Reloader(CommandPlugin):
         # Unload procedure
         oldircplugin = None
         foundunload = False
-        for plugin in list(self.parent.plugins):
+        for plugin in self._plugins():
 
             pluginname = plugin.__class__.__name__
 
@@ -153,6 +158,9 @@ class Reloader(CommandPlugin):
             while not ircplugin.connected:
                 time.sleep(0.5)
             oldircplugin.bot.connection = ircplugin.bot.connection
+            # and the old reply() functions queue their lines with the new
+            # plugin, which is the one that sends them
+            oldircplugin.send_line = ircplugin.send_line
             self.log_debug("IRC connected. Swapping connection object and proceeding to reply...")
             time.sleep(1)
 
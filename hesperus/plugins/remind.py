@@ -1,8 +1,21 @@
 from hesperus.plugin import CommandPlugin, PersistentPlugin
+from hesperus import timespec
+import heapq
 import time
-import re
 
 class RemindPlugin(CommandPlugin, PersistentPlugin):
+    """Passes messages on to people the next time they say something, once
+    the time given has passed.
+
+    Each reminder is kept under an id of its own. The reminders for each
+    person are kept in a heap ordered by when they are due, so checking
+    whether anything is due for someone who just spoke only looks at the
+    top of their heap, and is done before the line is even queued for us.
+    With deliver_when_due, reminders are also said in the channels they
+    were set in as soon as they are due, whether the person is around or
+    not.
+
+    """
     _USAGE = 'usage: remind <username> <message> ' \
         '[in|at|for <timespec>]'
     # haha suck it agrif
@@ -10,187 +23,233 @@ class RemindPlugin(CommandPlugin, PersistentPlugin):
         [1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, 610, 987, 1597, 2584]
     ]
 
-    compres = [
-              re.compile(r"^in (?P<timespec>(\d+ \w+?s? ?)+) (?P<action>.*?)$"),
-              re.compile(r"^(?P<action>.*) in (?P<timespec>(\d+ \w+?s? ?)+)$"),
-              ]
-
-    atres = [
-            re.compile(r"^at (?P<month>\w{3,4})[-/ ](?P<day>\d\d?)[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
-            re.compile(r"^at (?P<year>\d{4})[-/ ](?P<month>\w{3,4})[-/ ](?P<day>\d\d?)\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
-            re.compile(r"^at (?P<year>\d{4})[-/ ](?P<day>\d\d?)[-/ ](?P<month>\w{3,4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
-            re.compile(r"^at (?P<day>\d\d?)[-/ ](?P<month>\w{3,4})[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d) (?P<action>.*?)$"),
-            re.compile(r"^(?P<action>.*?) at (?P<month>\w{3,4})[-/ ](?P<day>\d\d?)[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
-            re.compile(r"^(?P<action>.*?) at (?P<year>\d{4})[-/ ](?P<month>\w{3,4})[-/ ](?P<day>\d\d?)\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
-            re.compile(r"^(?P<action>.*?) at (?P<year>\d{4})[-/ ](?P<day>\d\d?)[-/ ](?P<month>\w{3,4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$"),
-            re.compile(r"^(?P<action>.*?) at (?P<day>\d\d?)[-/ ](?P<month>\w{3,4})[-/ ](?P<year>\d{4})\D(?P<hour>\d\d?)\D(?P<min>\d\d)\D(?P<sec>\d\d)$")
-            ]
-
-    forres = [
-        re.compile(r'(?P<action>.*) for (?P<timespec>(\d+ \w+?s? ?)+)$'),
-        re.compile(r"^for (?P<timespec>(\d+ \w+?s? ?)+) (?P<action>.*?)$"),
-    ]
-
-    unit_map = {
-        "second": 1,
-        "sec": 1,
-        "min": 60,
-        "minute": 60,
-        "hour": 60*60,
-        "hr": 60*60,
-        "day": 60*60*24,
-        "week": 60*60*24*7,
-        "wk": 60*60*24*7,
-        "month": 60*60*24*30,
-        "year": 60*60*24*365,
-    }
-
     persistence_file = 'remind.json'
-    @CommandPlugin.config_types(min_delay=int)
-    def __init__(self, core, min_delay=300):
+    # reminders listed per page by the reminders command
+    page_size = 5
+
+    @CommandPlugin.config_types(min_delay=int, deliver_when_due=bool)
+    def __init__(self, core, min_delay=300, deliver_when_due=False):
         super(RemindPlugin, self).__init__(core)
         self._min_delay = min_delay
+        self.deliver_when_due = deliver_when_due
         self.load_data()
+        self._build_index()
+
+    #
+    # the index
+    #
+
+    def _build_index(self):
+        # target -> heap of (due, id), with stale entries left in until they
+        # reach the top
+        self._by_target = {}
+        # target -> when their first reminder is due, read by observe()
+        # in the core's thread, so only ever replaced item by item
+        self._next_due = {}
+        # (due, id) for every reminder, only kept for deliver_when_due
+        self._heap = []
+        self._last_id = max([int(k) for k in self._data if k.isdigit()] or [0])
+        for key in list(self._data):
+            value = self._data[key]
+            if isinstance(value, list):
+                # reminders used to be kept in a list per target
+                del self._data[key]
+                self.save_data(key)
+                for notice in value:
+                    self._add(notice)
+            else:
+                self._index(key, value)
+
+    def _due(self, notice):
+        return notice['time'] + notice['delay']
+
+    def _valid(self, due, rid):
+        notice = self._data.get(rid)
+        return notice is not None and self._due(notice) == due
+
+    def _add(self, notice):
+        self._last_id += 1
+        rid = str(self._last_id)
+        self._data[rid] = notice
+        self._index(rid, notice)
+        self.save_data(rid)
+        return rid
+
+    def _index(self, rid, notice):
+        due = self._due(notice)
+        target = notice['target']
+        heapq.heappush(self._by_target.setdefault(target, []), (due, rid))
+        self._refresh(target)
+        if self.deliver_when_due:
+            earlier = not self._heap or due < self._heap[0][0]
+            heapq.heappush(self._heap, (due, rid))
+            if earlier:
+                # run() is waiting for a later one
+                self.wake()
+
+    def _refresh(self, target):
+        # drops stale entries off the top of target's heap, and updates
+        # _next_due to match
+        heap = self._by_target.get(target)
+        while heap and not self._valid(*heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            self._next_due[target] = heap[0][0]
+        else:
+            self._by_target.pop(target, None)
+            self._next_due.pop(target, None)
+
+    def _take_due(self, target, now):
+        heap = self._by_target.get(target)
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if self._valid(*entry):
+                due.append(entry[1])
+        self._refresh(target)
+        return due
+
+    def _deliver(self, rid, now, say):
+        notice = self._data[rid]
+        say('{target}, {source} reminds you "{message}" ({ago} ago)'.format(
+            ago=self._span(now - notice['time']), **notice))
+        later = [d for d in notice.get('later', []) if d > now - notice['time']]
+        if later:
+            notice['delay'] = later[0]
+            notice['later'] = later[1:]
+            self._index(rid, notice)
+        else:
+            del self._data[rid]
+            self._refresh(notice['target'])
+        self.save_data(rid)
+
+    def _span(self, diff):
+        w = diff // timespec.WEEK
+        d = (diff % timespec.WEEK) // timespec.DAY
+        h = (diff % timespec.DAY) // timespec.HOUR
+        m = (diff % timespec.HOUR) // timespec.MINUTE
+
+        span = '%02dm' % m
+        if (w+d+h) > 0:
+            span = ('%02dh' % h) + span
+        if (w+d) > 0:
+            span = ('%02dd' % d) + span
+        if w > 0:
+            span = ('%02dw' % w) + span
+        return span
+
+    #
+    # commands
+    #
 
     @CommandPlugin.register_command(r"remind(?:\s+(?P<target>[^ ]+))?(?:\s+(?P<message_with_timespec>.*?))?")
     def remind_command(self, chans, name, match, direct, reply):
         parts = match.groupdict()
-        self.log_debug(match.group(0) + repr(match.groupdict()))
+        self.log_debug(match.group(0), parts)
         if not parts['target'] or not parts['message_with_timespec']:
             reply(self._USAGE)
             return
         if parts['target'].lower() == 'me':
             parts['target'] = name
 
-        if self._add_notice(source=name, **parts):
+        try:
+            added = self._add_notice(source=name, channels=chans, **parts)
+        except timespec.TimespecError as e:
+            reply('I can\'t read that time: {}'.format(e))
+            return
+        if added:
             reply('Reminder for {} saved.'.format(parts['target']))
         else:
             reply('Reminder not saved, use a longer delay (min is %d seconds).' % self._min_delay)
 
-    @CommandPlugin.register_command(r'reminders')
+    @CommandPlugin.register_command(r'reminders(?:\s+(?P<who>[^\d\s]\S*))?(?:\s+(?P<page>\d+))?')
     def reminders_command(self, chans, name, match, direct, reply):
-        reply(repr(self._data))
-
-    def _add_notice(self, source, target, message_with_timespec):
+        who = match.group('who')
+        page = max(int(match.group('page') or 1), 1)
+        if who is None:
+            pending = [(self._due(n), rid) for rid, n in self._data.items()]
+        else:
+            target = (name if who.lower() == 'me' else who).lower()
+            pending = [e for e in self._by_target.get(target, []) if self._valid(*e)]
+        if not pending:
+            reply('No reminders waiting.')
+            return
+        pending.sort(key=lambda e: (e[0], int(e[1])))
+        pages = (len(pending) + self.page_size - 1) // self.page_size
+        page = min(page, pages)
+        now = int(time.time())
+        for due, rid in pending[(page - 1) * self.page_size:page * self.page_size]:
+            notice = self._data[rid]
+            when = 'in ' + self._span(due - now) if due > now else 'now'
+            reply('#{rid} for {target} from {source}, due {when}: "{message}"'.format(
+                rid=rid, when=when, **notice))
+        if pages > 1:
+            more = ' {}'.format(who) if who else ''
+            reply('page {} of {}, "reminders{} <page>" for more'.format(page, pages, more))
+
+    def _add_notice(self, source, target, message_with_timespec, channels=()):
         target = target.lower()
-        if target not in self._data:
-            self._data[target] = []
         now = int(time.time())
 
-        delay, message = self._parse_and_extract(message_with_timespec)
-        if delay is not None and delay < 0:
-            delay = abs(delay + now)
+        spec = timespec.parse(message_with_timespec, now)
+        notice = {
+            'target': target,
+            'source': source,
+            'message': spec.action,
+            'time': now,
+            'channels': sorted(channels),
+        }
+        if spec.kind == timespec.RECURRING:
+            # a reminder every fibonacci days, up to the first at or after
+            # the end of the time given
+            delays = []
             for d in self.FIBONACCI_SEQ:
-                if d < delay:
-                    self._data[target].append({
-                        'target': target,
-                        'source': source,
-                        'message': message,
-                        'time': now,
-                        'delay': d,
-                    })
-                else:
+                delays.append(d)
+                if d >= spec.seconds:
                     break
-            self._data[target].append({
-                'target': target,
-                'source': source,
-                'message': message,
-                'time': now,
-                'delay': d,
-            })
+            notice['delay'] = delays[0]
+            notice['later'] = delays[1:]
+        elif spec.kind is None:
+            notice['delay'] = self._min_delay
         else:
-            if delay is None:
-                delay = self._min_delay
-            else:
-                delay = delay - now
-
-            self._data[target].append({
-                'target': target,
-                'source': source,
-                'message': message,
-                'time': now,
-                'delay': delay,
-            })
-        self.save_data()
+            notice['delay'] = int(spec.when) - now
+        self._add(notice)
         return True
 
-    def _parse_and_extract(self, string):
-        now = int(time.time())
-        for regex in self.forres:
-            m = regex.match(string)
-            if m:
-                timespec = m.group('timespec').split(' ')
-                action = m.group('action')
-                val = 0
-                for x in range(0, len(timespec), 2):
-                    num = int(timespec[x])
-                    unit = timespec[x+1]
-                    if unit.endswith("s"):
-                        unit = unit[:-1]
-                    val += self.unit_map[unit] * num
-                return (-(now+val), action)
-
-        for regex in self.compres:
-            m = regex.match(string)
-            if m:
-                timespec = m.group("timespec").split(" ")
-                action = m.group("action")
-                val = 0
-                for x in range(0, len(timespec), 2):
-                    num = int(timespec[x])
-                    unit = timespec[x+1]
-                    if unit.endswith("s"):
-                        unit = unit[:-1]
-                    val += self.unit_map[unit] * num
-                return (now+val, action)
-
-        for regex in self.atres:
-            m = regex.match(string)
-            if m:
-                ts = time.strptime("%s %s %s %s %s %s" % m.group("year", "month", "day", "hour", "min", "sec"),
-                        "%Y %b %d %H %M %S")
-                return int(time.mktime(ts)), m.group("action")
-
-        # if still no match, assume no timespec
-        return (None, string)
-
     @CommandPlugin.queued
     def remind_check(self, name, reply):
         now = int(time.time())
-        name = name.lower()
-        if name in self._data:
-            to_del = []
-            for i, notice in enumerate(self._data[name]):
-                diff = now - notice['time']
-                if diff >= notice['delay']:
-                    w = diff / self.unit_map['week']
-                    d = (diff % self.unit_map['week']) / self.unit_map['day']
-                    h = (diff % self.unit_map['day']) / self.unit_map['hour']
-                    m = (diff % self.unit_map['hour']) / self.unit_map['minute']
-
-                    ago = '%02dm' % m                    
-                    if (w+d+h) > 0:
-                        ago = ('%02dh' % h) + ago
-                    if (w+d) > 0:
-                        ago = ('%02dd' % d) + ago
-                    if w > 0:
-                        ago = ('%02dw' % w) + ago
-
-                    reply('{target}, {source} reminds you "{message}" ({ago} ago)'.format(
-                        ago=ago, **notice))
-                    to_del.append(i)
-            if to_del:
-                for i in to_del[::-1]:
-                    try:
-                        del self._data[name][i]
-                    except IndexError:
-                        self.log_warning('Failed to delete message #%d for %s' % (i, name))
-                self.save_data()
-            if not self._data[name]:
-                del self._data[name]
-                self.save_data()
-
-    def handle_incoming(self, chans, name, msg, direct, reply):
-        super(RemindPlugin, self).handle_incoming(chans, name, msg, direct, reply)
-        if not direct:
-            self.remind_check(name, reply)
+        for rid in self._take_due(name.lower(), now):
+            self._deliver(rid, now, reply)
+
+    def run(self):
+        if not self.deliver_when_due:
+            for timeout in super(RemindPlugin, self).run():
+                yield timeout
+            return
+        while True:
+            now = int(time.time())
+            while self._heap and self._heap[0][0] <= now:
+                due, rid = heapq.heappop(self._heap)
+                if not self._valid(due, rid):
+                    continue
+                channels = self._data[rid].get('channels')
+                if not channels:
+                    # nowhere to say it, so wait for them to show up
+                    continue
+                def say(msg):
+                    for chan in channels:
+                        self.parent.send_outgoing(chan, msg)
+                self._deliver(rid, now, say)
+            # stale entries only make us wake up early
+            yield max(self._heap[0][0] - time.time(), 0) if self._heap else self.forever
+
+    def observe(self, message):
+        # any line could be from someone with a reminder waiting
+        if message.direct or message.nick is None:
+            return
+        # checked here, in the core's thread, so lines from people with
+        # nothing due aren't queued for us at all
+        due = self._next_due.get(message.nick.lower())
+        if due is not None and due <= time.time():
+            self.remind_check(message.nick, self.metrics.counting_reply(message.reply))
@@ -5,6 +5,7 @@ import feedparser
 
 from ..plugin import PollPlugin
 from ..shorturl import short_url
+from .. import executor
 from ..core import ET, ConfigurationError
 
 class Feed(object):
@@ -12,11 +13,19 @@ class Feed(object):
         self.url = url
         self.formatstr = formatstr
 
-        # Go ahead and fetch the feed so we can see what entries are already there
+        # set by warm_up(), or by the first get_new_events() if that comes
+        # first
+        self.seen_entries = None
+
+    def warm_up(self):
+        """Fetch the feed so we can see what entries are already there."""
         feedobj = self._fetch()
-        self.seen_entries = set(
-                e.id if hasattr(e, 'id') else e.published for e in feedobj.entries
-                )
+        seen = set(self._key(e) for e in feedobj.entries)
+        if self.seen_entries is None:
+            self.seen_entries = seen
+
+    def _key(self, entry):
+        return entry.id if hasattr(entry, 'id') else entry.published
 
     def _fetch(self):
         feedobj = feedparser.parse(self.url)
@@ -39,10 +48,15 @@ class Feed(object):
         this feed
 
         """
+        if self.seen_entries is None:
+            # the initial fetch hasn't happened yet, so everything is old
+            self.warm_up()
+            return
+
         feedobj = self._fetch()
 
         for entry in feedobj.entries:
-            key = entry.id if hasattr(entry, 'id') else entry.published
+            key = self._key(entry)
             if key not in self.seen_entries:
                 self.seen_entries.add(key)
                 yield self._format_entry(feedobj.feed, entry)
@@ -84,7 +98,14 @@ class RSSWatcher(PollPlugin):
     </plugin>
 
     """
+    # poll() fetches the feeds itself, so it gets a thread (or a slot in the
+    # asyncio runtime's executor) of its own
+    dedicated_thread = True
     poll_interval = 60
+    # spread out the fetches of many watchers
+    poll_jitter = 0.1
+    # fetch up to four feeds at once when warming up
+    blocking_limit = 4
     ratelimit = 5
 
     @PollPlugin.config_types(feeds=ET.Element)
@@ -115,12 +136,17 @@ class RSSWatcher(PollPlugin):
                     (Feed(url, formatstr), channels)
                     )
 
+    def warm_up(self):
+        # fetch the feeds side by side
+        for feedobj, channels in self.feeds:
+            executor.shared().submit(self, feedobj.url, feedobj.warm_up)
+
     def poll(self):
         for feedobj, channels in self.feeds:
             for responsestr in feedobj.get_new_events():
                 for chan in channels:
                     while time.time() < self.last_msg + self.ratelimit:
-                        yield
+                        yield self.last_msg + self.ratelimit - time.time()
                     self.parent.send_outgoing(chan, responsestr)
                     self.last_msg = time.time()
                     yield
@@ -1,48 +1,284 @@
-from hesperus.plugin import CommandPlugin
-from datetime import datetime
+from hesperus.plugin import CommandPlugin, PersistentPlugin
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+import json
+import sys
+import time
 
-class SeenPlugin(CommandPlugin):
-    def __init__(self, core):
+class SeenTable(object):
+    """When each nick was last seen, in which channel, and what they said.
+
+    Nicks are case-folded and interned, and each gets a slot in a few
+    parallel arrays: the time (in seconds since the epoch) they were last
+    seen anywhere, the channel it was in, and one array of times per
+    channel. At most max_nicks nicks are kept; past that, the tenth that
+    were seen longest ago are dropped. The text of their last line is kept,
+    up to max_text characters of it.
+
+    The folded nicks changed and dropped since the last take_changes() are
+    kept track of, so they can be saved a few at a time.
+
+    """
+    def __init__(self, max_nicks=100000, max_text=200):
+        self.max_nicks = max(max_nicks, 1)
+        self.max_text = max_text
+        # folded nick -> slot, and slot -> folded nick
+        self._slots = {}
+        self._keys = []
+        # slot -> the nick as it was last written, and their last line
+        self._nicks = []
+        self._texts = []
+        self._times = array('q')
+        # slot -> number of the channel they were last seen in, or -1
+        self._last_chan = array('i')
+        # channel numbers, and channel number -> array of times by slot (0
+        # for never)
+        self._chans = []
+        self._chan_numbers = {}
+        self._chan_times = []
+        self.changed = set()
+        self.removed = set()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _fold(self, nick):
+        return sys.intern(nick.casefold())
+
+    def _chan_number(self, chan):
+        number = self._chan_numbers.get(chan)
+        if number is None:
+            number = self._chan_numbers[chan] = len(self._chans)
+            self._chans.append(chan)
+            self._chan_times.append(array('q', bytes(8 * len(self._keys))))
+        return number
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        if len(self._keys) >= self.max_nicks:
+            self._evict()
+        slot = self._slots[key] = len(self._keys)
+        self._keys.append(key)
+        self._nicks.append(None)
+        self._texts.append(None)
+        self._times.append(0)
+        self._last_chan.append(-1)
+        for times in self._chan_times:
+            times.append(0)
+        return slot
+
+    def _evict(self):
+        # keep the nine tenths seen most recently (newer slots win ties), in
+        # the order they were first seen
+        keep = self.max_nicks * 9 // 10
+        times = self._times
+        slots = sorted(range(len(self._keys)), key=lambda s: (times[s], s), reverse=True)
+        dropped = slots[keep:]
+        slots = sorted(slots[:keep])
+        for slot in dropped:
+            key = self._keys[slot]
+            self.changed.discard(key)
+            self.removed.add(key)
+        self.evicted += len(dropped)
+        self._keys = [self._keys[s] for s in slots]
+        self._nicks = [self._nicks[s] for s in slots]
+        self._texts = [self._texts[s] for s in slots]
+        self._times = array('q', [times[s] for s in slots])
+        self._last_chan = array('i', [self._last_chan[s] for s in slots])
+        self._chan_times = [array('q', [ct[s] for s in slots]) for ct in self._chan_times]
+        self._slots = dict((key, i) for i, key in enumerate(self._keys))
+
+    def update(self, nick, channels, text, when):
+        key = self._fold(nick)
+        slot = self._slot(key)
+        self._nicks[slot] = nick
+        self._texts[slot] = text[:self.max_text] if text is not None else None
+        self._times[slot] = when
+        last = -1
+        for chan in sorted(channels):
+            last = self._chan_number(chan)
+            self._chan_times[last][slot] = when
+        self._last_chan[slot] = last
+        self.changed.add(key)
+        self.removed.discard(key)
+
+    def lookup(self, nick, chan=None):
+        """Returns (nick, time, channel, text) for when nick was last seen
+        (in chan, if given), or None. The channel and text are for their
+        last line anywhere."""
+        slot = self._slots.get(self._fold(nick))
+        if slot is None:
+            return None
+        when = self._times[slot]
+        if chan is not None:
+            number = self._chan_numbers.get(chan)
+            when = self._chan_times[number][slot] if number is not None else 0
+            if not when:
+                return None
+        last = self._last_chan[slot]
+        return (self._nicks[slot], when, self._chans[last] if last >= 0 else None,
+                self._texts[slot])
+
+    #
+    # saving and loading
+    #
+
+    def row(self, key):
+        """The JSON saved for a folded nick."""
+        slot = self._slots[key]
+        last = self._last_chan[slot]
+        chans = dict((chan, self._chan_times[n][slot]) for n, chan in enumerate(self._chans)
+                if self._chan_times[n][slot])
+        return json.dumps([self._nicks[slot], self._times[slot],
+                self._chans[last] if last >= 0 else None, self._texts[slot], chans])
+
+    def load(self, key, row):
+        """Puts back what row() saved, without counting it as a change."""
+        nick, when, last, text, chans = row
+        slot = self._slot(sys.intern(key))
+        self._nicks[slot] = nick
+        self._texts[slot] = text
+        self._times[slot] = when
+        for chan, chan_when in chans.items():
+            self._chan_times[self._chan_number(chan)][slot] = chan_when
+        self._last_chan[slot] = self._chan_number(last) if last is not None else -1
+
+    def take_changes(self):
+        """Returns ([(folded nick, JSON)], [folded nicks dropped]) for
+        everything since the last call."""
+        puts = [(key, self.row(key)) for key in self.changed]
+        removed = list(self.removed)
+        self.changed = set()
+        self.removed = set()
+        return puts, removed
+
+class SeenPlugin(CommandPlugin, PersistentPlugin):
+    """Remembers when everyone was last seen, and where, and what they said.
+
+    Lines are noted down in the core's thread and added to the table in
+    batches, at most every batch_interval seconds. The nicks seen since the
+    last save are written to the shared store every persist_interval
+    seconds, and read back when the plugin starts.
+
+    """
+    persistence_namespace = 'seen'
+    persist_interval = 30.0
+    # how long lines wait to be added to the table
+    batch_interval = 1.0
+
+    # the key the time we started watching is kept under; nicks can't have
+    # spaces
+    _SINCE = ' since'
+
+    @CommandPlugin.config_types(max_nicks=int, max_text=int)
+    def __init__(self, core, max_nicks=100000, max_text=200):
         super(SeenPlugin, self).__init__(core)
-        self.times = {}
-        self.starttime = datetime.utcnow()
-    
+        self.seen = SeenTable(max_nicks, max_text)
+        # (nick, channels, text, time) waiting to go in the table
+        self._pending = deque()
+        self._batch_armed = False
+        self.since = None
+        self.load_data()
+
+    def load_data(self):
+        start = time.time()
+        try:
+            for key, row in self.store.items():
+                if key == self._SINCE:
+                    self.since = row
+                else:
+                    self.seen.load(key, row)
+        except ValueError as e:
+            self.log_warning('Error while loading seen data: {err}'.format(err=e))
+        if self.since is None:
+            self.since = int(time.time())
+            self.store.put(self._SINCE, self.since)
+        self.log_debug('loaded %d nicks in %.2f seconds' % (len(self.seen), time.time() - start))
+
+    def _snapshot(self):
+        # only the nicks seen since the last snapshot are written
+        self._apply_pending()
+        self._persist_dirty = set()
+        puts, deletes = self.seen.take_changes()
+        if not puts and not deletes:
+            return False
+        with self._persist_lock:
+            self._persist_pending.append((puts, deletes))
+        return True
+
+    def _apply_pending(self):
+        # called in our thread
+        self._batch_armed = False
+        pending = self._pending
+        if not pending:
+            return
+        update = self.seen.update
+        while pending:
+            update(*pending.popleft())
+        self.save_data()
+
+    def run(self):
+        while True:
+            self._apply_pending()
+            yield self.forever
+
+    def observe(self, message):
+        # every line counts
+        if message.nick is None:
+            return
+        self._pending.append((message.nick, message.channels, message.text, int(message.timestamp)))
+        if not self._batch_armed:
+            self._batch_armed = True
+            wheel = getattr(self.parent, 'timers', None)
+            if wheel is None:
+                self.wake()
+            else:
+                wheel.schedule_in(self.batch_interval, self.wake)
+
     @CommandPlugin.register_command(r"(seen|lastseen)(?:\s+(.*?))?(?:\?)?")
     def seen_command(self, chans, name, match, direct, reply):
         cmd = match.group(1)
         target = match.group(2)
-        
+
         if not target:
-            reply("usage: %s <username>" % (cmd,))
+            reply("usage: %s <username> [in <channel>]" % (cmd,))
             return
-        
-        def fmtdate(d):
-            now = datetime.utcnow()
-            delta = now - d
-            delta = delta.seconds + delta.days * 24 * 60 * 60
+        chan = None
+        parts = target.split()
+        if len(parts) == 3 and parts[1] == 'in':
+            target, chan = parts[0], parts[2]
+
+        def fmtdate(t):
+            d = datetime.fromtimestamp(t, timezone.utc)
+            delta = int(time.time() - t)
             if delta > 60 * 60 * 24 * 7:
                 return d.strftime("on %B %d, %Y")
             elif delta > 60 * 60 * 24:
-                delta /= 60 * 60 * 24
+                delta //= 60 * 60 * 24
                 return "%i day%s ago, on %s" % (delta, '' if delta == 1 else 's', d.strftime("%A, %B %d"))
             elif delta > 60 * 60:
-                delta /= 60 * 60
+                delta //= 60 * 60
                 return "%i hour%s ago" % (delta, '' if delta == 1 else 's')
             elif delta > 60:
-                delta /= 60
+                delta //= 60
                 return "%i minute%s ago" % (delta, '' if delta == 1 else 's')
-            
+
             return "%i seconds ago" % (delta,)
-        
-        if not target in self.times:
-            reply("%s has not been seen since I started watching %s." % (target, fmtdate(self.starttime)))
-        else:
-            reply("%s was last seen %s." % (target, fmtdate(self.times[target])))
-    
-    @CommandPlugin.queued
-    def update_seen(self, name):
-        self.times[name] = datetime.utcnow()
-    
-    def handle_incoming(self, chans, name, msg, direct, reply):
-        super(SeenPlugin, self).handle_incoming(chans, name, msg, direct, reply)
-        self.update_seen(name)
+
+        self._apply_pending()
+        found = self.seen.lookup(target, chan)
+        where = " in %s" % (chan,) if chan else ""
+        if found is None:
+            reply("%s has not been seen%s since I started watching %s." % (target, where, fmtdate(self.since)))
+            return
+        nick, when, last_chan, text = found
+        if chan is None and last_chan is not None:
+            where = " in %s" % (last_chan,)
+        msg = "%s was last seen%s %s" % (nick, where, fmtdate(when))
+        if text and (chan is None or chan == last_chan):
+            msg += ', saying "%s"' % (text,)
+        reply(msg + ".")
@@ -3,11 +3,11 @@ from packagetrack.carriers.errors import *
 from packagetrack.configuration import DotFileConfig
 import time
 import datetime
-import json
 import random
 import traceback
 import requests
 from ..plugin import PollPlugin, CommandPlugin
+from .. import storage
 from ..shorturl import short_url
 from .hesperus_irc import IRCPlugin
 from .evenames import EveGenerator
@@ -26,15 +26,31 @@ class FallbackGenerator(object):
         return tn
 
 class PackageTracker(CommandPlugin, PollPlugin):
+    # poll() asks the carriers' sites itself, so it gets a thread (or a slot
+    # in the asyncio runtime's executor) of its own
+    dedicated_thread = True
+
     @CommandPlugin.config_types(persist_file=str, auth_file=str, retry_period=int, eve_data=str)
     def __init__(self, core, persist_file='shipping-following.json', auth_file=None, retry_period=24, eve_data=None):
         super(PackageTracker, self).__init__(core)
-        self._persist_file = persist_file
-        self._data = {}
+        # tracking number -> what we know about the package. Unlike the
+        # PersistentPlugins, this writes to the store directly instead of on
+        # the storage writer: a write is at most one per command or changed
+        # package, the replies and the next poll read back what was just
+        # written, and this runs on a thread of its own anyway (see
+        # dedicated_thread)
+        self._packages = storage.namespace('shipping')
+        self._packages.add_index('owner', lambda data: data['owner'])
+        try:
+            self._packages.import_json(persist_file)
+        except ValueError as e:
+            self.log_warning('could not import %s: %s' % (persist_file, e))
+        # how many packages are watched, for poll_interval, so it doesn't
+        # ask the database every time
+        self._count = len(self._packages)
         self._unready_data = {}
         self._retry_period = retry_period
-        packagetrack.auto_register_carriers(DotFileConfig(auth_file))
-        self.load_data()
+        self._auth_file = auth_file
         if eve_data:
             try:
                 self._tag_generator = EveGenerator(eve_data)
@@ -52,10 +68,11 @@ class PackageTracker(CommandPlugin, PollPlugin):
     def track_command(self, chans, name, match, direct, reply):
         if match.group(1):
             tn = match.group(1)
-            if tn in self._data.keys():
-                if name == self._data[tn]['owner'] or 'admin' in chans:
-                    del self._data[tn]
-                    self.save_data()
+            data = self._packages.get(tn)
+            if data is not None:
+                if name == data['owner'] or 'admin' in chans:
+                    self._packages.delete(tn)
+                    self._packages_changed()
                     reply('WELL FINE THEN, I won\'t tell you about that package anymore')
                 else:
                     reply('You can\'t tell me what to do, you\'re not even my real dad!')
@@ -77,12 +94,12 @@ class PackageTracker(CommandPlugin, PollPlugin):
                     data = {
                         'tag': match.group(2) if match.group(2) else self._tag_generator.generate(tn),
                         'owner': name,
-                        'channels': chans,
+                        'channels': list(chans),
                         'direct': direct,
                         'last_update': int(time.time())
                     }
                     self._unready_data[tn] = data
-                    self.log_debug('Unready package: %s' % err)
+                    self.log_debug('Unready package:', err)
                     reply('{p.carrier} doesn\'t know about "{d[tag]}" yet but I\'ll keep an eye on it ' \
                         'for {0} hours and let you know if they find it'.format(
                             self._retry_period, p=package, d=data))
@@ -93,16 +110,16 @@ class PackageTracker(CommandPlugin, PollPlugin):
                         data = {
                             'tag': match.group(2) if match.group(2) else self._tag_generator.generate(tn),
                             'owner': name,
-                            'channels': chans,
+                            'channels': list(chans),
                             'direct': direct,
                             'last_update': int(time.mktime(state.last_update.timetuple()))
                         }
-                        self._data[tn] = data
-                        self.save_data()
+                        self._packages.put(tn, data)
+                        self._packages_changed()
                         reply('"{tag}" is at "{state}" now, I\'ll let you know when it changes'.format(
                             state=state.status, tag=data['tag']))
         else:
-            packages = [self.get_package(tn) for tn in self._data.keys() if self._data[tn]['owner'] == name]
+            packages = [self.get_package(tn) for tn, data in self._packages.find('owner', name)]
             if packages:
                 for package in packages:
                     self.output_status(package)
@@ -114,7 +131,7 @@ class PackageTracker(CommandPlugin, PollPlugin):
         expired = {}
         found = {}
         for (tn, data) in self._unready_data.items():
-            self.log_debug('checking updates for tn/data: {}/{}'.format(tn,data))
+            self.log_debug('checking updates for tn/data:', tn, data)
             package = self.get_package(tn)
             try:
                 new_state = package.track()
@@ -127,15 +144,15 @@ class PackageTracker(CommandPlugin, PollPlugin):
                 found[tn] = data
             yield
         for (tn, data) in found.items():
-            self.log_debug('sending message for updated tn/data: {}/{}'.format(tn,data))
+            self.log_debug('sending message for updated tn/data:', tn, data)
             package = self.get_package(tn)
             self._raw_message(None,
                 '{d[owner]}: {p.carrier} seems to have found your "{d[tag]}", I\'ll watch it for updates now'.format(
                     d=data, p=package))
-            self._data[tn] = data
+            self._packages.put(tn, data)
             del self._unready_data[tn]
         for (tn, data) in expired.items():
-            self.log_debug('sending message for expired tn/data: {}/{}'.format(tn,data))
+            self.log_debug('sending message for expired tn/data:', tn, data)
             package = self.get_package(tn)
             self._raw_message(None,
                 '{d[owner]}: {p.carrier} hasn\'t found your "{d[tag]}" yet so I\'m dropping it'.format(
@@ -143,8 +160,8 @@ class PackageTracker(CommandPlugin, PollPlugin):
             del self._unready_data[tn]
 
         delivered = []
-        for (tn, data) in self._data.items():
-            self.log_debug('sending message for delivered tn/data: {}/{}'.format(tn,data))
+        for (tn, data) in self._packages.items():
+            self.log_debug('sending message for delivered tn/data:', tn, data)
             package = self.get_package(tn)
             try:
                 new_state = package.track()
@@ -155,19 +172,27 @@ class PackageTracker(CommandPlugin, PollPlugin):
             if new_state.is_delivered:
                 delivered.append(tn)
             if data['last_update'] < new_update:
-                self._data[tn]['last_update'] = new_update
-                self.save_data()
+                data['last_update'] = new_update
+                self._packages.put(tn, data)
                 self.output_status(package)
             yield
-        for tn in delivered:
-            del self._data[tn]
-        self.save_data()
+        with self._packages.batch():
+            for tn in delivered:
+                self._packages.delete(tn)
+        if found or delivered:
+            # the next poll is scheduled once this one is over, and reads it
+            self._count = len(self._packages)
+
+    def _packages_changed(self):
+        # called after packages are added or removed
+        self._count = len(self._packages)
+        self.reschedule_poll()
 
     def output_status(self, package):
-        self.log_debug('sending status for tn: {}'.format(package.tracking_number))
+        self.log_debug('sending status for tn:', package.tracking_number)
         try:
             state = package.track()
-            data = self._data[package.tracking_number]
+            data = self._packages[package.tracking_number]
         except Exception:
             traceback.print_exc()
             return
@@ -208,28 +233,22 @@ class PackageTracker(CommandPlugin, PollPlugin):
     @property
     def poll_interval(self):
         base_interval = 300
-        return base_interval if len(self._data) < 2 else (base_interval / len(self._data))
-
-    def save_data(self):
-        self.log_debug('saving state')
-        with open(self._persist_file, 'wb') as pf:
-            json.dump(self._data, pf, indent=4)
-
-    def load_data(self):
-        self.log_debug('loading state')
-        try:
-            with open(self._persist_file, 'rb') as pf:
-                self._data.update(json.load(pf))
-        except (IOError, ValueError):
-            pass
+        count = self._count
+        return base_interval if count < 2 else (base_interval / count)
 
     def get_package(self, tn):
         return packagetrack.Package(tn)
 
+    def warm_up(self):
+        packagetrack.auto_register_carriers(DotFileConfig(self._auth_file))
+
 class PackageStatus(CommandPlugin):
     def __init__(self, core, auth_file=None):
         super(PackageStatus, self).__init__(core)
-        packagetrack.auto_register_carriers(DotFileConfig(auth_file))
+        self._auth_file = auth_file
+
+    def warm_up(self):
+        packagetrack.auto_register_carriers(DotFileConfig(self._auth_file))
 
     @CommandPlugin.register_command(r"pstatus(?:\s+([\w\d]+))?")
     def status_command(self, chans, name, match, direct, reply):
@@ -1,22 +1,22 @@
-from hesperus.plugin import CommandPlugin
+from hesperus.plugin import CommandPlugin, PersistentPlugin
 import re
-import json
 import random
 
-class SnippetPlugin(CommandPlugin):
-    _data = {}
+class SnippetPlugin(CommandPlugin, PersistentPlugin):
+    persistence_namespace = 'snippets'
 
     @CommandPlugin.config_types(persist_file=str)
-    def __init__(self, core, persist_file):
+    def __init__(self, core, persist_file='snippets.json'):
         super(SnippetPlugin, self).__init__(core)
-        self._persist_file = persist_file
+        # only read the first time, to import the snippets saved there
+        self.persistence_file = persist_file
         self.load_data()
 
     @CommandPlugin.register_command(r'snip(?:pet)?\s+(\w+)(?:\s+(.*))?')
     def snippet_command(self, chans, name, match, direct, reply):
         if match.group(2):
             self._data[match.group(1)] = (name, match.group(2))
-            self.save_data()
+            self.save_data(match.group(1))
             reply('Today I learned about "{thing}"'.format(thing=match.group(1)))
         else:
             try:
@@ -26,27 +26,15 @@ class SnippetPlugin(CommandPlugin):
                 if key == 'list':
                     reply('I know these things: {snippets}'.format(snippets=', '.join(self._data.keys())))
                 elif key == 'save':
-                    self.save_data()
+                    self.flush_data()
                     reply('Sure, let me just find a pen')
                 elif key == 'reload':
                     self.load_data()
                     reply('Getting a sense of deja vu here...')
                 elif key == 'random':
                     reply('"{snippet[1]}" -- {snippet[0]}'.format(
-                        snippet=self._data[self._data.keys()[random.randint(0,len(self._data)-1)]]))
+                        snippet=random.choice(list(self._data.values()))))
                 else:
                     reply('I don\'t know anything about "{thing}"'.format(thing=key))
             else:
                 reply('"{snippet[1]}" -- {snippet[0]}'.format(snippet=s))
-
-
-    def load_data(self):
-        try:
-            with open(self._persist_file, 'rb') as pf:
-                self._data.update(json.load(pf))
-        except IOError:
-            pass
-
-    def save_data(self):
-        with open(self._persist_file, 'wb') as pf:
-            json.dump(self._data, pf, indent=4)
@@ -0,0 +1,120 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from ..plugin import CommandPlugin
+from ..core import ConfigurationError
+from .. import metrics
+
+def _ms(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'inf'
+    return '%.2fms' % (seconds * 1000,)
+
+class StatsPlugin(CommandPlugin):
+    """Reports the metrics in hesperus.metrics.
+
+    "stats" summarizes every plugin in one line each, and "stats <plugin>"
+    gives the details for one. For monitoring, the metrics can also be
+    written in the Prometheus text format to a file every interval seconds
+    (prometheus-file, for node_exporter's textfile collector), or served over
+    HTTP on localhost (prometheus-port).
+
+    """
+    @CommandPlugin.config_types(prometheus_file=str, prometheus_port=int, interval=float)
+    def __init__(self, core, prometheus_file=None, prometheus_port=None, interval=15.0):
+        super(StatsPlugin, self).__init__(core)
+        self.prometheus_file = prometheus_file
+        self.interval = interval
+        self.server = None
+        if prometheus_port:
+            try:
+                self.server = HTTPServer(('127.0.0.1', prometheus_port), _MetricsHandler)
+            except OSError as e:
+                raise ConfigurationError('could not listen on port %d: %s' % (prometheus_port, e))
+
+    def run(self):
+        if self.server:
+            thread = threading.Thread(target=self.server.serve_forever, name='hesperus-metrics')
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                if self.prometheus_file:
+                    self.write_file()
+                    yield self.interval
+                else:
+                    yield self.forever
+        finally:
+            if self.server:
+                self.server.shutdown()
+                self.server.server_close()
+
+    def write_file(self):
+        # write it all at once, so readers never see half a file
+        tmp = self.prometheus_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(metrics.registry.prometheus())
+            os.replace(tmp, self.prometheus_file)
+        except OSError as e:
+            self.log_warning("could not write metrics to %s: %s" % (self.prometheus_file, e))
+
+    @CommandPlugin.register_command(r"stats")
+    def stats_command(self, chans, name, match, direct, reply):
+        registry = metrics.registry
+        parts = []
+        for plugname in registry.names():
+            m = registry.get(plugname)
+            # queued plugins do the real work in their own thread
+            hist = m.call if m.call.count >= m.dispatch.count else m.dispatch
+            if not hist.count and not m.poll.count and not m.exceptions:
+                continue
+            parts.append("%s: %d handled, p99 %s, %d replies, %d errors" % (
+                plugname, hist.count, _ms(hist.quantile(0.99)), m.replies, m.exceptions))
+        if not parts:
+            reply("Nothing to report yet.")
+            return
+        reply("; ".join(parts))
+
+    @CommandPlugin.register_command(r"stats\s+(\S+)")
+    def stats_plugin_command(self, chans, name, match, direct, reply):
+        registry = metrics.registry
+        plugname = match.group(1)
+        m = registry.get(plugname)
+        if m is None:
+            reply("I don't have any stats for %s." % (plugname,))
+            return
+        parts = []
+        for attr in metrics.AgentMetrics.histograms:
+            hist = getattr(m, attr)
+            if hist.count:
+                parts.append("%s: %d, mean %s, p50 %s, p99 %s" % (
+                    attr.replace('_', ' '), hist.count, _ms(hist.mean()),
+                    _ms(hist.quantile(0.5)), _ms(hist.quantile(0.99))))
+        depth = registry.queue_depth(plugname)
+        if depth is not None:
+            parts.append("queue: %d" % (depth,))
+        parts.append("replies: %d" % (m.replies,))
+        parts.append("errors: %d" % (m.exceptions,))
+        if m.persist_writes:
+            parts.append("saved: %d writes, %d bytes" % (m.persist_writes, m.persist_bytes))
+        reply("%s -- %s" % (plugname, "; ".join(parts)))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log otherwise
+        pass
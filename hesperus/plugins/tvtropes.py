@@ -15,7 +15,7 @@ class TvTropesPlugin(CommandPlugin):
     URLMATCH = re.compile(r'^https?://(?:www.)?tvtropes.org/pmwiki/pmwiki.php/([^/]+)/([^/]+)$')
     URLFORMAT = 'http://tvtropes.org/pmwiki/pmwiki.php/{0}/{1}'
     
-    @CommandPlugin.register_command(r"(?:tv)?tropes?\s+(.+)")
+    @CommandPlugin.register_command(r"(?:tv)?tropes?\s+(.+)", blocking=True)
     def trope_command(self, chans, name, match, direct, reply):
         self.log_debug('searching google for trope: ' + match.group(1))
         try:
@@ -21,6 +21,10 @@ class TwitchWatcherPlugin(PollPlugin, CommandPlugin, PersistentPlugin):
 								'"{key}" in your channel status then try again ' \
 								'after a minute or two'
 
+	# poll() asks the twitch api itself, so it gets a thread (or a slot in
+	# the asyncio runtime's executor) of its own
+	dedicated_thread	= True
+
 	persistence_file	= 'twitch_watcher.json'
 	_data 				= {
 		'watched':	{},
@@ -52,8 +56,9 @@ class TwitchWatcherPlugin(PollPlugin, CommandPlugin, PersistentPlugin):
 
 		if name in self._data['watched']:
 			del self._data['watched'][name]
+			self.reschedule_poll()
 			reply(self.MSG_STOPPED_WATCHING)
-			return self.save_data()
+			return self.save_data('watched')
 
 		try:
 			twitch_channel = self._get_channel(twitch_username)
@@ -68,8 +73,9 @@ class TwitchWatcherPlugin(PollPlugin, CommandPlugin, PersistentPlugin):
 				'live':				False,
 				'url':				twitch_channel['url'],
 			}
+			self.reschedule_poll()
 			reply(self.MSG_STARTED_WATCHING)
-			return self.save_data()
+			return self.save_data('watched')
 		else:
 			self.log_debug('Found channel status as: {}'.format(twitch_channel['status']))
 			return reply(self.MSG_CHALLENGE_RESP.format(key=auth_key))
@@ -115,7 +121,7 @@ class TwitchWatcherPlugin(PollPlugin, CommandPlugin, PersistentPlugin):
 					require_save = True
 
 			if require_save:
-				self.save_data()
+				self.save_data('watched')
 			yield
 
 
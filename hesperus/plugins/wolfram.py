@@ -59,7 +59,7 @@ class AlphaPlugin(CommandPlugin):
         self.app_id = app_id
         self.confuse_chance = confuse_chance
     
-    @CommandPlugin.register_command(r"(?:wolframalpha|wa|alpha|=)\s+(.+)")
+    @CommandPlugin.register_command(r"(?:wolframalpha|wa|alpha|=)\s+(.+)", blocking=True)
     def alpha_command(self, chans, name, match, direct, reply):
         ret = alpha(match.group(1), self.app_id)
         if not ret['success']:
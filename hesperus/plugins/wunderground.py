@@ -17,7 +17,7 @@ class WundergroundPlugin(CommandPlugin):
         self._conn = wunderground.Wunderground(self._api_key)
         self.log_debug('Init with api_key={} and max_locs={}'.format(api_key, max_locations))
 
-    @CommandPlugin.register_command(r'w(?:under)?g(?:round)?\s+(.+)')
+    @CommandPlugin.register_command(r'w(?:under)?g(?:round)?\s+(.+)', blocking=True)
     def command_get_weather(self, chans, name, match, direct, reply):
         given_location = match.group(1)
         self.log_debug('Got location from IRC: {}'.format(given_location))
@@ -0,0 +1,122 @@
+"""A sampling profiler for the threads running agents.
+
+A Profiler looks at the stack of every thread that is working for an agent
+(see hesperus.agent.thread_agents()) a number of times a second, from a daemon
+thread of its own, so the threads being profiled only pay for the GIL being
+taken now and then. Samples are put under the class name of the agent the
+thread was working for, so work done for a plugin on a shared scheduler or
+executor thread still counts towards that plugin.
+
+Threads sitting in an agent's _wait() are idle, and are counted separately
+instead of being recorded.
+
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from .agent import thread_agents
+
+# functions that mean a thread is just waiting for something to do
+IDLE_FUNCTIONS = frozenset(['_wait'])
+
+def _describe(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class Profile(object):
+    """The results of one profiling run."""
+    def __init__(self, seconds, rate):
+        self.seconds = seconds
+        self.rate = rate
+        # (agent name, outermost function, ..., innermost function) -> samples
+        self.stacks = Counter()
+        self.idle = Counter()
+        self.samples = 0
+
+    def by_agent(self):
+        """Returns a Counter of busy samples per agent name."""
+        totals = Counter()
+        for stack, n in self.stacks.items():
+            totals[stack[0]] += n
+        return totals
+
+    def top(self, n=10):
+        """Returns the n (agent, function, samples) with the most samples
+        spent in that function itself."""
+        counts = Counter()
+        for stack, samples in self.stacks.items():
+            counts[(stack[0], stack[-1])] += samples
+        return [(agent, func, samples) for (agent, func), samples in counts.most_common(n)]
+
+    def collapsed(self):
+        """Returns the samples in the collapsed stack format used by
+        flamegraph.pl and speedscope, one "a;b;c count" line per stack."""
+        lines = []
+        for stack, n in sorted(self.stacks.items()):
+            lines.append('%s %d' % (';'.join(s.replace(';', ':') for s in stack), n))
+        return '\n'.join(lines) + '\n'
+
+class Profiler(object):
+    """Samples the stacks of agent threads rate times a second for the given
+    number of seconds, in a daemon thread, then calls done(profile)."""
+    def __init__(self, seconds, rate=100, done=None):
+        self.seconds = seconds
+        self.rate = rate
+        self.done = done
+        self.profile = Profile(seconds, rate)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='hesperus-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling early. done() is still called."""
+        self._stop.set()
+
+    def sample(self):
+        """Takes one sample of every agent thread."""
+        agents = thread_agents()
+        frames = sys._current_frames()
+        me = threading.get_ident()
+        profile = self.profile
+        for ident, agent in agents.items():
+            frame = frames.get(ident)
+            if frame is None or ident == me:
+                continue
+            name = agent.__class__.__name__
+            stack = []
+            idle = False
+            while frame is not None:
+                code = frame.f_code
+                if code.co_name in IDLE_FUNCTIONS:
+                    idle = True
+                    break
+                stack.append(_describe(code))
+                frame = frame.f_back
+            if idle:
+                profile.idle[name] += 1
+                continue
+            stack.append(name)
+            stack.reverse()
+            profile.stacks[tuple(stack)] += 1
+        profile.samples += 1
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        deadline = time.time() + self.seconds
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                if now >= deadline:
+                    break
+                self.sample()
+                self._stop.wait(min(interval, deadline - now))
+        finally:
+            if self.done is not None:
+                self.done(self.profile)
@@ -0,0 +1,168 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from . import agent as _agent
+
+# what a scheduled agent is doing
+SLEEPING = 'sleeping'
+READY = 'ready'
+RUNNING = 'running'
+
+class _Task(object):
+    __slots__ = ('agent', 'state', 'woken', 'deadline')
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.state = READY
+        # set if the agent is woken up while one of its steps is running
+        self.woken = False
+        self.deadline = None
+
+class Scheduler(object):
+    """Runs many Agents on a small pool of worker threads, instead of giving
+    each one a thread of its own.
+
+    Each step of an agent (resuming run() up to its next yield, then handling
+    its queued calls) is done by whichever worker is free. In between steps
+    the agent takes up no thread at all: it is woken up by wake() (which
+    queued calls and stop() already do), or when the time yielded from run()
+    runs out. An agent is never run by two workers at once, so agents don't
+    need to be any more careful about threads than before.
+
+    Since a step holds on to a worker until run() yields, agents that block
+    for a long time in run() (like pollers that fetch from the network in
+    poll()) hold up the others. Those, and agents that override _wait(),
+    should set dedicated_thread and be started with start_threaded()
+    instead, which Core.launch() does.
+
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._cond = threading.Condition(self.lock)
+        self._tasks = {}
+        self._ready = deque()
+        # heap of (deadline, sequence, task) for sleeping agents
+        self._timers = []
+        self._sequence = itertools.count()
+        self._threads = []
+        self._idle = 0
+        self.steps = 0
+
+    def _start_threads(self):
+        # called with the lock held
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name='hesperus-scheduler-%d' % (len(self._threads),))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def add(self, agent):
+        """Starts running agent on the worker threads."""
+        with self.lock:
+            if agent in self._tasks:
+                return
+            agent._begin()
+            agent._scheduler = self
+            task = self._tasks[agent] = _Task(agent)
+            self._ready.append(task)
+            self._start_threads()
+            self._cond.notify()
+
+    def wake(self, agent):
+        """Makes sure agent gets a step soon. Called by Agent.wake()."""
+        with self.lock:
+            task = self._tasks.get(agent)
+            if task is None:
+                return
+            if task.state == SLEEPING:
+                task.state = READY
+                task.deadline = None
+                self._ready.append(task)
+                self._cond.notify()
+            elif task.state == RUNNING:
+                task.woken = True
+
+    def _next_task(self):
+        # called with the lock held, waits for a task that's ready to run
+        while True:
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                deadline, _, task = heapq.heappop(self._timers)
+                # skip timers left over from earlier sleeps
+                if task.state == SLEEPING and task.deadline == deadline:
+                    task.state = READY
+                    task.deadline = None
+                    self._ready.append(task)
+            if self._ready:
+                task = self._ready.popleft()
+                task.state = RUNNING
+                return task
+            timeout = self._timers[0][0] - now if self._timers else None
+            self._idle += 1
+            self._cond.wait(timeout)
+            self._idle -= 1
+
+    def _worker(self):
+        # a full queue must not hold up the worker: whoever would empty it
+        # may be waiting for a worker themselves
+        _agent.set_loop_thread(True)
+        while True:
+            with self.lock:
+                task = self._next_task()
+            agent = task.agent
+
+            finished = False
+            timeout = None
+            _agent.set_current_agent(agent)
+            try:
+                if agent._running:
+                    timeout = agent._step()
+                else:
+                    finished = True
+            except StopIteration:
+                finished = True
+            except Exception as e:
+                agent._crashed(e)
+                finished = True
+            finally:
+                _agent.set_current_agent(None)
+
+            if finished:
+                with self.lock:
+                    del self._tasks[agent]
+                agent._finish()
+                continue
+
+            with self.lock:
+                self.steps += 1
+                seconds = agent._wait_seconds(timeout)
+                if task.woken or seconds == 0:
+                    task.woken = False
+                    task.state = READY
+                    self._ready.append(task)
+                    self._cond.notify()
+                elif seconds is None:
+                    task.state = SLEEPING
+                else:
+                    task.state = SLEEPING
+                    task.deadline = time.time() + seconds
+                    heapq.heappush(self._timers, (task.deadline, next(self._sequence), task))
+                    # an idle worker may be waiting on a later timer
+                    self._cond.notify()
+
+    def stats(self):
+        """Returns a dict with the number of workers, how many are idle, how
+        many agents are scheduled and ready to run, and how many steps have
+        been run so far."""
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'idle': self._idle,
+                'agents': len(self._tasks),
+                'ready': len(self._ready),
+                'steps': self.steps,
+            }
@@ -0,0 +1,355 @@
+"""Plugin state kept in an SQLite database.
+
+A Store is one database file, shared by all plugins, with one table of keys
+and JSON values for each Namespace (usually one per plugin), so a plugin
+only ever reads and writes its own keys. The database is in WAL mode, so
+reads don't wait for writes, and each put() or delete() is a small
+transaction of its own unless it is made inside a batch().
+
+A namespace can have secondary indexes: functions from a value to the
+terms it can be looked up by (say, the owner of a package, or when a
+reminder is due). Terms are kept in a second table, updated along with the
+values, and find() and scan() look keys up by them.
+
+The first time a namespace is used, the plugin can import the JSON file it
+used to keep its state in, see Namespace.import_json().
+
+Plugins write their state in the background on the Writer thread (see
+PersistentPlugin), not on the shared executor, so saving never waits behind
+blocking commands that have hung.
+
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+from queue import Queue
+
+class Store(object):
+    """One SQLite database. Thread safe: all access goes through one
+    connection, under the lock."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        # transactions are started and ended by batch(), not by sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS namespaces (name TEXT PRIMARY KEY, imported TEXT)')
+        self._namespaces = {}
+        self._depth = 0
+        self._failed = False
+        self.transactions = 0
+
+    @contextmanager
+    def batch(self):
+        """Runs the body as one transaction, committed at the end, or rolled
+        back if it raises. Batches can be nested; only the outermost one
+        commits. Other threads wait until the batch is over."""
+        with self.lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._failed = False
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._failed = True
+                raise
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._failed:
+                        self._conn.execute('ROLLBACK')
+                    else:
+                        self._conn.execute('COMMIT')
+                        self.transactions += 1
+
+    def execute(self, sql, params=()):
+        """Runs a statement that changes the database, in a transaction."""
+        with self.batch():
+            return self._conn.execute(sql, params).rowcount
+
+    def query(self, sql, params=()):
+        """Runs a query, and returns all the rows."""
+        with self.lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def namespace(self, name):
+        """Returns the Namespace called name, creating it if needed."""
+        with self.lock:
+            ns = self._namespaces.get(name)
+            if ns is None:
+                ns = self._namespaces[name] = Namespace(self, name)
+            return ns
+
+    def close(self):
+        with self.lock:
+            self._conn.close()
+
+class Namespace(object):
+    """The keys of one plugin. Values are anything json can handle, and
+    keys are strings."""
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        table = re.sub(r'\W', '_', name.lower())
+        self._table = '"kv_%s"' % (table,)
+        self._index_table = '"ix_%s"' % (table,)
+        # index name -> function from a value to its terms
+        self._indexes = {}
+        self.writes = 0
+        self.bytes_written = 0
+        with store.batch():
+            store.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT NOT NULL)' % (self._table,))
+            store.execute('CREATE TABLE IF NOT EXISTS %s (idx TEXT NOT NULL, term, key TEXT NOT NULL, PRIMARY KEY (idx, term, key))' % (self._index_table,))
+            store.execute('CREATE INDEX IF NOT EXISTS "%s_key" ON %s (key)' % (self._index_table[1:-1], self._index_table))
+            store.execute('INSERT OR IGNORE INTO namespaces (name) VALUES (?)', (name,))
+
+    #
+    # indexes
+    #
+
+    def add_index(self, index, func):
+        """Indexes every value under the terms func(value) returns: one
+        term, a list of them, or None for none. The index is rebuilt from
+        the values already stored."""
+        self._indexes[index] = func
+        with self.store.batch():
+            self.store.execute('DELETE FROM %s WHERE idx = ?' % (self._index_table,), (index,))
+            for key, value in self.items():
+                self._index_one(index, func, key, value)
+
+    def _terms(self, func, value):
+        terms = func(value)
+        if terms is None:
+            return ()
+        if isinstance(terms, (list, tuple, set, frozenset)):
+            return terms
+        return (terms,)
+
+    def _index_one(self, index, func, key, value):
+        # called inside a batch
+        for term in self._terms(func, value):
+            self.store.execute('INSERT OR IGNORE INTO %s (idx, term, key) VALUES (?, ?, ?)' % (self._index_table,),
+                    (index, term, key))
+
+    def _unindex(self, key):
+        # called inside a batch
+        if self._indexes:
+            self.store.execute('DELETE FROM %s WHERE key = ?' % (self._index_table,), (key,))
+
+    def find(self, index, term):
+        """Returns the (key, value)s indexed under term, by key."""
+        rows = self.store.query('SELECT kv.key, kv.value FROM %s ix JOIN %s kv ON kv.key = ix.key '
+                'WHERE ix.idx = ? AND ix.term = ? ORDER BY kv.key' % (self._index_table, self._table),
+                (index, term))
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def scan(self, index, start=None, stop=None, limit=None):
+        """Returns (term, key, value)s with start <= term < stop (either can
+        be left out), in order of their terms, at most limit of them."""
+        sql = 'SELECT ix.term, kv.key, kv.value FROM %s ix JOIN %s kv ON kv.key = ix.key WHERE ix.idx = ?' % (
+                self._index_table, self._table)
+        params = [index]
+        if start is not None:
+            sql += ' AND ix.term >= ?'
+            params.append(start)
+        if stop is not None:
+            sql += ' AND ix.term < ?'
+            params.append(stop)
+        sql += ' ORDER BY ix.term, kv.key'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [(term, key, json.loads(value)) for term, key, value in self.store.query(sql, params)]
+
+    #
+    # keys
+    #
+
+    def get(self, key, default=None):
+        rows = self.store.query('SELECT value FROM %s WHERE key = ?' % (self._table,), (key,))
+        if not rows:
+            return default
+        return json.loads(rows[0][0])
+
+    def put(self, key, value):
+        """Stores value under key. Returns the number of bytes written."""
+        return self.put_json(key, json.dumps(value))
+
+    def put_json(self, key, text, value=None):
+        """Stores text, value already turned into JSON, under key. value is
+        only needed for the indexes, and is read back from text if not
+        given. Returns the number of bytes written."""
+        with self.store.batch():
+            self.store.execute('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % (self._table,), (key, text))
+            if self._indexes:
+                if value is None:
+                    value = json.loads(text)
+                self._unindex(key)
+                for index, func in self._indexes.items():
+                    self._index_one(index, func, key, value)
+        size = len(text.encode('utf-8'))
+        self.writes += 1
+        self.bytes_written += size
+        return size
+
+    def delete(self, key):
+        """Removes key. Returns whether it was there."""
+        with self.store.batch():
+            self._unindex(key)
+            found = self.store.execute('DELETE FROM %s WHERE key = ?' % (self._table,), (key,)) > 0
+        self.writes += 1
+        return found
+
+    def clear(self):
+        with self.store.batch():
+            self.store.execute('DELETE FROM %s' % (self._index_table,))
+            self.store.execute('DELETE FROM %s' % (self._table,))
+        self.writes += 1
+
+    def batch(self):
+        """A transaction, see Store.batch()."""
+        return self.store.batch()
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return bool(self.store.query('SELECT 1 FROM %s WHERE key = ?' % (self._table,), (key,)))
+
+    def __len__(self):
+        return self.store.query('SELECT COUNT(*) FROM %s' % (self._table,))[0][0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for (key,) in self.store.query('SELECT key FROM %s ORDER BY key' % (self._table,))]
+
+    def items(self):
+        rows = self.store.query('SELECT key, value FROM %s ORDER BY key' % (self._table,))
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    #
+    # importing
+    #
+
+    def import_json(self, path):
+        """Imports the top-level keys of the JSON object in path, unless a
+        file has been imported into this namespace before, or it doesn't
+        exist. Returns the number of keys imported."""
+        with self.store.batch():
+            rows = self.store.query('SELECT imported FROM namespaces WHERE name = ?', (self.name,))
+            if rows and rows[0][0] is not None:
+                return 0
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (IOError, OSError):
+                return 0
+            if not isinstance(data, dict):
+                raise ValueError('%s does not hold a JSON object' % (path,))
+            for key, value in data.items():
+                self.put(key, value)
+            self.store.execute('UPDATE namespaces SET imported = ? WHERE name = ?', (os.path.abspath(path), self.name))
+        return len(data)
+
+    def stats(self):
+        """Returns a dict with the number of keys, and the number of writes
+        made and bytes written through this object."""
+        return {
+            'keys': len(self),
+            'writes': self.writes,
+            'bytes': self.bytes_written,
+        }
+
+_missing = object()
+
+class Writer(object):
+    """A thread of its own that runs writes handed to it with submit(), one
+    at a time, in order."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._jobs = Queue()
+        self._thread = None
+        self.completed = 0
+
+    def submit(self, func):
+        """Queues func() to be run on the writer thread."""
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='hesperus-storage-writer')
+                self._thread.daemon = True
+                self._thread.start()
+        self._jobs.put(func)
+
+    def _run(self):
+        while True:
+            func = self._jobs.get()
+            try:
+                func()
+            except Exception:
+                traceback.print_exc()
+            self.completed += 1
+
+    def stats(self):
+        """Returns a dict with the number of writes waiting and done."""
+        return {
+            'queued': self._jobs.qsize(),
+            'completed': self.completed,
+        }
+
+# the database plugins keep their state in, unless configured otherwise
+default_path = 'hesperus.db'
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared():
+    """Returns the store shared by all plugins, opening it if needed."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Store(default_path)
+        return _shared
+
+_writer = None
+
+def writer():
+    """Returns the Writer plugins save their state on, creating it if
+    needed."""
+    global _writer
+    with _shared_lock:
+        if _writer is None:
+            _writer = Writer()
+        return _writer
+
+def configure(path):
+    """Sets the database file plugins keep their state in. Only has an
+    effect before the store is first opened."""
+    global default_path
+    with _shared_lock:
+        default_path = path
+
+def namespace(name):
+    """Returns the Namespace called name in the shared store."""
+    return shared().namespace(name)
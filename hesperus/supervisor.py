@@ -0,0 +1,155 @@
+import time
+from collections import deque
+
+# how a crashed plugin is brought back, set with <plugin restart="...">
+RELOAD = 'reload'
+THREAD = 'thread'
+NEVER = 'never'
+
+RESTART_MODES = (RELOAD, THREAD, NEVER)
+
+class _Record(object):
+    __slots__ = ('name', 'mode', 'index', 'crashes', 'restarts', 'failures',
+            'started', 'due', 'state')
+
+    def __init__(self, name, mode):
+        self.name = name
+        self.mode = mode
+        # where the plugin was in the core's list, so it can go back there
+        self.index = None
+        # times of recent crashes, for crash loop detection
+        self.crashes = deque()
+        self.restarts = 0
+        # crashes since the plugin last ran for long enough to count as fixed
+        self.failures = 0
+        self.started = time.time()
+        self.due = None
+        self.state = 'running'
+
+class Supervisor(object):
+    """Keeps track of crashed plugins for the core, and decides when (and
+    whether) to restart them.
+
+    Each crash is followed by a restart after a delay that doubles with every
+    crash in a row, from backoff_initial up to backoff_max seconds. A plugin
+    that stays up for stable_after seconds starts over from backoff_initial.
+    A plugin that crashes more than crash_limit times in crash_window seconds
+    is in a crash loop, and is given up on.
+
+    Plugins are restarted according to their restart attribute: "reload"
+    makes a new instance from the plugin's config element, "thread" starts
+    the same instance again (keeping whatever it has in memory), and "never"
+    leaves it be. Plugins made without a config element can't be reloaded,
+    so they are restarted as with "thread".
+
+    The supervisor only keeps the books, the core does the restarting.
+
+    """
+    backoff_initial = 1.0
+    backoff_factor = 2.0
+    backoff_max = 300.0
+    stable_after = 300.0
+    crash_window = 600.0
+    crash_limit = 5
+
+    def __init__(self):
+        self._records = {}
+
+    def _record(self, plug):
+        record = self._records.get(plug)
+        if record is None:
+            mode = getattr(plug, 'restart', NEVER)
+            if mode == RELOAD and getattr(plug, 'config_element', None) is None:
+                mode = THREAD
+            record = self._records[plug] = _Record(plug.__class__.__name__, mode)
+        return record
+
+    def waiting(self, plug):
+        """True if plug has crashed and is waiting to be restarted."""
+        record = self._records.get(plug)
+        return record is not None and record.state == 'waiting'
+
+    def crashed(self, plug, index=None, now=None):
+        """Records a crash of plug, which was at index in the core's plugin
+        list. Returns the number of seconds until it should be restarted, or
+        None if it shouldn't be."""
+        if now is None:
+            now = time.time()
+        record = self._record(plug)
+        record.index = index
+
+        record.crashes.append(now)
+        while record.crashes and record.crashes[0] < now - self.crash_window:
+            record.crashes.popleft()
+        if now - record.started >= self.stable_after:
+            record.failures = 0
+        record.failures += 1
+
+        if record.mode == NEVER:
+            record.state = 'stopped'
+            return None
+        if len(record.crashes) > self.crash_limit:
+            record.state = 'crash-loop'
+            return None
+
+        delay = min(self.backoff_initial * self.backoff_factor ** (record.failures - 1), self.backoff_max)
+        record.state = 'waiting'
+        record.due = now + delay
+        return delay
+
+    def pending(self):
+        """Returns the plugins waiting to be restarted."""
+        return [plug for plug, record in list(self._records.items()) if record.state == 'waiting']
+
+    def due(self, now=None):
+        """Returns (plugin, mode, index) for the plugins due to be restarted."""
+        if now is None:
+            now = time.time()
+        return [(plug, record.mode, record.index) for plug, record in list(self._records.items())
+                if record.state == 'waiting' and record.due <= now]
+
+    def postpone(self, plug, seconds, now=None):
+        """Tries again to restart plug in a little while."""
+        if now is None:
+            now = time.time()
+        self._records[plug].due = now + seconds
+
+    def restarted(self, old, new, now=None):
+        """Records that old was restarted as new (which may be the same
+        plugin)."""
+        if now is None:
+            now = time.time()
+        record = self._records.pop(old)
+        record.restarts += 1
+        record.started = now
+        record.due = None
+        record.state = 'running'
+        self._records[new] = record
+
+    def next_delay(self, now=None):
+        """Returns the seconds until the next restart is due, or None."""
+        if now is None:
+            now = time.time()
+        dues = [r.due for r in self._records.values() if r.state == 'waiting']
+        if not dues:
+            return None
+        return max(min(dues) - now, 0)
+
+    def forget(self, plug):
+        """Stops keeping track of plug, for example once it is unloaded."""
+        self._records.pop(plug, None)
+
+    def stats(self):
+        """Returns a list of dicts, one per plugin that has crashed, with its
+        name, state, restart mode and counters."""
+        stats = []
+        for record in self._records.values():
+            stats.append({
+                'name': record.name,
+                'state': record.state,
+                'mode': record.mode,
+                'restarts': record.restarts,
+                'recent_crashes': len(record.crashes),
+                'due': record.due,
+            })
+        return stats
@@ -0,0 +1,331 @@
+"""A hierarchical timer wheel, shared by everything the core runs.
+
+Timers are kept in a few levels of slots. The first level has one slot per
+tick (resolution seconds), the next one slot per slots ticks, and so on, and
+timers too far away for any level wait in an overflow list. Scheduling and
+cancelling a timer are O(1), and as time goes by the timers in a slot of a
+higher level are moved down a level (cascaded), until they reach the first
+level and fire. A timer fires on the first tick at or after its deadline, so
+at most resolution seconds late.
+
+Nothing ticks while there is nothing to do: whoever drives the wheel (the
+core, see Core.run()) calls advance() when next_delay() says something is
+due, and is woken up by the on_earlier callback when a new timer is due
+before that.
+
+Periodic builds repeating timers on top of a wheel, with jitter, dynamic
+intervals and a policy for ticks that are missed because the work took too
+long:
+
+delay
+    the next tick is interval seconds after the work is done (the default)
+skip
+    ticks stay on a fixed schedule, and missed ones are skipped
+catch-up
+    ticks stay on a fixed schedule, and missed ones are run back to back
+
+"""
+
+import math
+import random
+import threading
+import time
+
+DELAY = 'delay'
+SKIP = 'skip'
+CATCH_UP = 'catch-up'
+POLICIES = (DELAY, SKIP, CATCH_UP)
+
+class Timer(object):
+    __slots__ = ('tick', 'deadline', 'callback', '_slot', '_level')
+
+    def __init__(self, tick, deadline, callback):
+        self.tick = tick
+        self.deadline = deadline
+        self.callback = callback
+        # the slot (a dict) the timer is waiting in, or None, and its level
+        # (None for the overflow list)
+        self._slot = None
+        self._level = None
+
+    @property
+    def pending(self):
+        return self._slot is not None
+
+class TimerWheel(object):
+    """Fires callbacks at (or just after) given times. Thread safe; the
+    callbacks are called by whoever calls advance(), without the lock held,
+    so they should be quick, like waking up an agent."""
+    def __init__(self, resolution=0.05, slots=64, levels=4, clock=time.monotonic, on_earlier=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        # called when a timer is scheduled before anything else is due
+        self.on_earlier = on_earlier
+        self.lock = threading.Lock()
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow = {}
+        self._counts = [0] * levels
+        self._current = self._tick_at(clock())
+        # the tick next_delay() last promised to be back by, or None
+        self._promised = None
+        self.fired = 0
+        self.cascades = 0
+
+    def _tick_at(self, t):
+        # the last tick at or before t, allowing for rounding so that
+        # advance() always gets as far as next_delay() said it would
+        return int(math.floor(t / self.resolution + 1e-6))
+
+    def now(self):
+        return self.clock()
+
+    #
+    # slots
+    #
+
+    def _span(self, level):
+        return self.slots ** level
+
+    def _place(self, timer, earliest):
+        # called with the lock held: puts timer in the slot for its tick, or
+        # for the earliest tick if that is later
+        tick = max(timer.tick, earliest)
+        for level in range(self.levels):
+            span = self._span(level + 1)
+            if tick // span == self._current // span:
+                slot = self._wheels[level][(tick // self._span(level)) % self.slots]
+                self._counts[level] += 1
+                break
+        else:
+            level = None
+            slot = self._overflow
+        slot[timer] = None
+        timer._slot = slot
+        timer._level = level
+
+    def _take(self, timer):
+        # called with the lock held: takes timer out of its slot
+        del timer._slot[timer]
+        timer._slot = None
+        if timer._level is not None:
+            self._counts[timer._level] -= 1
+
+    def _empty(self, slot, level):
+        timers = list(slot)
+        slot.clear()
+        if level is not None:
+            self._counts[level] -= len(timers)
+        for timer in timers:
+            timer._slot = None
+        return timers
+
+    def _next_tick(self):
+        # called with the lock held: the first tick after the current one on
+        # which a timer fires or a slot cascades, or None
+        best = None
+        for level in range(self.levels):
+            if not self._counts[level]:
+                continue
+            span = self._span(level)
+            base = self._current // span
+            wheel = self._wheels[level]
+            for k in range(1, self.slots + 1):
+                if wheel[(base + k) % self.slots]:
+                    tick = (base + k) * span
+                    if best is None or tick < best:
+                        best = tick
+                    break
+        if self._overflow:
+            span = self._span(self.levels)
+            tick = (self._current // span + 1) * span
+            if best is None or tick < best:
+                best = tick
+        return best
+
+    def _run_tick(self, tick):
+        # called with the lock held: moves to tick, cascading whatever
+        # reaches a lower level, and returns the timers that fire
+        self._current = tick
+        if tick % self._span(self.levels) == 0 and self._overflow:
+            self.cascades += 1
+            for timer in self._empty(self._overflow, None):
+                self._place(timer, tick)
+        for level in range(self.levels - 1, 0, -1):
+            span = self._span(level)
+            if tick % span == 0:
+                slot = self._wheels[level][(tick // span) % self.slots]
+                if slot:
+                    self.cascades += 1
+                    for timer in self._empty(slot, level):
+                        self._place(timer, tick)
+        return self._empty(self._wheels[0][tick % self.slots], 0)
+
+    #
+    # public interface
+    #
+
+    def schedule(self, deadline, callback):
+        """Calls callback() once the clock reaches deadline. Returns a Timer,
+        for cancel()."""
+        # the first tick at or after the deadline
+        timer = Timer(int(math.ceil(deadline / self.resolution - 1e-6)), deadline, callback)
+        with self.lock:
+            self._place(timer, self._current + 1)
+            earlier = self._promised is None or timer.tick < self._promised
+            if earlier:
+                self._promised = timer.tick
+        if earlier and self.on_earlier is not None:
+            self.on_earlier()
+        return timer
+
+    def schedule_in(self, delay, callback):
+        return self.schedule(self.clock() + delay, callback)
+
+    def cancel(self, timer):
+        """Stops a timer from firing. Does nothing if it already has."""
+        with self.lock:
+            if timer._slot is not None:
+                self._take(timer)
+
+    def advance(self, now=None):
+        """Fires every timer that is due by now. Returns how many fired."""
+        if now is None:
+            now = self.clock()
+        target = self._tick_at(now)
+        due = []
+        with self.lock:
+            # skip over the ticks where nothing happens
+            while self._current < target:
+                tick = self._next_tick()
+                if tick is None or tick > target:
+                    self._current = target
+                    break
+                due.extend(self._run_tick(tick))
+            self.fired += len(due)
+        for timer in due:
+            timer.callback()
+        return len(due)
+
+    def next_delay(self, now=None):
+        """Returns how many seconds until advance() has something to do, or
+        None if nothing is scheduled."""
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            tick = self._next_tick()
+            self._promised = tick
+        if tick is None:
+            return None
+        return max(tick * self.resolution - now, 0)
+
+    def __len__(self):
+        with self.lock:
+            return sum(self._counts) + len(self._overflow)
+
+    def stats(self):
+        """Returns a dict with the number of timers waiting, how many have
+        fired, and how many slots have been cascaded."""
+        with self.lock:
+            return {
+                'timers': sum(self._counts) + len(self._overflow),
+                'fired': self.fired,
+                'cascades': self.cascades,
+            }
+
+class Periodic(object):
+    """Calls callback() every interval seconds on a TimerWheel. interval may
+    be a function, for intervals that change; it is looked at again every
+    time a tick is scheduled, and by reschedule().
+
+    Each tick is started by callback(), which usually hands the work to an
+    agent, and is over once done() is called. The next tick is only
+    scheduled then, so ticks never overlap; see the module docs for the
+    policies about ticks missed in the meantime. Each tick is put off by up
+    to jitter * interval seconds, at random, so that many timers with the
+    same interval don't all fire at once.
+
+    """
+    def __init__(self, wheel, interval, callback, jitter=0.0, policy=DELAY):
+        if not policy in POLICIES:
+            raise ValueError('unknown policy "%s"' % (policy,))
+        self.wheel = wheel
+        self.interval = interval
+        self.callback = callback
+        self.jitter = jitter
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.missed = 0
+        # when the pending tick is due without jitter, and when the interval
+        # before it started
+        self._base = None
+        self._since = None
+        self._timer = None
+        self._stopped = True
+
+    def _interval(self):
+        interval = self.interval
+        if callable(interval):
+            interval = interval()
+        return max(float(interval), 0.0)
+
+    def _arm(self, since, base):
+        # called with the lock held
+        self._since = since
+        self._base = base
+        deadline = base
+        if self.jitter:
+            deadline += random.uniform(0, self.jitter * self._interval())
+        self._timer = self.wheel.schedule(deadline, self._fire)
+
+    def _fire(self):
+        with self.lock:
+            if self._stopped:
+                return
+            self._timer = None
+        self.callback()
+
+    def start(self, delay=None):
+        """Schedules the first tick, after delay seconds (by default, one
+        interval)."""
+        with self.lock:
+            self._stopped = False
+            if delay is None:
+                delay = self._interval()
+            now = self.wheel.now()
+            self._arm(now, now + delay)
+
+    def done(self):
+        """Called once the work for a tick is over, to schedule the next."""
+        with self.lock:
+            if self._stopped:
+                return
+            now = self.wheel.now()
+            interval = self._interval()
+            since = now if self.policy == DELAY else self._base
+            base = since + interval
+            if self.policy == SKIP and base <= now and interval > 0:
+                missed = int((now - base) // interval) + 1
+                self.missed += missed
+                since += missed * interval
+                base += missed * interval
+            elif self.policy == CATCH_UP and base <= now:
+                self.missed += 1
+            self._arm(since, base)
+
+    def reschedule(self):
+        """Moves the pending tick, after the interval has changed, to one
+        interval after the last one."""
+        with self.lock:
+            if self._stopped or self._timer is None:
+                return
+            self.wheel.cancel(self._timer)
+            self._arm(self._since, self._since + self._interval())
+
+    def stop(self):
+        with self.lock:
+            self._stopped = True
+            if self._timer is not None:
+                self.wheel.cancel(self._timer)
+                self._timer = None
@@ -0,0 +1,355 @@
+"""Reads the time out of things like "remind bob in 1 hour 30 mins to call".
+
+A timespec is a keyword followed by a time, at the start or the end of a
+message, and the rest of the message is the action:
+
+in <duration>
+    relative: the duration from now, as in "in 2 days" or "in 1h30m"
+
+for <duration>
+    recurring: repeatedly, until the duration is up (RemindPlugin repeats
+    every fibonacci number of days)
+
+at <date and/or time>
+    absolute: "at 2024-05-01 12:30", "at jan 5 2024 09:00:00", "at 17:45"
+    (the next time it is 17:45), "at 5pm"
+
+A duration is one or more counts of units, mixed as needed, and optionally
+separated by "and" or commas: "1 hour 30 mins", "2 weeks, 3 days", "90s",
+"1h30m", "an hour". Dates have a four-digit year, and a month given by name
+(in any order) or by number (year first).
+
+The message is split into words once, and the timespec is read from them by
+hand, instead of trying a regular expression for every form in turn. A
+message with no timespec is not an error: it comes back with kind None. But
+once it is clear that a timespec was meant, like "buy milk in 5 bananas"
+or "at 2024-02-30 12:00 ...", a TimespecError says what is wrong with it.
+
+"""
+
+import datetime
+import re
+import time
+from collections import namedtuple
+
+RELATIVE = 'relative'
+RECURRING = 'recurring'
+ABSOLUTE = 'absolute'
+
+KEYWORDS = {'in': RELATIVE, 'for': RECURRING, 'at': ABSOLUTE}
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+MONTH = 30 * DAY
+YEAR = 365 * DAY
+
+UNITS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': MINUTE, 'min': MINUTE, 'minute': MINUTE,
+    'h': HOUR, 'hr': HOUR, 'hour': HOUR,
+    'd': DAY, 'day': DAY,
+    'w': WEEK, 'wk': WEEK, 'week': WEEK,
+    'mo': MONTH, 'month': MONTH,
+    'y': YEAR, 'yr': YEAR, 'year': YEAR,
+}
+
+# every way of writing a unit: the names above, and their plurals
+_UNIT_WORDS = dict(UNITS)
+for _name, _seconds in UNITS.items():
+    if len(_name) > 1:
+        _UNIT_WORDS[_name + 's'] = _seconds
+
+MONTHS = {}
+for _i, _name in enumerate(['january', 'february', 'march', 'april', 'may', 'june', 'july',
+        'august', 'september', 'october', 'november', 'december']):
+    MONTHS[_name] = MONTHS[_name[:3]] = _i + 1
+MONTHS['sept'] = 9
+
+_WORD = re.compile(r'\S+')
+_COMPACT = re.compile(r'(?:\d+[a-z]+)+$')
+_COMPACT_PART = re.compile(r'(\d+)([a-z]+)')
+_TIME = re.compile(r'(\d\d?)(?:[:.](\d\d)(?:[:.](\d\d))?)?(am|pm)?$')
+_ISO = re.compile(r'(\d{4}-\d\d?-\d\d?)t(.*)$')
+_DATE_SEP = re.compile(r'[-/]')
+_DIGIT = re.compile(r'\d')
+
+class TimespecError(ValueError):
+    """A timespec that can't be read. position is where in the message the
+    problem is."""
+    def __init__(self, message, position):
+        super(TimespecError, self).__init__(message)
+        self.position = position
+
+class _WordError(Exception):
+    # raised while reading words, and turned into a TimespecError by parse()
+    # once the word's position in the message is worked out
+    def __init__(self, message, index):
+        super(_WordError, self).__init__(message)
+        self.index = index
+
+Timespec = namedtuple('Timespec', ['kind', 'when', 'seconds', 'action'])
+Timespec.__doc__ = """What parse() found: kind is RELATIVE, RECURRING,
+ABSOLUTE or None (no timespec), when the time (in seconds since the epoch) it
+comes to, seconds how far that is from now, and action the rest of the
+message."""
+
+def unit(word):
+    """Returns the length in seconds of a unit like "mins", or None."""
+    return _UNIT_WORDS.get(word.lower())
+
+#
+# durations
+#
+
+def _duration(words, i):
+    # reads a duration starting at words[i]: returns (seconds, index after
+    # it), or (None, i) if there is none, and raises if it starts with a
+    # number followed by something that isn't a unit
+    total = 0
+    found = False
+    n = len(words)
+    while i < n:
+        word = words[i].rstrip(',')
+        if found and word in ('and', ''):
+            i += 1
+            continue
+        if word.isdigit() or (word in ('a', 'an') and not found):
+            if i + 1 >= n:
+                if not found:
+                    raise _WordError('"%s" what? expected a unit after it' % (word,), i)
+                break
+            seconds = unit(words[i + 1].rstrip(','))
+            if seconds is None:
+                if found or not word.isdigit():
+                    # just the start of the action
+                    break
+                raise _WordError('unknown unit "%s"' % (words[i + 1],), i + 1)
+            total += (int(word) if word.isdigit() else 1) * seconds
+            found = True
+            i += 2
+        elif word[:1].isdigit() and _COMPACT.match(word):
+            parts = _COMPACT_PART.findall(word)
+            units = [unit(u) for _, u in parts]
+            if None in units:
+                if found:
+                    break
+                raise _WordError('unknown unit "%s"' % (parts[units.index(None)][1],), i)
+            total += sum(int(count) * u for (count, _), u in zip(parts, units))
+            found = True
+            i += 1
+        else:
+            break
+    # a trailing "and" belongs to the action
+    while found and words[i - 1].rstrip(',') in ('and', ''):
+        i -= 1
+    return (total if found else None), i
+
+#
+# dates and times
+#
+
+def _time_of_day(words, i):
+    # reads "17:45", "9.30.15", "5pm" or "5 pm" at words[i]: returns
+    # ((hour, minute, second), index after it), or (None, i)
+    if i >= len(words):
+        return None, i
+    m = _TIME.match(words[i])
+    if not m:
+        return None, i
+    hour, minute, second, half = m.groups()
+    end = i + 1
+    if half is None and end < len(words) and words[end] in ('am', 'pm'):
+        half = words[end]
+        end += 1
+    if minute is None and half is None:
+        # a bare number isn't a time
+        return None, i
+    hour = int(hour)
+    if half is not None:
+        if not 1 <= hour <= 12:
+            raise _WordError('"%s" isn\'t a time' % (words[i],), i)
+        hour = hour % 12 + (12 if half == 'pm' else 0)
+    return (hour, int(minute or 0), int(second or 0)), end
+
+def _date_parts(words, i):
+    # the pieces of a date at words[i], as one word ("2024-05-01") or three
+    # ("5 jan 2024"): returns (parts, index after them), or (None, i)
+    word = words[i]
+    iso = _ISO.match(word)
+    if iso:
+        word = iso.group(1)
+    parts = _DATE_SEP.split(word)
+    if len(parts) == 3 and any(c.isdigit() for c in word):
+        return parts, i + 1
+    if i + 2 < len(words):
+        parts = [w.rstrip(',') for w in words[i:i + 3]]
+        if any(len(p) == 4 and p.isdigit() for p in parts) and any(p in MONTHS for p in parts):
+            return parts, i + 3
+    return None, i
+
+def _date(parts, i):
+    # turns three date pieces into (year, month, day)
+    years = [p for p in parts if len(p) == 4 and p.isdigit()]
+    names = [p for p in parts if p in MONTHS]
+    if len(years) != 1:
+        raise _WordError('a date needs a four-digit year', i)
+    rest = list(parts)
+    rest.remove(years[0])
+    if names:
+        rest.remove(names[0])
+        month = MONTHS[names[0]]
+    elif parts[0] == years[0] and all(p.isdigit() for p in rest):
+        month = int(rest.pop(0))
+    else:
+        bad = [p for p in rest if not p.isdigit()]
+        if bad:
+            raise _WordError('unknown month "%s"' % (bad[0],), i)
+        raise _WordError('give the month by name, or the year first', i)
+    if not rest[0].isdigit():
+        raise _WordError('unknown month "%s"' % (rest[0],), i)
+    return int(years[0]), month, int(rest[0])
+
+def _absolute(words, i, now):
+    # reads a date and/or time at words[i]: returns (when, index after it),
+    # or (None, i)
+    if i >= len(words):
+        return None, i
+    parts, end = _date_parts(words, i)
+    if parts is None:
+        clock, end = _time_of_day(words, i)
+        if clock is None:
+            return None, i
+        # the next time it is that time
+        today = datetime.datetime.fromtimestamp(now)
+        try:
+            when = today.replace(hour=clock[0], minute=clock[1], second=clock[2], microsecond=0)
+        except ValueError:
+            raise _WordError('"%s" isn\'t a time' % (words[i],), i)
+        if when <= today:
+            when += datetime.timedelta(days=1)
+        return time.mktime(when.timetuple()), end
+
+    year, month, day = _date(parts, i)
+    clock = (0, 0, 0)
+    iso = _ISO.match(words[i])
+    if iso:
+        m = _TIME.match(iso.group(2))
+        if not m or m.group(2) is None:
+            raise _WordError('"%s" isn\'t a time' % (iso.group(2),), i)
+        clock = (int(m.group(1)), int(m.group(2)), int(m.group(3) or 0))
+    else:
+        found, after = _time_of_day(words, end)
+        if found is not None:
+            clock, end = found, after
+    try:
+        when = datetime.datetime(year, month, day, *clock)
+    except ValueError as e:
+        raise _WordError('invalid date: %s' % (e,), i)
+    return time.mktime(when.timetuple()), end
+
+#
+# the whole thing
+#
+
+def _spec(words, k, now):
+    # reads the timespec whose keyword is words[k]: returns (kind, when,
+    # index after it), or None
+    kind = KEYWORDS[words[k]]
+    if kind == ABSOLUTE:
+        when, end = _absolute(words, k + 1, now)
+    else:
+        seconds, end = _duration(words, k + 1)
+        when = None if seconds is None else now + seconds
+    if when is None:
+        return None
+    return kind, when, end
+
+def _could_end_spec(word):
+    # whether a timespec could end with word: a unit, or something with
+    # digits in it (a compact duration, a date or a time)
+    return word in _UNIT_WORDS or word in ('am', 'pm') or _DIGIT.search(word) is not None
+
+def _offset(text, index):
+    # where the index'th word starts in text
+    for i, m in enumerate(_WORD.finditer(text)):
+        if i == index:
+            return m.start()
+    return len(text)
+
+def parse(text, now=None):
+    """Finds the timespec at the start or end of text. Returns a Timespec,
+    or raises TimespecError."""
+    if now is None:
+        now = time.time()
+    words = text.lower().split()
+    try:
+        found = _parse(words, now)
+    except _WordError as e:
+        raise TimespecError(str(e), _offset(text, e.index))
+    if found is None:
+        return Timespec(None, None, None, text)
+    kind, when, first, last = found
+    if first == 0:
+        # everything after the last word of the timespec
+        action = text.split(None, last)[-1].strip()
+    else:
+        # everything before the keyword
+        action = text.rsplit(None, len(words) - first)[0].strip()
+    return Timespec(kind, when, when - now, action)
+
+def _parse(words, now):
+    # returns (kind, when, first word, word after) for the timespec, with
+    # the action being the words before it or after it, or None
+    n = len(words)
+    if n and words[0] in KEYWORDS:
+        # like at the end, a broken one only counts if it was meant as one,
+        # so "in 2 places at once" is just a message
+        try:
+            found = _spec(words, 0, now)
+        except _WordError as e:
+            if _meant(words, 0, e):
+                raise
+            found = None
+        if found is not None:
+            kind, when, end = found
+            if end >= n:
+                raise _WordError('there is nothing after the time', n)
+            return kind, when, 0, end
+
+    # otherwise the last keyword whose timespec runs to the end; most lines
+    # can't end in one, and are turned away by their last word
+    if n < 3 or not (_could_end_spec(words[-1]) or words[-2].isdigit()):
+        return None
+    # a broken one only counts as an error if nothing else works, and if it
+    # doesn't look like it was just followed by something else, like "born
+    # in 1984"
+    error = None
+    for k in range(n - 2, 0, -1):
+        if not words[k] in KEYWORDS:
+            continue
+        try:
+            found = _spec(words, k, now)
+        except _WordError as e:
+            if error is None and _meant(words, k, e):
+                error = e
+            continue
+        if found is not None and found[2] == n:
+            kind, when, end = found
+            return kind, when, k, n
+    if error is not None:
+        raise error
+    return None
+
+def _meant(words, k, error):
+    # whether a broken timespec starting at words[k] was meant as one. At
+    # the end of a message, everything from the problem on is part of it; at
+    # the start, the words after the problem are the action
+    rest = words[error.index:] if k else words[error.index:error.index + 1]
+    if KEYWORDS[words[k]] == ABSOLUTE:
+        # a date that doesn't exist, like "at 2024-02-30 12:00"
+        return bool(rest) and all(any(c.isdigit() for c in w) or w in MONTHS or w in ('am', 'pm') for w in rest)
+    # a count of something that isn't a unit, like "buy milk in 5 bananas";
+    # at the start, "in 2 places at once" is as likely as "in 5 bananas ..."
+    return k > 0 and len(rest) == 1 and not rest[0].isdigit()
@@ -0,0 +1,124 @@
+import threading
+import time
+from queue import Empty
+
+import pytest
+
+from hesperus.callqueue import CallQueue, BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE
+
+def drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except Empty:
+            return items
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        CallQueue(4, 'drop-everything')
+
+def test_block_waits_for_room():
+    q = CallQueue(2, BLOCK)
+    q.put(1)
+    q.put(2)
+    done = threading.Event()
+    def put():
+        q.put(3)
+        done.set()
+    t = threading.Thread(target=put)
+    t.daemon = True
+    t.start()
+    # still waiting while the queue is full
+    assert not done.wait(0.1)
+    assert q.get_nowait() == 1
+    assert done.wait(5)
+    t.join(5)
+    assert drain(q) == [2, 3]
+    assert q.dropped == 0 and q.overflowed == 0
+
+def test_block_without_waiting_overflows():
+    q = CallQueue(2, BLOCK)
+    assert q.put(1)
+    assert q.put(2)
+    start = time.time()
+    assert q.put(3, block=False)
+    assert time.time() - start < 1
+    assert q.overflowed == 1
+    assert q.qsize() == 3
+    assert q.high_water == 3
+    assert drain(q) == [1, 2, 3]
+
+def test_drop_oldest():
+    q = CallQueue(2, DROP_OLDEST)
+    for i in range(4):
+        assert q.put(i)
+    assert q.dropped == 2
+    assert drain(q) == [2, 3]
+
+def test_drop_oldest_spares_the_priority_lane():
+    q = CallQueue(2, DROP_OLDEST)
+    q.put('urgent', priority=True)
+    q.put('chatter')
+    q.put('more chatter')
+    assert drain(q) == ['urgent', 'more chatter']
+
+def test_drop_newest():
+    q = CallQueue(2, DROP_NEWEST)
+    assert q.put(1)
+    assert q.put(2)
+    assert not q.put(3)
+    assert q.dropped == 1
+    assert drain(q) == [1, 2]
+
+def test_coalesce_by_key():
+    q = CallQueue(10, COALESCE)
+    assert q.put('a1', key='a')
+    assert q.put('b1', key='b')
+    assert not q.put('a2', key='a')
+    # calls without a key are never coalesced
+    assert q.put('x')
+    assert q.put('y')
+    assert q.coalesced == 1
+    assert drain(q) == ['a1', 'b1', 'x', 'y']
+    # once handed out, the key can be queued again
+    assert q.put('a3', key='a')
+    assert drain(q) == ['a3']
+
+def test_coalesce_at_capacity_drops_oldest():
+    q = CallQueue(2, COALESCE)
+    q.put('a', key='a')
+    q.put('b', key='b')
+    assert q.put('c', key='c')
+    assert q.dropped == 1
+    # the dropped call's key is forgotten along with it
+    assert q.put('a again', key='a')
+    assert drain(q) == ['c', 'a again']
+
+def test_keys_ignored_by_other_policies():
+    q = CallQueue(10, DROP_OLDEST)
+    q.put(1, key='same')
+    q.put(2, key='same')
+    assert q.coalesced == 0
+    assert drain(q) == [1, 2]
+
+def test_priority_lane_goes_first():
+    q = CallQueue(10)
+    q.put('normal 1')
+    q.put('priority 1', priority=True)
+    q.put('normal 2')
+    q.put('priority 2', priority=True)
+    assert drain(q) == ['priority 1', 'priority 2', 'normal 1', 'normal 2']
+    assert q.prioritized == 2
+
+def test_stats():
+    q = CallQueue(3, DROP_NEWEST)
+    for i in range(5):
+        q.put(i)
+    stats = q.stats()
+    assert stats['size'] == 3
+    assert stats['maxsize'] == 3
+    assert stats['policy'] == DROP_NEWEST
+    assert stats['queued'] == 3
+    assert stats['dropped'] == 2
+    assert stats['high_water'] == 3
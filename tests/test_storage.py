@@ -0,0 +1,151 @@
+import json
+import threading
+
+import pytest
+
+from hesperus.storage import Store, Writer
+
+@pytest.fixture
+def store(tmp_path):
+    store = Store(str(tmp_path / 'test.db'))
+    yield store
+    store.close()
+
+def test_round_trip(store):
+    ns = store.namespace('things')
+    assert ns.get('a') is None
+    assert ns.get('a', 'default') == 'default'
+    ns.put('a', {'x': [1, 2, 3]})
+    ns['b'] = 'bee'
+    assert ns.get('a') == {'x': [1, 2, 3]}
+    assert ns['b'] == 'bee'
+    assert 'a' in ns and not 'c' in ns
+    assert len(ns) == 2
+    assert ns.keys() == ['a', 'b']
+    ns.put('a', 42)
+    assert ns['a'] == 42
+    assert ns.delete('a')
+    assert not ns.delete('a')
+    assert ns.get('a') is None
+    with pytest.raises(KeyError):
+        ns['a']
+    with pytest.raises(KeyError):
+        del ns['a']
+    assert ns.items() == [('b', 'bee')]
+
+def test_namespaces_are_separate(store):
+    one = store.namespace('one')
+    two = store.namespace('two')
+    assert store.namespace('one') is one
+    one.put('key', 1)
+    two.put('key', 2)
+    assert one['key'] == 1 and two['key'] == 2
+    one.clear()
+    assert len(one) == 0 and len(two) == 1
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / 'test.db')
+    store = Store(path)
+    store.namespace('things').put('a', [1, 'two'])
+    store.close()
+    store = Store(path)
+    assert store.namespace('things')['a'] == [1, 'two']
+    store.close()
+
+def test_index_follows_updates_and_deletes(store):
+    ns = store.namespace('packages')
+    ns.put('p1', {'owner': 'alice'})
+    # indexes built from what is already stored
+    ns.add_index('owner', lambda value: value['owner'])
+    ns.put('p2', {'owner': 'bob'})
+    ns.put('p3', {'owner': 'alice'})
+    assert [key for key, value in ns.find('owner', 'alice')] == ['p1', 'p3']
+
+    ns.put('p1', {'owner': 'bob'})
+    assert [key for key, value in ns.find('owner', 'alice')] == ['p3']
+    assert ns.find('owner', 'bob') == [('p1', {'owner': 'bob'}), ('p2', {'owner': 'bob'})]
+
+    ns.delete('p2')
+    assert [key for key, value in ns.find('owner', 'bob')] == ['p1']
+    assert ns.find('owner', 'carol') == []
+
+def test_index_terms(store):
+    ns = store.namespace('reminders')
+    # several terms, or none
+    ns.add_index('tags', lambda value: value.get('tags'))
+    ns.add_index('due', lambda value: value['due'])
+    ns.put('r1', {'due': 30, 'tags': ['a', 'b']})
+    ns.put('r2', {'due': 10})
+    ns.put('r3', {'due': 20, 'tags': ['b']})
+    assert [key for key, value in ns.find('tags', 'b')] == ['r1', 'r3']
+    assert [(term, key) for term, key, value in ns.scan('due')] == [(10, 'r2'), (20, 'r3'), (30, 'r1')]
+    assert [key for term, key, value in ns.scan('due', start=15, stop=30)] == ['r3']
+    assert [key for term, key, value in ns.scan('due', limit=1)] == ['r2']
+
+def test_batch_commits(store):
+    ns = store.namespace('things')
+    transactions = store.transactions
+    with ns.batch():
+        for i in range(10):
+            ns.put('key %d' % (i,), i)
+    assert len(ns) == 10
+    assert store.transactions == transactions + 1
+
+def test_nested_batch_rolls_back(store):
+    ns = store.namespace('things')
+    ns.put('kept', 1)
+    with pytest.raises(RuntimeError):
+        with ns.batch():
+            ns.put('a', 1)
+            with ns.batch():
+                ns.put('b', 2)
+                ns.delete('kept')
+            # the inner batch is done, but nothing is committed yet
+            raise RuntimeError('oops')
+    assert ns.keys() == ['kept']
+
+    # an error in the inner batch rolls back the outer one too
+    with pytest.raises(RuntimeError):
+        with ns.batch():
+            ns.put('a', 1)
+            with ns.batch():
+                raise RuntimeError('oops')
+    assert ns.keys() == ['kept']
+
+    # and the store is still usable afterwards
+    ns.put('a', 1)
+    assert ns.keys() == ['a', 'kept']
+
+def test_import_json_once(store, tmp_path):
+    path = tmp_path / 'old.json'
+    path.write_text(json.dumps({'a': 1, 'b': [2, 3]}))
+    ns = store.namespace('things')
+    ns.add_index('number', lambda value: value if isinstance(value, int) else None)
+    assert ns.import_json(str(path)) == 2
+    assert ns.items() == [('a', 1), ('b', [2, 3])]
+    assert ns.find('number', 1) == [('a', 1)]
+
+    # not again, even if the file changed
+    ns.delete('a')
+    path.write_text(json.dumps({'c': 4}))
+    assert ns.import_json(str(path)) == 0
+    assert ns.keys() == ['b']
+
+def test_import_json_missing_or_bad(store, tmp_path):
+    ns = store.namespace('things')
+    assert ns.import_json(str(tmp_path / 'missing.json')) == 0
+    path = tmp_path / 'list.json'
+    path.write_text('[1, 2]')
+    with pytest.raises(ValueError):
+        ns.import_json(str(path))
+    assert len(ns) == 0
+
+def test_writer_runs_in_order():
+    writer = Writer()
+    done = threading.Event()
+    order = []
+    for i in range(5):
+        writer.submit(lambda i=i: order.append(i))
+    writer.submit(done.set)
+    assert done.wait(5)
+    assert order == [0, 1, 2, 3, 4]
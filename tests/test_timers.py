@@ -0,0 +1,135 @@
+import random
+
+import pytest
+
+from hesperus.timers import TimerWheel, Periodic, DELAY
+
+class Clock(object):
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+def make_wheel(**kwargs):
+    clock = Clock()
+    # one-second ticks, 4 slots a level: the first level covers 4 seconds,
+    # the second 16, and anything later overflows
+    kwargs.setdefault('resolution', 1.0)
+    kwargs.setdefault('slots', 4)
+    kwargs.setdefault('levels', 2)
+    return clock, TimerWheel(clock=clock, **kwargs)
+
+def run_until(clock, wheel, end):
+    # advances the wheel the way the core does, jumping to each due tick
+    while True:
+        delay = wheel.next_delay()
+        if delay is None or clock.t + delay > end:
+            clock.t = end
+            wheel.advance()
+            return
+        clock.t += delay
+        wheel.advance()
+
+def test_fires_on_time():
+    clock, wheel = make_wheel()
+    fired = []
+    wheel.schedule(3, lambda: fired.append(clock.t))
+    run_until(clock, wheel, 2.5)
+    assert fired == []
+    run_until(clock, wheel, 10)
+    assert fired == [3]
+    assert len(wheel) == 0
+
+def test_crosses_level_boundary():
+    clock, wheel = make_wheel()
+    fired = []
+    # too far for the first level, so it starts in the second and is
+    # cascaded down at tick 4
+    wheel.schedule(6, lambda: fired.append(clock.t))
+    run_until(clock, wheel, 5)
+    assert fired == []
+    assert wheel.cascades == 1
+    run_until(clock, wheel, 7)
+    assert fired == [6]
+
+def test_overflow():
+    clock, wheel = make_wheel()
+    fired = []
+    wheel.schedule(37, lambda: fired.append(clock.t))
+    run_until(clock, wheel, 36)
+    assert fired == []
+    run_until(clock, wheel, 40)
+    assert fired == [37]
+
+def test_fractional_deadline_rounds_up():
+    clock, wheel = make_wheel()
+    fired = []
+    wheel.schedule(2.5, lambda: fired.append(clock.t))
+    run_until(clock, wheel, 10)
+    assert fired == [3]
+
+def test_cancel():
+    clock, wheel = make_wheel()
+    fired = []
+    timer = wheel.schedule(6, lambda: fired.append('cancelled'))
+    wheel.schedule(7, lambda: fired.append('kept'))
+    assert timer.pending
+    wheel.cancel(timer)
+    assert not timer.pending
+    assert len(wheel) == 1
+    run_until(clock, wheel, 10)
+    assert fired == ['kept']
+    # cancelling again, after the fact, does nothing
+    wheel.cancel(timer)
+
+def test_on_earlier():
+    calls = []
+    clock, wheel = make_wheel(on_earlier=lambda: calls.append(clock.t))
+    wheel.schedule(10, lambda: None)
+    assert len(calls) == 1
+    assert wheel.next_delay() == pytest.approx(8)
+    # later than what the driver is waiting for
+    wheel.schedule(12, lambda: None)
+    assert len(calls) == 1
+    # earlier, so the driver has to be woken up
+    wheel.schedule(2, lambda: None)
+    assert len(calls) == 2
+    assert wheel.next_delay() == pytest.approx(2)
+
+def test_periodic_delay():
+    clock, wheel = make_wheel()
+    fired = []
+    def tick():
+        fired.append(clock.t)
+        periodic.done()
+    periodic = Periodic(wheel, 5, tick)
+    periodic.start()
+    run_until(clock, wheel, 21)
+    assert fired == [5, 10, 15, 20]
+    periodic.stop()
+    run_until(clock, wheel, 40)
+    assert fired == [5, 10, 15, 20]
+
+def test_periodic_jitter_within_bounds():
+    random.seed(1)
+    clock, wheel = make_wheel(resolution=0.01, slots=64, levels=4)
+    interval, jitter = 10.0, 0.5
+    fired = []
+    def tick():
+        fired.append(clock.t)
+        periodic.done()
+    periodic = Periodic(wheel, interval, tick, jitter=jitter, policy=DELAY)
+    periodic.start()
+    run_until(clock, wheel, 2000)
+    gaps = [b - a for a, b in zip([0.0] + fired, fired)]
+    assert len(gaps) > 100
+    for gap in gaps:
+        assert interval - 1e-6 <= gap <= interval * (1 + jitter) + wheel.resolution + 1e-6
+    # and it is actually spread out
+    assert max(gaps) - min(gaps) > interval * jitter / 2
+
+def test_periodic_unknown_policy():
+    clock, wheel = make_wheel()
+    with pytest.raises(ValueError):
+        Periodic(wheel, 5, lambda: None, policy='sometimes')
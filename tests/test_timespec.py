@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from hesperus import timespec
+from hesperus.timespec import parse, TimespecError, RELATIVE, RECURRING, ABSOLUTE
+
+# noon, local time
+NOW = time.mktime((2026, 10, 18, 12, 0, 0, 0, 0, -1))
+
+def local(*parts):
+    return time.mktime(parts + (0,) * (6 - len(parts)) + (0, 0, -1))
+
+@pytest.mark.parametrize('text, seconds, action', [
+    ('in 1 hour 30 mins call mom', 90 * 60, 'call mom'),
+    ('in 1h30m stretch', 90 * 60, 'stretch'),
+    ('in an hour make tea', 60 * 60, 'make tea'),
+    ('in 10 mins at the pub', 10 * 60, 'at the pub'),
+    ('in 5 mins 3 apples to buy', 5 * 60, '3 apples to buy'),
+])
+def test_leading_in(text, seconds, action):
+    found = parse(text, NOW)
+    assert found.kind == RELATIVE
+    assert found.seconds == seconds
+    assert found.when == NOW + seconds
+    assert found.action == action
+
+@pytest.mark.parametrize('text, seconds, action', [
+    ('call mom in 1 hour 30 mins', 90 * 60, 'call mom'),
+    ('stretch in 90s', 90, 'stretch'),
+    ('tea in 2 weeks, 3 days and 4 hours', 2 * timespec.WEEK + 3 * timespec.DAY + 4 * timespec.HOUR, 'tea'),
+    ('at the pub in 10 mins', 10 * 60, 'at the pub'),
+])
+def test_trailing_in(text, seconds, action):
+    found = parse(text, NOW)
+    assert found.kind == RELATIVE
+    assert found.seconds == seconds
+    assert found.action == action
+
+@pytest.mark.parametrize('text, seconds, action', [
+    ('for 3 days water plants', 3 * timespec.DAY, 'water plants'),
+    ('water plants for 2 weeks', 2 * timespec.WEEK, 'water plants'),
+])
+def test_for(text, seconds, action):
+    found = parse(text, NOW)
+    assert found.kind == RECURRING
+    assert found.seconds == seconds
+    assert found.action == action
+
+@pytest.mark.parametrize('text, when, action', [
+    ('at 2026-12-01 09:30 dentist', local(2026, 12, 1, 9, 30), 'dentist'),
+    ('dentist at dec 1 2026 09:30:00', local(2026, 12, 1, 9, 30), 'dentist'),
+    ('at 1 dec 2026 09:30:00 dentist', local(2026, 12, 1, 9, 30), 'dentist'),
+    ('dentist at 2026-12-01T09:30', local(2026, 12, 1, 9, 30), 'dentist'),
+    # the next time it is that time: later today, or tomorrow
+    ('at 17:45 leave', local(2026, 10, 18, 17, 45), 'leave'),
+    ('leave at 5pm', local(2026, 10, 18, 17), 'leave'),
+    ('at 9 am standup', local(2026, 10, 19, 9), 'standup'),
+])
+def test_at(text, when, action):
+    found = parse(text, NOW)
+    assert found.kind == ABSOLUTE
+    assert found.when == when
+    assert found.seconds == when - NOW
+    assert found.action == action
+
+@pytest.mark.parametrize('text', [
+    'hello there',
+    'I was born in 1984',
+    'meet in the kitchen',
+    'in 2 places at once',
+    'in a while read',
+])
+def test_no_timespec(text):
+    found = parse(text, NOW)
+    assert found.kind is None
+    assert found.when is None and found.seconds is None
+    assert found.action == text
+
+def test_unknown_unit():
+    with pytest.raises(TimespecError) as info:
+        parse('buy milk in 5 bananas', NOW)
+    assert info.value.position == len('buy milk in 5 ')
+
+def test_nothing_after_the_time():
+    with pytest.raises(TimespecError):
+        parse('in 10 min', NOW)
+
+@pytest.mark.parametrize('text', [
+    'at 2026-02-30 12:00 something',
+    'something at 2026-13-01 12:00',
+    'at 25:00 something',
+])
+def test_bad_dates(text):
+    with pytest.raises(TimespecError):
+        parse(text, NOW)